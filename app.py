@@ -1,12 +1,36 @@
 import sqlite3
 import markdown
 import os
-import io
+import tempfile
+import shutil
 import zipfile
 import json
-from PIL import Image
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file, send_from_directory
+import hashlib
+import threading
+import multiprocessing
+import queue
+import time
+import math
+import re
+import html
+import base64
+import binascii
+import unicodedata
+import requests
+import gzip
+import struct
+import click
+import sys
+import bisect
+import urllib.parse
+import mimetypes
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, ImageOps
+from functools import wraps, lru_cache
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file, abort
+from flask import before_render_template, template_rendered
+from werkzeug.security import safe_join
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -25,13 +49,16 @@ app.secret_key = os.getenv("SECRET_KEY", "fallback-secret")
 
 # Use persistent disk location if available
 # Use /var/data if it exists (Render persistent disk), otherwise use ./db locally
+# PERSISTENT_DIR in the environment overrides both (the benchmarks use a temp dir)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # -------------------------
 # Persistent directory
 # -------------------------
-if os.path.exists("/var/data"):
+if os.getenv("PERSISTENT_DIR"):
+    PERSISTENT_DIR = os.getenv("PERSISTENT_DIR")
+elif os.path.exists("/var/data"):
     PERSISTENT_DIR = "/var/data"
 else:
     PERSISTENT_DIR = os.path.join(BASE_DIR, "data")
@@ -50,6 +77,7 @@ DB_NAME = os.path.join(PERSISTENT_DIR, "pictures.db")
 BLOG_DB = os.path.join(PERSISTENT_DIR, "blog.db")
 FOOD_DB = os.path.join(PERSISTENT_DIR, "food_map.db")
 UPDATES_DB = os.path.join(PERSISTENT_DIR, "site_update.db")
+FEATURES_DB = os.path.join(PERSISTENT_DIR, "features.db")
 
 # Create empty DB files if missing
 for db_file in [DB_NAME, BLOG_DB,FOOD_DB]:
@@ -62,10 +90,9 @@ for db_file in [DB_NAME, BLOG_DB,FOOD_DB]:
 IMAGE_FOLDER = os.path.join(PERSISTENT_DIR, "images")
 os.makedirs(IMAGE_FOLDER, exist_ok=True)
 
-#having trouble with photo updates, trying to fix it
-@app.route("/data/<path:filename>")
-def data(filename):
-    return send_from_directory(PERSISTENT_DIR, filename)
+# Resized copies of the originals used by the gallery (regenerable)
+DERIVATIVE_FOLDER = os.path.join(PERSISTENT_DIR, "derivatives")
+os.makedirs(DERIVATIVE_FOLDER, exist_ok=True)
 
 # GeoJSON files (persistent)
 CITIES_GEOJSON = os.path.join(PERSISTENT_DIR, "cities.geojson")
@@ -77,34 +104,453 @@ for geojson_path in [CITIES_GEOJSON, MOUNTAINS_GEOJSON]:
             json.dump({"type": "FeatureCollection", "features": []}, f, indent=2)
 
 # -------------------------
-# Database Connection Helpers
+# Request Metrics
+# -------------------------
+# MetricsMiddleware wraps the WSGI app and records, per route: a latency
+# histogram, status codes, bytes sent, SQLite query count and time, and
+# template render time. The totals are per worker process and are served in
+# Prometheus text format at /admin/metrics.
+#
+# Setting PROFILE_SLOW_MS turns on a sampling profiler: while a request runs,
+# a background thread samples its stack every PROFILE_INTERVAL_MS, and
+# requests slower than the threshold are written to PROFILE_FOLDER as
+# collapsed stacks (one "frame;frame;frame count" line per stack), ready for
+# flamegraph.pl or speedscope.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))  # 0 leaves the profiler off
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_FOLDER = os.path.join(PERSISTENT_DIR, "profiles")
+PROFILE_KEEP = 200  # newest profiles kept on disk
+
+REQUEST_METRICS = {}   # (method, route) -> counters
+TEMPLATE_METRICS = {}  # template name -> Histogram
+_metrics_lock = threading.Lock()
+_request_local = threading.local()
+
+class Histogram:
+    """Latency histogram with the fixed METRICS_BUCKETS upper bounds."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def record_request_db(seconds, queries=0):
+    """Add SQLite work to the request running on this thread, if any."""
+    state = getattr(_request_local, "state", None)
+    if state is not None:
+        state["db_queries"] += queries
+        state["db_seconds"] += seconds
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    _request_local.__dict__.setdefault("template_starts", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    starts = getattr(_request_local, "template_starts", None)
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    state = getattr(_request_local, "state", None)
+    if state is not None:
+        state["template_seconds"] += elapsed
+    with _metrics_lock:
+        TEMPLATE_METRICS.setdefault(template.name or "(string)", Histogram()).observe(elapsed)
+
+@app.before_request
+def _label_request_route():
+    """Label metrics with the URL rule rather than the path, so /data/<path> is one series."""
+    request.environ["metrics.route"] = request.url_rule.rule if request.url_rule else "(unmatched)"
+
+_profiled_threads = {}  # thread id -> Counter of collapsed stacks
+_profile_lock = threading.Lock()
+_sampler_thread = None
+
+def collapse_stack(frame):
+    """Render a frame and its callers as one collapsed-stack line, outermost first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def _sample_stacks():
+    """Sampler thread: record the current stack of every profiled request."""
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        frames = sys._current_frames()
+        with _profile_lock:
+            for thread_id, samples in _profiled_threads.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[collapse_stack(frame)] += 1
+
+def start_profiling():
+    """Start sampling the calling thread, starting the sampler on first use."""
+    global _sampler_thread
+    with _profile_lock:
+        if _sampler_thread is None:
+            _sampler_thread = threading.Thread(target=_sample_stacks, name="profile-sampler", daemon=True)
+            _sampler_thread.start()
+        _profiled_threads[threading.get_ident()] = Counter()
+
+def stop_profiling():
+    """Stop sampling the calling thread and return its samples."""
+    with _profile_lock:
+        return _profiled_threads.pop(threading.get_ident(), Counter())
+
+def write_profile(route, seconds, samples):
+    """Write a slow request's samples as collapsed stacks and prune old profiles."""
+    if not samples:
+        return
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{slug}-{seconds * 1000:.0f}ms.folded"
+    with open(os.path.join(PROFILE_FOLDER, name), "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+    profiles = sorted(os.listdir(PROFILE_FOLDER))
+    for old in profiles[:-PROFILE_KEEP]:
+        os.remove(os.path.join(PROFILE_FOLDER, old))
+
+class MetricsMiddleware:
+    """WSGI middleware recording per-route request metrics (see above)."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        state = {"db_queries": 0, "db_seconds": 0.0, "template_seconds": 0.0, "status": 500, "length": None}
+        _request_local.state = state
+        start = time.perf_counter()
+        if PROFILE_SLOW_MS:
+            start_profiling()
+
+        def metrics_start_response(status, headers, exc_info=None):
+            state["status"] = int(status.split(" ", 1)[0])
+            for name, value in headers:
+                if name.lower() == "content-length" and value.isdigit():
+                    state["length"] = int(value)
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.wsgi_app(environ, metrics_start_response)
+        except BaseException:
+            self.finish(environ, state, start, 0)
+            raise
+
+        # The server streams file responses itself (sendfile); wrapping them
+        # would lose that, so count them by Content-Length when returned
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper):
+            self.finish(environ, state, start, state["length"] or 0)
+            return app_iter
+        return self.stream(app_iter, environ, state, start)
+
+    def stream(self, app_iter, environ, state, start):
+        sent = 0
+        try:
+            for chunk in app_iter:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self.finish(environ, state, start, sent)
+
+    def finish(self, environ, state, start, sent):
+        elapsed = time.perf_counter() - start
+        _request_local.state = None
+        route = environ.get("metrics.route", "(unmatched)")
+        key = (environ.get("REQUEST_METHOD", ""), route)
+        with _metrics_lock:
+            entry = REQUEST_METRICS.get(key)
+            if entry is None:
+                entry = REQUEST_METRICS[key] = {
+                    "latency": Histogram(), "statuses": Counter(), "bytes": 0,
+                    "db_queries": 0, "db_seconds": 0.0, "template_seconds": 0.0,
+                }
+            entry["latency"].observe(elapsed)
+            entry["statuses"][state["status"]] += 1
+            entry["bytes"] += sent
+            for field in ("db_queries", "db_seconds", "template_seconds"):
+                entry[field] += state[field]
+
+        if PROFILE_SLOW_MS:
+            samples = stop_profiling()
+            if elapsed * 1000 >= PROFILE_SLOW_MS:
+                try:
+                    write_profile(route, elapsed, samples)
+                except OSError as e:
+                    print(f"Could not write profile for {route}: {e}")
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+def prometheus_escape(value):
+    """Escape a label value as the Prometheus text format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_labels(**labels):
+    return "{" + ",".join(f'{name}="{prometheus_escape(value)}"' for name, value in labels.items()) + "}"
+
+def prometheus_histogram(lines, name, histogram, **labels):
+    """Append a histogram's cumulative buckets, sum and count."""
+    cumulative = 0
+    for bound, count in zip((*METRICS_BUCKETS, "+Inf"), histogram.buckets):
+        cumulative += count
+        lines.append(f"{name}_bucket{prometheus_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_sum{prometheus_labels(**labels)} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{prometheus_labels(**labels)} {histogram.count}")
+
+def render_prometheus():
+    """All request, template and SQLite metrics of this worker in Prometheus text format."""
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with _metrics_lock:
+        requests_by_route = sorted(REQUEST_METRICS.items())
+        templates = sorted(TEMPLATE_METRICS.items())
+
+        header("http_requests_total", "counter", "Requests by route and status.")
+        for (method, route), entry in requests_by_route:
+            for status, count in sorted(entry["statuses"].items()):
+                lines.append(f"http_requests_total{prometheus_labels(method=method, route=route, status=status)} {count}")
+
+        header("http_request_duration_seconds", "histogram", "Request latency by route, until the last byte was sent.")
+        for (method, route), entry in requests_by_route:
+            prometheus_histogram(lines, "http_request_duration_seconds", entry["latency"], method=method, route=route)
+
+        for name, field, help_text, fmt in (
+            ("http_response_bytes_total", "bytes", "Response bytes sent by route.", "{}"),
+            ("http_request_db_queries_total", "db_queries", "SQLite statements run by route.", "{}"),
+            ("http_request_db_seconds_total", "db_seconds", "Time spent in SQLite by route.", "{:.6f}"),
+            ("http_request_template_seconds_total", "template_seconds", "Template render time by route.", "{:.6f}"),
+        ):
+            header(name, "counter", help_text)
+            for (method, route), entry in requests_by_route:
+                lines.append(f"{name}{prometheus_labels(method=method, route=route)} {fmt.format(entry[field])}")
+
+        header("template_render_seconds", "histogram", "Render time by template.")
+        for template, histogram in templates:
+            prometheus_histogram(lines, "template_render_seconds", histogram, template=template)
+
+    with _db_stats_lock:
+        db_stats = sorted((name, dict(stats)) for name, stats in DB_STATS.items())
+    for name, field, help_text, fmt in (
+        ("sqlite_queries_total", "queries", "SQLite statements run by database.", "{}"),
+        ("sqlite_query_seconds_total", "query_seconds", "Time spent in SQLite statements and fetches by database.", "{:.6f}"),
+        ("sqlite_connections_opened_total", "connections_opened", "SQLite connections opened by database.", "{}"),
+        ("sqlite_connection_hold_seconds_total", "hold_seconds", "Time connections were checked out by database.", "{:.6f}"),
+    ):
+        header(name, "counter", help_text)
+        for db, stats in db_stats:
+            lines.append(f"{name}{prometheus_labels(db=db)} {fmt.format(stats[field])}")
+
+    return "\n".join(lines) + "\n"
+
+# -------------------------
+# Database Connection Manager
 # -------------------------
+# Each thread keeps one open connection per database and reuses it across
+# requests. Routes still call conn.close(); that only hands the connection
+# back (rolling back anything left uncommitted), and the app-context teardown
+# does the same for routes that exit early.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # readers no longer block on admin writes
+    "PRAGMA synchronous=NORMAL",      # safe with WAL, far fewer fsyncs
+    "PRAGMA cache_size=-8000",        # 8 MB page cache per connection
+    "PRAGMA mmap_size=67108864",      # 64 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+# Pragmas that only tune reads, for the built read-only files (tiles, gazetteer)
+READ_ONLY_PRAGMAS = SQLITE_PRAGMAS[2:]
+
+DB_STATS = {}
+_db_stats_lock = threading.Lock()
+_db_local = threading.local()
+
+def record_db_stat(path, **increments):
+    """Add to the running counters kept for a database."""
+    with _db_stats_lock:
+        stats = DB_STATS.setdefault(os.path.basename(path), {
+            "connections_opened": 0, "queries": 0, "query_seconds": 0.0,
+            "holds": 0, "hold_seconds": 0.0, "max_hold_seconds": 0.0,
+        })
+        for key, value in increments.items():
+            if key == "max_hold_seconds":
+                stats[key] = max(stats[key], value)
+            else:
+                stats[key] += value
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long statements and fetches take."""
+
+    def _timed(self, method, *args, count=False):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if count:
+                record_db_stat(self.connection.db_path, queries=1, query_seconds=elapsed)
+            else:
+                record_db_stat(self.connection.db_path, query_seconds=elapsed)
+            record_request_db(elapsed, 1 if count else 0)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters, count=True)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters, count=True)
+
+    def executescript(self, sql_script):
+        return self._timed(super().executescript, sql_script, count=True)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class PooledConnection(sqlite3.Connection):
+    """Connection reused by its thread; close() releases it instead of closing it."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        release_connection(self)
+
+def get_connection(path, read_only=False):
+    """Return this thread's connection to a database, opening it on first use.
+    The connection is reopened if the file was replaced (e.g. by a restore).
+    read_only opens the file with mode=ro and leaves its journal mode alone."""
+    connections = _db_local.__dict__.setdefault("connections", {})
+    inode = os.stat(path).st_ino if os.path.exists(path) else None
+    conn = connections.get(path)
+    if conn is not None and conn.inode != inode:
+        sqlite3.Connection.close(conn)
+        conn = None
+
+    if conn is None:
+        if read_only:
+            uri = "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, factory=PooledConnection)
+        else:
+            conn = sqlite3.connect(path, factory=PooledConnection)
+        conn.db_path = path
+        conn.row_factory = sqlite3.Row
+        for pragma in READ_ONLY_PRAGMAS if read_only else SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        conn.inode = os.stat(path).st_ino
+        conn.acquired_at = None
+        connections[path] = conn
+        record_db_stat(path, connections_opened=1)
+
+    if conn.acquired_at is None:
+        conn.acquired_at = time.perf_counter()
+    return conn
+
+def release_connection(conn):
+    """Hand a connection back to its thread, discarding any uncommitted work."""
+    if conn.in_transaction:
+        conn.rollback()
+    if conn.acquired_at is not None:
+        held = time.perf_counter() - conn.acquired_at
+        conn.acquired_at = None
+        record_db_stat(conn.db_path, holds=1, hold_seconds=held, max_hold_seconds=held)
+
+@app.teardown_appcontext
+def release_connections(exc):
+    """Release every connection this thread used during the request."""
+    for conn in getattr(_db_local, "connections", {}).values():
+        release_connection(conn)
+
+def _forget_connections():
+    """Forked children must not share the parent's SQLite handles."""
+    global _db_local
+    _db_local = threading.local()
+
+os.register_at_fork(after_in_child=_forget_connections)
+
 def get_db_connection():
     """Return a connection to pictures.db with row access as dict."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection(DB_NAME)
 
 def get_blog_connection():
     """Return a connection to blog.db with row access as dict."""
-    conn = sqlite3.connect(BLOG_DB)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection(BLOG_DB)
 
 def get_updates_connection():
-    """Return a connection to site_updates.db with row access as dict,
-    creating the table if it doesn't exist."""
-    conn = sqlite3.connect(UPDATES_DB)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    return conn
+    """Return a connection to site_update.db with row access as dict."""
+    return get_connection(UPDATES_DB)
 
 def get_FOOD_connection():
-    """Return a connection to blog.db with row access as dict."""
-    conn = sqlite3.connect(FOOD_DB)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Return a connection to food_map.db with row access as dict."""
+    return get_connection(FOOD_DB)
+
+def get_features_connection():
+    """Return a connection to features.db with row access as dict."""
+    return get_connection(FEATURES_DB)
+
+# -------------------------
+# Site Updates: pre-rendered Markdown
+# -------------------------
+# Site update posts are written in Markdown. The HTML is rendered once when a
+# post is saved and stored in description_html, so the public page never runs
+# Markdown/codehilite per request.
+MARKDOWN_EXTENSIONS = ["fenced_code", "codehilite"]
+
+def render_markdown(text):
+    """Render a site update description to HTML."""
+    return markdown.markdown(text or "", extensions=MARKDOWN_EXTENSIONS)
+
+def init_updates_db():
+    """Add the description_html column to site updates and backfill missing HTML."""
+    conn = get_updates_connection()
+    tables = [row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if "posts" not in tables:
+        conn.close()
+        return
+
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(posts)")]
+    if "description_html" not in columns:
+        conn.execute("ALTER TABLE posts ADD COLUMN description_html TEXT")
+
+    rows = conn.execute("SELECT id, description FROM posts WHERE description_html IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE posts SET description_html = ? WHERE id = ?",
+        [(render_markdown(row["description"]), row["id"]) for row in rows]
+    )
+    conn.commit()
+    conn.close()
+
+init_updates_db()
+
 # -------------------------------
 # Load GeoJSON safely
 # -------------------------------
@@ -117,25 +563,1947 @@ def load_geojson(path):
             print(f"Warning: Could not decode JSON in {path}")
     return {"type": "FeatureCollection", "features": []}
 
-cities_data = load_geojson(CITIES_GEOJSON)
-mountains_data = load_geojson(MOUNTAINS_GEOJSON)
+# -------------------------
+# Compressed Delivery
+# -------------------------
+# Text assets (GeoJSON, JS, CSS, the countries layer) are compressed once per
+# content version, not per request: gzip and, when the optional brotli package
+# is installed, brotli copies live in a hidden .precompressed folder beside the
+# source, named after its content hash. They are written by
+# `flask --app app precompress-assets` at build time and in the background when
+# a layer snapshot is exported. A version nobody built yet is served
+# uncompressed while the process pool builds its copies. Hidden folders
+# are left out of backups, and copies of older versions are pruned when a new
+# one is built. Dynamic JSON responses fall back to gzip on the fly.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PRECOMPRESSED_DIR = ".precompressed"
+PRECOMPRESS_PENDING_SECONDS = 300   # a build marker older than this is abandoned
+COMPRESSIBLE_EXTENSIONS = {".geojson", ".json", ".js", ".css", ".svg", ".html", ".txt"}
+COMPRESS_MIN_SIZE = 1024
+DYNAMIC_GZIP_LEVEL = 6
+# Best encoding first
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+def available_encodings():
+    return [encoding for encoding in ENCODING_SUFFIXES if encoding != "br" or brotli]
+
+def accepted_encodings():
+    """Encodings this server can produce that the client accepts, best first."""
+    return [e for e in available_encodings() if request.accept_encodings.quality(e) > 0]
+
+def is_compressible(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def compress_bytes(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def precompressed_path(path, encoding):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, PRECOMPRESSED_DIR, f"{name}.{data_version(path)}{ENCODING_SUFFIXES[encoding]}")
+
+def precompress(path):
+    """Write the compressed copies of a file's current version and remove
+    copies of older versions. Returns the number of copies written."""
+    if not is_compressible(path) or os.path.getsize(path) < COMPRESS_MIN_SIZE:
+        return 0
+    folder, name = os.path.split(path)
+    os.makedirs(os.path.join(folder, PRECOMPRESSED_DIR), exist_ok=True)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    written = 0
+    keep = set()
+    for encoding in available_encodings():
+        target = precompressed_path(path, encoding)
+        keep.add(os.path.basename(target))
+        if os.path.exists(target):
+            continue
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(target))
+        with os.fdopen(fd, "wb") as f:
+            f.write(compress_bytes(data, encoding))
+        os.replace(tmp_path, target)
+        written += 1
+
+    stale = re.compile(re.escape(name) + r"\.[0-9a-f]{32}\.(gz|br)(\.pending)?$")
+    for entry in os.scandir(os.path.join(folder, PRECOMPRESSED_DIR)):
+        if stale.match(entry.name) and entry.name not in keep:
+            os.remove(entry.path)
+    return written
+
+def queue_precompress(path):
+    """Build a file's compressed copies in the process pool. A marker file next
+    to the copies makes concurrent requests and workers queue a version once."""
+    if not is_compressible(path) or os.path.getsize(path) < COMPRESS_MIN_SIZE:
+        return
+    marker = precompressed_path(path, "gzip") + ".pending"
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(marker) < PRECOMPRESS_PENDING_SECONDS:
+                return  # already being built
+        except FileNotFoundError:
+            return  # just finished
+        os.utime(marker)  # take over an abandoned build
+
+    def done(future):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Could not precompress {path}: {e}")
+        finally:
+            if os.path.exists(marker):
+                os.remove(marker)
+
+    get_process_pool().submit(precompress, path).add_done_callback(done)
+
+def send_precompressed(folder, filename, max_age=None):
+    """send_from_directory() that answers with a precompressed copy when the
+    client accepts one. The ETag is the content version, per encoding."""
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    version = data_version(path)
+    if not is_compressible(path):
+        return send_file(path, etag=version, max_age=max_age)
+
+    encodings = accepted_encodings() if os.path.getsize(path) >= COMPRESS_MIN_SIZE else []
+    if encodings and not os.path.exists(precompressed_path(path, encodings[0])):
+        queue_precompress(path)  # first request for this version; served as-is meanwhile
+    for encoding in encodings:
+        variant = precompressed_path(path, encoding)
+        if os.path.exists(variant):
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            response = send_file(variant, mimetype=mimetype, etag=f"{version}-{encoding}", max_age=max_age)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_file(path, etag=version, max_age=max_age)
+    response.vary.add("Accept-Encoding")
+    return response
+
+def serve_static(filename):
+    """Flask's static route, with precompressed copies."""
+    return send_precompressed(app.static_folder, filename, max_age=app.get_send_file_max_age(filename))
+
+app.view_functions["static"] = serve_static
+
+def gzip_response(response):
+    """Gzip a dynamic JSON response in place if the client accepts gzip."""
+    if (not response.is_json or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if request.accept_encodings.quality("gzip") <= 0:
+        return response
+    body = response.get_data()
+    if len(body) >= COMPRESS_MIN_SIZE:
+        response.set_data(gzip.compress(body, compresslevel=DYNAMIC_GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+app.after_request(gzip_response)
+
+@app.cli.command("precompress-assets")
+def precompress_assets_command():
+    """Build the gzip/brotli copies of static assets and the GeoJSON layers."""
+    for layer in FEATURE_LAYERS:
+        export_layer(layer)
+    paths = [os.path.join(PERSISTENT_DIR, name) for name in os.listdir(PERSISTENT_DIR)]
+    for dirpath, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        paths.extend(os.path.join(dirpath, name) for name in files)
+
+    built = 0
+    for path in paths:
+        if os.path.isfile(path) and is_compressible(path):
+            built += precompress(path)
+    click.echo(f"{built} compressed copies written ({', '.join(available_encodings())})")
+
+# -------------------------
+# Versioned data serving
+# -------------------------
+# Files under PERSISTENT_DIR are served with a strong ETag built from their
+# content hash, so unchanged GeoJSON and images come back as 304s. URLs built
+# with data_url() carry that hash as ?v=..., and those are cached immutably.
+FINGERPRINT_MAX_AGE = 365 * 24 * 60 * 60
+
+def data_version(path):
+    """Return the content version (short SHA-256) of a file in the data folder."""
+    return cached_sha256(path)[:32]
+
+def refresh_data_version(path):
+    """Recompute a file's version right after an admin route rewrites it."""
+    _hash_cache.pop(path, None)
+    return data_version(path)
+
+@app.template_global()
+def data_url(filename):
+    """Fingerprinted URL for a file in the data folder (falls back to the plain URL)."""
+    path = safe_join(PERSISTENT_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return url_for("serve_data", filename=filename)
+    return url_for("serve_data", filename=filename, v=data_version(path))
 
 # Serve GeoJSON files from the persistent disk folder.
 # This allows Flask to dynamically serve files from /var/data (PERSISTENT_DIR),
 @app.route("/data/<path:filename>")
 def serve_data(filename):
-    return send_from_directory(PERSISTENT_DIR, filename)
+    path = safe_join(PERSISTENT_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    fingerprinted = request.args.get("v") == data_version(path)
+    response = send_precompressed(
+        PERSISTENT_DIR, filename,
+        max_age=FINGERPRINT_MAX_AGE if fingerprinted else None
+    )
+    if fingerprinted:
+        response.cache_control.immutable = True
+    return response
+
+# Older templates refer to the same route as "data"
+app.add_url_rule("/data/<path:filename>", endpoint="data", view_func=serve_data)
+
+# -------------------------
+# Picture Derivatives
+# -------------------------
+# Every original in IMAGE_FOLDER gets a set of smaller copies so the gallery
+# can use srcset thumbnails and only load the full image in the modal.
+DERIVATIVE_WIDTHS = (320, 800, 1600)
+DERIVATIVE_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+DERIVATIVE_QUALITY = 80
+
+def derivative_name(filename, width, ext):
+    """Return the derivative filename for an original at a given width. The
+    original's extension is kept so IMG_1.jpg and IMG_1.png do not collide."""
+    return f"{filename}_{width}w.{ext}"
+
+def generate_derivatives(filename, force=False, source_width=None):
+    """Write resized WebP and JPEG copies of an original image.
+    Widths that would upscale the original are skipped; pass the oriented
+    source_width when known so they are skipped without opening the file.
+    Returns the number of files written."""
+    src_path = os.path.join(IMAGE_FOLDER, filename)
+    targets = [
+        (width, ext)
+        for width in DERIVATIVE_WIDTHS
+        for ext in DERIVATIVE_FORMATS
+        if not (source_width and width >= source_width)
+        and (force or not os.path.exists(os.path.join(DERIVATIVE_FOLDER, derivative_name(filename, width, ext))))
+    ]
+    if not targets:
+        return 0
+
+    written = 0
+    with Image.open(src_path) as img:
+        # Let the JPEG decoder scale down while decoding when the original is huge
+        largest = max(DERIVATIVE_WIDTHS)
+        img.draft("RGB", (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+        # Work from the largest width down so each resize starts from the previous one
+        base = img
+        for width in sorted({width for width, _ in targets}, reverse=True):
+            if width >= img.width:
+                continue
+            height = round(img.height * width / img.width)
+            base = base.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            for ext in [ext for w, ext in targets if w == width]:
+                out = base.convert("RGB") if DERIVATIVE_FORMATS[ext] == "JPEG" else base
+                out_path = os.path.join(DERIVATIVE_FOLDER, derivative_name(filename, width, ext))
+                tmp_path = out_path + ".tmp"
+                out.save(tmp_path, format=DERIVATIVE_FORMATS[ext], quality=DERIVATIVE_QUALITY, optimize=True)
+                os.replace(tmp_path, out_path)
+                written += 1
+    return written
+
+def invalidate_derivatives(filename):
+    """Remove every derivative of an original (call when the original changes)."""
+    for width in DERIVATIVE_WIDTHS:
+        for ext in DERIVATIVE_FORMATS:
+            path = os.path.join(DERIVATIVE_FOLDER, derivative_name(filename, width, ext))
+            if os.path.exists(path):
+                os.remove(path)
+
+def refresh_derivatives(filename):
+    """Rebuild the derivative set after the original was rewritten."""
+    invalidate_derivatives(filename)
+    try:
+        generate_derivatives(filename)
+    except Exception as e:
+        print(f"Could not generate derivatives for {filename}: {e}")
+
+def migrate_derivative_names():
+    """Rename derivatives from the old stem-only names (IMG_1_320w.jpg) to
+    derivative_name(). Derivatives of a stem shared by several originals
+    can't be told apart, so they are removed; the backfill rebuilds them."""
+    if not os.listdir(DERIVATIVE_FOLDER):
+        return
+    originals = {}
+    for name in os.listdir(IMAGE_FOLDER):
+        if not name.startswith("."):
+            originals.setdefault(os.path.splitext(name)[0], []).append(name)
+    for stem, names in originals.items():
+        for width in DERIVATIVE_WIDTHS:
+            for ext in DERIVATIVE_FORMATS:
+                old_path = os.path.join(DERIVATIVE_FOLDER, f"{stem}_{width}w.{ext}")
+                if not os.path.exists(old_path):
+                    continue
+                if len(names) == 1:
+                    os.replace(old_path, os.path.join(DERIVATIVE_FOLDER, derivative_name(names[0], width, ext)))
+                else:
+                    os.remove(old_path)
+
+migrate_derivative_names()
+
+@app.template_global()
+def picture_sources(filename):
+    """Return the URLs a template needs to show a picture responsively.
+    Falls back to the original when no derivatives exist yet. The original
+    is linked without a fingerprint so rendering a page never hashes it."""
+    full = url_for("serve_data", filename="images/" + filename)
+    srcsets = {}
+    for ext in DERIVATIVE_FORMATS:
+        entries = []
+        for width in DERIVATIVE_WIDTHS:
+            name = derivative_name(filename, width, ext)
+            if os.path.exists(os.path.join(DERIVATIVE_FOLDER, name)):
+                entries.append(f"{data_url('derivatives/' + name)} {width}w")
+        srcsets[ext] = ", ".join(entries)
+
+    smallest = derivative_name(filename, DERIVATIVE_WIDTHS[0], "jpg")
+    if os.path.exists(os.path.join(DERIVATIVE_FOLDER, smallest)):
+        src = data_url("derivatives/" + smallest)
+    else:
+        src = full
+    return {"src": src, "full": full, "webp": srcsets["webp"], "jpg": srcsets["jpg"]}
 
 # -------------------------
 # Template Filters
 # -------------------------
 @app.template_filter('datetimeformat')
+@lru_cache(maxsize=1024)
 def datetimeformat(value):
     """Convert YYYY-MM-DD string to 'Month Day, Year' format."""
     if not value:
         return ""
     return datetime.strptime(value, "%Y-%m-%d").strftime("%B %d, %Y")
 
+# -------------------------
+# Keyset Pagination
+# -------------------------
+# Pictures, blog posts and site updates are paged on (date, id) instead of
+# being rendered all at once. A cursor holds the last (date, id) seen, so each
+# page is a short index range scan no matter how deep it is.
+PICTURES_PAGE_SIZE = 24
+POSTS_PAGE_SIZE = 10
+
+def init_page_indexes():
+    """Create the (date, id) indexes the paged queries walk."""
+    for path, table, date_col in (
+        (DB_NAME, "pictures", "date_taken"),
+        (BLOG_DB, "posts", "date"),
+        (UPDATES_DB, "posts", "date"),
+    ):
+        conn = get_connection(path)
+        try:
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table}_date_id ON {table} (COALESCE({date_col}, ''), id)"
+            )
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # table not created yet
+        conn.close()
+
+init_page_indexes()
+
+def encode_cursor(date, row_id):
+    return base64.urlsafe_b64encode(json.dumps([date or "", row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(value):
+    """Return (date, id) from a cursor, None for no cursor; raises ValueError if malformed."""
+    if not value:
+        return None
+    try:
+        date, row_id = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except (TypeError, json.JSONDecodeError, binascii.Error) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(date, str) or type(row_id) is not int:
+        raise ValueError("invalid cursor")
+    return date, row_id
+
+def start_cursor(date, row_id):
+    """Cursor for a newest-first page that starts at the given row."""
+    return encode_cursor(date, row_id + 1)
+
+def keyset_page(conn, table, date_col, cursor, limit, order="desc"):
+    """Return (rows, next_cursor) for one page of a table ordered by (date, id)."""
+    key = f"COALESCE({date_col}, '')"
+    direction, op = ("DESC", "<") if order == "desc" else ("ASC", ">")
+    where, params = "", []
+    if cursor:
+        # Written so the index gets a range on its first column
+        where = f"WHERE {key} {op}= ? AND ({key} {op} ? OR id {op} ?)"
+        params = [cursor[0], cursor[0], cursor[1]]
+    rows = conn.execute(
+        f"SELECT * FROM {table} {where} ORDER BY {key} {direction}, id {direction} LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last[date_col], last["id"])
+
+def page_cursor():
+    """The ?cursor= of the current request; a bad one falls back to the first page."""
+    try:
+        return decode_cursor(request.args.get("cursor"))
+    except ValueError:
+        return None
+
+# -------------------------
+# Countries
+# -------------------------
+# Points are tagged with the Natural Earth country they fall in. Each country
+# polygon keeps its edges bucketed into latitude bands, so a ray cast only
+# tests the few edges that cross the point's band, and a coarse grid of
+# polygon bounding boxes picks the candidate polygons.
+COUNTRIES_GEOJSON = os.path.join(BASE_DIR, "static", "layers", "countries.json")
+COUNTRY_GRID_DEGREES = 2.0
+
+def load_country_features(path=COUNTRIES_GEOJSON):
+    """Return [(properties, [polygon, ...])] from the countries GeoJSON, where each
+    polygon is a list of rings and each ring a list of (lon, lat)."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    countries = []
+    for feature in data.get("features", []):
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        rings = [[[(pt[0], pt[1]) for pt in ring] for ring in polygon] for polygon in polygons]
+        countries.append((feature.get("properties") or {}, rings))
+    return countries
+
+def prepare_polygon(rings):
+    """Bucket a polygon's edges (all rings, so holes work with even-odd) into
+    latitude bands. Returns (west, south, east, north, band_height, bands)."""
+    edges = []
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if y1 != y2:  # horizontal edges never cross a horizontal ray
+                edges.append((x1, y1, x2, y2))
+    xs = [x for ring in rings for x, _ in ring]
+    south = min(min(e[1], e[3]) for e in edges)
+    north = max(max(e[1], e[3]) for e in edges)
+
+    count = max(1, int(math.sqrt(len(edges))))
+    height = (north - south) / count or 1.0
+    bands = [[] for _ in range(count)]
+    for edge in edges:
+        low, high = sorted((edge[1], edge[3]))
+        for band in range(int((low - south) / height), min(count - 1, int((high - south) / height)) + 1):
+            bands[band].append(edge)
+    return min(xs), south, max(xs), north, height, bands
+
+def point_in_polygon(lon, lat, polygon):
+    """Even-odd ray cast against the edges in the point's latitude band."""
+    west, south, east, north, height, bands = polygon
+    if not (west <= lon <= east and south <= lat <= north):
+        return False
+    inside = False
+    for x1, y1, x2, y2 in bands[min(len(bands) - 1, int((lat - south) / height))]:
+        if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def build_country_index(countries):
+    """Prepare [(properties, polygons)] for lookups. Returns (polygons, grid)
+    where polygons is [(name, prepared)] and grid maps a cell to polygon indexes."""
+    polygons, grid = [], {}
+    for properties, parts in countries:
+        name = properties.get("ADMIN") or properties.get("NAME")
+        for rings in parts:
+            if not rings or len(rings[0]) < 3:
+                continue
+            prepared = prepare_polygon(rings)
+            west, south, east, north = prepared[:4]
+            for cx in range(int(west // COUNTRY_GRID_DEGREES), int(east // COUNTRY_GRID_DEGREES) + 1):
+                for cy in range(int(south // COUNTRY_GRID_DEGREES), int(north // COUNTRY_GRID_DEGREES) + 1):
+                    grid.setdefault((cx, cy), []).append(len(polygons))
+            polygons.append((name, prepared))
+    return polygons, grid
+
+_country_index = None
+_country_index_lock = threading.Lock()
+_country_file_warned = False
+
+def get_country_index():
+    """Return the country lookup index, built on first use and rebuilt when the
+    countries file changes. None (with a warning, once) when the file is missing."""
+    global _country_index, _country_file_warned
+    try:
+        stat = os.stat(COUNTRIES_GEOJSON)
+    except FileNotFoundError:
+        if not _country_file_warned:
+            _country_file_warned = True
+            print(f"Warning: country boundaries not found at {COUNTRIES_GEOJSON}; points stay untagged")
+        return None
+    key = (stat.st_size, stat.st_mtime_ns)
+    with _country_index_lock:
+        if _country_index is None or _country_index[0] != key:
+            _country_index = (key, build_country_index(load_country_features()))
+        return _country_index[1]
+
+def country_at(index, lon, lat):
+    """Name of the country containing the point, or None."""
+    polygons, grid = index
+    cell = (int(lon // COUNTRY_GRID_DEGREES), int(lat // COUNTRY_GRID_DEGREES))
+    for i in grid.get(cell, ()):
+        name, prepared = polygons[i]
+        if point_in_polygon(lon, lat, prepared):
+            return name
+    return None
+
+def tag_countries(conn, table):
+    """Fill in the country of rows that have none yet. New rows start untagged
+    and a trigger clears the tag when a row moves, so this only touches rows
+    that changed. Points outside every country get ''. Runs inside the
+    caller's transaction; returns the number of rows tagged."""
+    index = get_country_index()
+    if index is None:
+        return 0
+    rows = conn.execute(f"SELECT id, lon, lat FROM {table} WHERE country IS NULL").fetchall()
+    conn.executemany(
+        f"UPDATE {table} SET country = ? WHERE id = ?",
+        [(country_at(index, row["lon"], row["lat"]) or "", row["id"]) for row in rows]
+    )
+    return len(rows)
+
+@app.cli.command("tag-countries")
+@click.option("--retag", is_flag=True, help="Recompute every tag, not just the missing ones.")
+def tag_countries_command(retag):
+    """Tag cities, mountains and food spots with the country they are in."""
+    if get_country_index() is None:
+        raise click.ClickException(f"{COUNTRIES_GEOJSON} not found")
+    for conn, table in ((get_features_connection(), "features"), (get_FOOD_connection(), "food_locations")):
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        if retag:
+            conn.execute(f"UPDATE {table} SET country = NULL")
+        count = tag_countries(conn, table)
+        conn.commit()
+        conn.close()
+        click.echo(f"Tagged {count} rows in {table} in {time.perf_counter() - start:.2f}s")
+    for layer in FEATURE_LAYERS:
+        export_layer(layer)
+
+def country_columns_sql(table):
+    """Schema for a table's country tag: an index over untagged rows and the
+    trigger that clears the tag when the point moves."""
+    return f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_untagged ON {table} (id) WHERE country IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_{table}_country ON {table} (country);
+        CREATE TRIGGER IF NOT EXISTS {table}_country_reset AFTER UPDATE OF lon, lat ON {table}
+        WHEN old.lon IS NOT new.lon OR old.lat IS NOT new.lat BEGIN
+            UPDATE {table} SET country = NULL WHERE id = new.id;
+        END;
+    """
+
+# -------------------------
+# Feature Store
+# -------------------------
+# Cities and mountains live in features.db, one row per feature, so an admin
+# edit touches only the rows it changes. Writers take SQLite's write lock
+# (BEGIN IMMEDIATE), which also serializes gunicorn workers. Triggers keep an
+# R-tree and a per-layer version counter in step; the .geojson files the
+# frontends fetch are snapshots, rewritten atomically by every write path
+# once the version has moved past the last exported one.
+FEATURE_LAYERS = {"cities": CITIES_GEOJSON, "mountains": MOUNTAINS_GEOJSON}
+
+def import_layer(conn, layer, path):
+    """Replace a layer's rows with the point features of a GeoJSON file.
+    Runs inside the caller's transaction."""
+    conn.execute("DELETE FROM features WHERE layer = ?", (layer,))
+    for feature in load_geojson(path).get("features", []):
+        try:
+            lon, lat = (float(v) for v in feature["geometry"]["coordinates"][:2])
+        except (KeyError, TypeError, ValueError):
+            continue
+        save_feature(conn, layer, lon, lat, feature.get("properties") or {})
+    tag_countries(conn, "features")
+
+def init_features_db():
+    """Create the feature store and import the existing GeoJSON files once."""
+    conn = get_features_connection()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS features (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            layer TEXT NOT NULL,
+            lon REAL NOT NULL,
+            lat REAL NOT NULL,
+            properties TEXT NOT NULL DEFAULT '{}',
+            country TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_features_layer ON features (layer, id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS features_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+        CREATE TABLE IF NOT EXISTS layer_versions (
+            layer TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            exported_version INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TRIGGER IF NOT EXISTS features_insert AFTER INSERT ON features BEGIN
+            INSERT INTO features_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+            UPDATE layer_versions SET version = version + 1 WHERE layer = new.layer;
+        END;
+        CREATE TRIGGER IF NOT EXISTS features_update AFTER UPDATE ON features BEGIN
+            INSERT OR REPLACE INTO features_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+            UPDATE layer_versions SET version = version + 1 WHERE layer IN (old.layer, new.layer);
+        END;
+        CREATE TRIGGER IF NOT EXISTS features_delete AFTER DELETE ON features BEGIN
+            DELETE FROM features_rtree WHERE id = old.id;
+            UPDATE layer_versions SET version = version + 1 WHERE layer = old.layer;
+        END;
+    """)
+
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(features)")]
+    if "country" not in columns:
+        conn.execute("ALTER TABLE features ADD COLUMN country TEXT")
+    conn.executescript(country_columns_sql("features"))
+
+    for layer, path in FEATURE_LAYERS.items():
+        conn.execute("BEGIN IMMEDIATE")
+        exists = conn.execute("SELECT 1 FROM layer_versions WHERE layer = ?", (layer,)).fetchone()
+        if not exists:
+            conn.execute("INSERT INTO layer_versions (layer) VALUES (?)", (layer,))
+            import_layer(conn, layer, path)
+        conn.commit()
+    conn.close()
+
+def save_feature(conn, layer, lon, lat, properties, feature_id=None):
+    """Insert a feature (feature_id None) or update one in place. Returns its id."""
+    if feature_id is None:
+        cur = conn.execute(
+            "INSERT INTO features (layer, lon, lat, properties) VALUES (?, ?, ?, ?)",
+            (layer, lon, lat, json.dumps(properties))
+        )
+        return cur.lastrowid
+    conn.execute(
+        "UPDATE features SET lon = ?, lat = ?, properties = ? WHERE id = ? AND layer = ?",
+        (lon, lat, json.dumps(properties), feature_id, layer)
+    )
+    return feature_id
+
+def delete_feature(conn, layer, feature_id):
+    conn.execute("DELETE FROM features WHERE id = ? AND layer = ?", (feature_id, layer))
+
+def query_features_locked(conn, layer):
+    """Read a layer on a connection that already holds the write lock."""
+    rows = conn.execute("SELECT * FROM features WHERE layer = ? ORDER BY id", (layer,)).fetchall()
+    return [feature_row_dict(row) for row in rows]
+
+def feature_row_dict(row):
+    """A features row as a GeoJSON Feature."""
+    return {
+        "type": "Feature",
+        "id": row["id"],
+        "geometry": {"type": "Point", "coordinates": [row["lon"], row["lat"]]},
+        "properties": json.loads(row["properties"]),
+    }
+
+def layer_version(layer):
+    """Return the change counter of a layer."""
+    conn = get_features_connection()
+    row = conn.execute("SELECT version FROM layer_versions WHERE layer = ?", (layer,)).fetchone()
+    conn.close()
+    return row["version"] if row else None
+
+def export_layer(layer):
+    """Rewrite a layer's .geojson snapshot if the store has changed since the
+    last export. The file is written to a temp file and renamed into place, so
+    readers never see a partial file."""
+    conn = get_features_connection()
+    row = conn.execute("SELECT version, exported_version FROM layer_versions WHERE layer = ?", (layer,)).fetchone()
+    if row is None or row["version"] == row["exported_version"]:
+        conn.close()
+        return False
+
+    # Holding the write lock keeps a slower export from replacing a newer one
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT version, exported_version FROM layer_versions WHERE layer = ?", (layer,)).fetchone()
+        if row["version"] == row["exported_version"]:
+            return False
+        rows = conn.execute("SELECT * FROM features WHERE layer = ? ORDER BY id", (layer,)).fetchall()
+        data = {"type": "FeatureCollection", "features": [feature_row_dict(r) for r in rows]}
+
+        path = FEATURE_LAYERS[layer]
+        fd, tmp_path = tempfile.mkstemp(prefix=".export-", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        conn.execute("UPDATE layer_versions SET exported_version = ? WHERE layer = ?", (row["version"], layer))
+        conn.commit()
+    finally:
+        conn.close()
+    refresh_data_version(FEATURE_LAYERS[layer])
+    queue_precompress(FEATURE_LAYERS[layer])
+    return True
+
+init_features_db()
+
+# -------------------------
+# Spatial Index
+# -------------------------
+# Food locations and the feature store are indexed with SQLite's R-tree
+# module, kept in sync by triggers.
+def init_food_db():
+    """Create the food_locations R-tree and its sync triggers if missing."""
+    conn = get_FOOD_connection()
+    tables = [row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if "food_locations" not in tables:
+        conn.close()
+        return
+
+    if "food_rtree" not in tables:
+        conn.executescript("""
+            CREATE VIRTUAL TABLE food_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+            INSERT INTO food_rtree SELECT id, lon, lon, lat, lat FROM food_locations;
+        """)
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS food_rtree_insert AFTER INSERT ON food_locations BEGIN
+            INSERT INTO food_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+        END;
+        CREATE TRIGGER IF NOT EXISTS food_rtree_update AFTER UPDATE OF lat, lon ON food_locations BEGIN
+            INSERT OR REPLACE INTO food_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+        END;
+        CREATE TRIGGER IF NOT EXISTS food_rtree_delete AFTER DELETE ON food_locations BEGIN
+            DELETE FROM food_rtree WHERE id = old.id;
+        END;
+
+        CREATE TABLE IF NOT EXISTS data_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+        INSERT OR IGNORE INTO data_versions VALUES ('food_locations', 0);
+        CREATE TRIGGER IF NOT EXISTS food_version_insert AFTER INSERT ON food_locations BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = 'food_locations';
+        END;
+        CREATE TRIGGER IF NOT EXISTS food_version_update AFTER UPDATE ON food_locations BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = 'food_locations';
+        END;
+        CREATE TRIGGER IF NOT EXISTS food_version_delete AFTER DELETE ON food_locations BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = 'food_locations';
+        END;
+    """)
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(food_locations)")]
+    if "country" not in columns:
+        conn.execute("ALTER TABLE food_locations ADD COLUMN country TEXT")
+    conn.executescript(country_columns_sql("food_locations"))
+    conn.commit()
+    conn.close()
+
+init_food_db()
+
+def parse_bbox(value):
+    """Parse "west,south,east,north" into a list of boxes that do not cross the
+    antimeridian. Returns None when no bbox was given; raises ValueError if invalid."""
+    if not value:
+        return None
+    west, south, east, north = (float(v) for v in value.split(","))
+    if south > north:
+        raise ValueError("south must not be greater than north")
+    if east - west >= 360:
+        return [(-180.0, south, 180.0, north)]
+
+    # Map views report longitudes beyond ±180 when panned across world copies
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return [(west, south, east, north)]
+    return [(west, south, 180.0, north), (-180.0, south, east, north)]
+
+def point_in_boxes(lon, lat, boxes):
+    """True if the point falls inside any of the boxes."""
+    return any(w <= lon <= e and s <= lat <= n for w, s, e, n in boxes)
+
+def query_features(layer, boxes):
+    """Return the GeoJSON features of a layer, limited to the boxes when given."""
+    return [feature_row_dict(row) for row in query_feature_rows(layer, boxes)]
+
+def query_feature_rows(layer, boxes):
+    """Return the features rows of a layer, limited to the boxes when given."""
+    conn = get_features_connection()
+    if boxes is None:
+        rows = conn.execute("SELECT * FROM features WHERE layer = ? ORDER BY id", (layer,)).fetchall()
+    else:
+        rows = []
+        for west, south, east, north in boxes:
+            rows += conn.execute(
+                """
+                SELECT f.* FROM features f
+                JOIN features_rtree r ON r.id = f.id
+                WHERE f.layer = ?
+                  AND r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+                ORDER BY f.id
+                """,
+                (layer, west, east, south, north)
+            ).fetchall()
+    conn.close()
+    # The R-tree stores 32-bit floats, so trim to the exact box
+    return [row for row in rows if boxes is None or point_in_boxes(row["lon"], row["lat"], boxes)]
+
+def query_food(boxes):
+    """Return food_locations rows, limited to the boxes when given
+    (none while the table has not been created yet)."""
+    conn = get_FOOD_connection()
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'food_locations'").fetchone():
+        conn.close()
+        return []
+    if boxes is None:
+        rows = conn.execute("SELECT * FROM food_locations").fetchall()
+    else:
+        rows = []
+        for west, south, east, north in boxes:
+            rows += conn.execute(
+                """
+                SELECT f.* FROM food_locations f
+                JOIN food_rtree r ON r.id = f.id
+                WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+                """,
+                (west, east, south, north)
+            ).fetchall()
+        # The R-tree stores 32-bit floats, so trim to the exact box
+        rows = [row for row in rows if point_in_boxes(row["lon"], row["lat"], boxes)]
+    conn.close()
+    return rows
+
+# -------------------------
+# Columnar Payloads
+# -------------------------
+# /api/food and /api/features/<layer> can answer with a columnar layout instead
+# of one object per point: ids and coordinates as parallel id/lon/lat arrays,
+# each property as one array, and repetitive strings (cuisine) dictionary-encoded
+# as distinct values plus integer codes. Property keys are sent once rather than
+# per point, and the arrays are transposed straight from the query rows without
+# a dict per row. Clients ask for it with ?format=columnar or an Accept header
+# naming COLUMNAR_MIMETYPE.
+COLUMNAR_MIMETYPE = "application/vnd.geojourney.columnar+json"
+FOOD_COLUMNS = ("name", "cuisine", "rating", "desc", "link")
+FOOD_DICTIONARY_COLUMNS = ("cuisine",)
+
+def wants_columnar():
+    """True if the request asked for the columnar layout."""
+    if request.args.get("format") == "columnar":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE
+
+def transpose_rows(rows, names):
+    """Return {name: tuple of values} for the named columns of sqlite3.Row results."""
+    if not rows:
+        return {name: () for name in names}
+    columns = dict(zip(rows[0].keys(), zip(*rows)))
+    return {name: columns[name] for name in names}
+
+def dictionary_encode(values):
+    """Return {"values": distinct values in first-seen order, "codes": [index, ...]}."""
+    index = {}
+    codes = [index.setdefault(value, len(index)) for value in values]
+    return {"values": list(index), "codes": codes}
+
+def columnar_response(ids, lons, lats, properties, dictionary=()):
+    """Build the columnar response. properties maps names to value arrays; the
+    names in dictionary are dictionary-encoded."""
+    response = jsonify({
+        "format": "columnar",
+        "count": len(ids),
+        "id": ids,
+        "lon": lons,
+        "lat": lats,
+        "properties": {
+            name: dictionary_encode(values) if name in dictionary else values
+            for name, values in properties.items()
+        },
+    })
+    response.mimetype = COLUMNAR_MIMETYPE
+    return response
+
+def food_columnar(rows):
+    """food_locations rows in the columnar layout."""
+    columns = transpose_rows(rows, ("id", "lon", "lat") + FOOD_COLUMNS)
+    return columnar_response(
+        columns["id"], columns["lon"], columns["lat"],
+        {name: columns[name] for name in FOOD_COLUMNS},
+        FOOD_DICTIONARY_COLUMNS
+    )
+
+def features_columnar(rows):
+    """Feature store rows in the columnar layout. Every property key becomes a
+    column, with None where a feature lacks it."""
+    columns = transpose_rows(rows, ("id", "lon", "lat", "properties"))
+    properties = [json.loads(text) for text in columns["properties"]]
+    keys = dict.fromkeys(key for props in properties for key in props)
+    return columnar_response(
+        columns["id"], columns["lon"], columns["lat"],
+        {key: [props.get(key) for props in properties] for key in keys}
+    )
+
+# -------------------------
+# Point Clustering
+# -------------------------
+# Supercluster-style hierarchical clustering: points are projected to Web
+# Mercator and greedily merged level by level from CLUSTER_MAX_ZOOM down to
+# zoom 0. Every level is kept with a grid index so a bbox + zoom query only
+# touches nearby nodes. Levels are rebuilt when the underlying data changes.
+CLUSTER_RADIUS = 60      # cluster radius in pixels
+CLUSTER_EXTENT = 512     # tile size the radius is measured against
+CLUSTER_MAX_ZOOM = 14    # above this zoom every point is returned individually
+
+def lon_to_x(lon):
+    return lon / 360 + 0.5
+
+def lat_to_y(lat):
+    sin = math.sin(math.radians(max(min(lat, 85.05112878), -85.05112878)))
+    return 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+
+def x_to_lon(x):
+    return (x - 0.5) * 360
+
+def y_to_lat(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+def _grid_index(nodes, cell):
+    """Bucket nodes by grid cell for neighbour and bbox lookups."""
+    grid = {}
+    for i, node in enumerate(nodes):
+        grid.setdefault((int(node[0] // cell), int(node[1] // cell)), []).append(i)
+    return grid
+
+def build_clusters(points):
+    """Build the cluster hierarchy for [(lon, lat, properties)].
+    Nodes are [x, y, count, cluster_id, properties, expansion_zoom]; leaves
+    have cluster_id None. Returns {zoom: (nodes, grid, cell)}."""
+    nodes = [[lon_to_x(lon), lat_to_y(lat), 1, None, props, None] for lon, lat, props in points]
+    levels = {}
+    next_id = 0
+
+    for zoom in range(CLUSTER_MAX_ZOOM, -1, -1):
+        radius = CLUSTER_RADIUS / (CLUSTER_EXTENT * 2 ** zoom)
+        grid = _grid_index(nodes, radius)
+        visited = [False] * len(nodes)
+        clustered = []
+
+        for i, node in enumerate(nodes):
+            if visited[i]:
+                continue
+            visited[i] = True
+            cx, cy = int(node[0] // radius), int(node[1] // radius)
+            neighbours = [
+                j
+                for gx in (cx - 1, cx, cx + 1)
+                for gy in (cy - 1, cy, cy + 1)
+                for j in grid.get((gx, gy), ())
+                if not visited[j]
+                and (nodes[j][0] - node[0]) ** 2 + (nodes[j][1] - node[1]) ** 2 <= radius ** 2
+            ]
+            if not neighbours:
+                clustered.append(node)
+                continue
+
+            count = node[2]
+            wx, wy = node[0] * node[2], node[1] * node[2]
+            for j in neighbours:
+                visited[j] = True
+                other = nodes[j]
+                count += other[2]
+                wx += other[0] * other[2]
+                wy += other[1] * other[2]
+            clustered.append([wx / count, wy / count, count, next_id, None, zoom + 1])
+            next_id += 1
+
+        # nodes (one zoom finer) are what is shown at zoom + 1
+        levels[zoom + 1] = (nodes, _grid_index(nodes, radius / 2), radius / 2)
+        nodes = clustered
+
+    levels[0] = (nodes, _grid_index(nodes, CLUSTER_RADIUS / CLUSTER_EXTENT), CLUSTER_RADIUS / CLUSTER_EXTENT)
+    return levels
+
+def query_clusters(levels, boxes, zoom):
+    """Return GeoJSON features (clusters and single points) for a bbox at a zoom."""
+    nodes, grid, cell = levels[max(0, min(zoom, CLUSTER_MAX_ZOOM + 1))]
+    boxes = boxes or [(-180.0, -85.05112878, 180.0, 85.05112878)]
+
+    features = []
+    for west, south, east, north in boxes:
+        x0, x1 = lon_to_x(west), lon_to_x(east)
+        y0, y1 = lat_to_y(north), lat_to_y(south)
+        cx0, cx1, cy0, cy1 = int(x0 // cell), int(x1 // cell), int(y0 // cell), int(y1 // cell)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(grid):
+            cells = [c for c in grid if cx0 <= c[0] <= cx1 and cy0 <= c[1] <= cy1]
+        else:
+            cells = [(x, y) for x in range(cx0, cx1 + 1) for y in range(cy0, cy1 + 1) if (x, y) in grid]
+
+        for c in cells:
+            for i in grid[c]:
+                x, y, count, cluster_id, props, expansion_zoom = nodes[i]
+                if not (x0 <= x <= x1 and y0 <= y <= y1):
+                    continue
+                if cluster_id is None:
+                    lon, lat = props["coords"]
+                    leaf = {key: value for key, value in props.items() if key != "coords"}
+                    features.append({
+                        "type": "Feature",
+                        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                        "properties": leaf,
+                    })
+                else:
+                    features.append({
+                        "type": "Feature",
+                        "geometry": {"type": "Point", "coordinates": [x_to_lon(x), y_to_lat(y)]},
+                        "properties": {
+                            "cluster": True,
+                            "cluster_id": cluster_id,
+                            "point_count": count,
+                            "expansion_zoom": expansion_zoom,
+                        },
+                    })
+    return features
+
+def food_version():
+    """Return the food_locations change counter maintained by triggers."""
+    return source_version("food")
+
+def food_row_dict(row):
+    """The public JSON shape of a food_locations row."""
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "cuisine": row["cuisine"],
+        "rating": row["rating"],
+        "coords": [row["lon"], row["lat"]],
+        "desc": row["desc"],
+        "link": row["link"]
+    }
+
+_cluster_cache = {}
+_cluster_lock = threading.Lock()
+
+def get_cluster_levels(layer):
+    """Return the cluster hierarchy for food, cities or mountains, rebuilding on change.
+    Threads asking for a stale layer wait for one rebuild instead of each running it."""
+    version = food_version() if layer == "food" else layer_version(layer)
+
+    with _cluster_lock:
+        cached = _cluster_cache.get(layer)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        if layer == "food":
+            points = [(row["lon"], row["lat"], food_row_dict(row)) for row in query_food(None)]
+        else:
+            points = []
+            for feature in query_features(layer, None):
+                lon, lat = feature["geometry"]["coordinates"][:2]
+                points.append((lon, lat, dict(feature.get("properties") or {}, coords=[lon, lat])))
+
+        levels = build_clusters(points)
+        _cluster_cache[layer] = (version, levels)
+    return levels
+
+# -------------------------
+# Country Vector Tiles
+# -------------------------
+# The Natural Earth country boundaries are pre-cut into Mapbox Vector Tiles,
+# simplified for each zoom level and stored in an MBTiles file. Build them with
+#   flask --app app build-country-tiles
+TILES_FOLDER = os.path.join(PERSISTENT_DIR, "tiles")
+COUNTRY_TILES = os.path.join(TILES_FOLDER, "countries.mbtiles")
+COUNTRY_TILES_MAX_ZOOM = 6
+COUNTRY_TILE_PROPERTIES = ("ADMIN", "NAME", "ISO_A3")
+TILE_EXTENT = 4096
+TILE_BUFFER = 64         # tile units drawn past the edge so strokes join up
+TILE_TOLERANCE = 4       # simplification tolerance in tile units
+
+def ring_importance(ring):
+    """Project a ring to Web Mercator [0, 1] and rank every vertex by the squared
+    distance at which Douglas-Peucker would keep it. Filtering by importance
+    then gives the simplification for any zoom without re-running it."""
+    points = [[lon_to_x(lon), lat_to_y(lat), 0.0] for lon, lat in ring]
+    if len(points) < 3:
+        return points
+    points[0][2] = points[-1][2] = math.inf
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = points[first][0], points[first][1]
+        bx, by = points[last][0], points[last][1]
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        max_dist, index = 0.0, None
+        for i in range(first + 1, last):
+            px, py = points[i][0], points[i][1]
+            if length:
+                t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+                ex, ey = px - (ax + t * dx), py - (ay + t * dy)
+            else:
+                ex, ey = px - ax, py - ay
+            dist = ex * ex + ey * ey
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > 0:
+            points[index][2] = max_dist
+            stack.append((first, index))
+            stack.append((index, last))
+    return points
+
+def clip_ring(ring, min_x, min_y, max_x, max_y):
+    """Sutherland-Hodgman clip of a ring against a rectangle."""
+    def clip(points, inside, intersect):
+        output = []
+        for i, current in enumerate(points):
+            previous = points[i - 1]
+            if inside(current):
+                if not inside(previous):
+                    output.append(intersect(previous, current))
+                output.append(current)
+            elif inside(previous):
+                output.append(intersect(previous, current))
+        return output
+
+    def at_x(x):
+        return lambda p, q: (x, p[1] + (q[1] - p[1]) * (x - p[0]) / (q[0] - p[0]))
+
+    def at_y(y):
+        return lambda p, q: (p[0] + (q[0] - p[0]) * (y - p[1]) / (q[1] - p[1]), y)
+
+    for inside, intersect in (
+        (lambda p: p[0] >= min_x, at_x(min_x)),
+        (lambda p: p[0] <= max_x, at_x(max_x)),
+        (lambda p: p[1] >= min_y, at_y(min_y)),
+        (lambda p: p[1] <= max_y, at_y(max_y)),
+    ):
+        ring = clip(ring, inside, intersect)
+        if not ring:
+            break
+    return ring
+
+def ring_area(ring):
+    """Signed area (surveyor's formula) in tile coordinates."""
+    return sum(ring[i - 1][0] * ring[i][1] - ring[i][0] * ring[i - 1][1] for i in range(len(ring))) / 2
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _pb_key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _pb_bytes(field, data):
+    return _pb_key(field, 2) + _varint(len(data)) + data
+
+def _pb_uint(field, value):
+    return _pb_key(field, 0) + _varint(value)
+
+def _pb_packed(field, values):
+    return _pb_bytes(field, b"".join(_varint(v) for v in values))
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def _mvt_value(value):
+    """Encode a property value as a vector tile Value message."""
+    if isinstance(value, bool):
+        return _pb_uint(7, int(value))
+    if isinstance(value, int):
+        return _pb_key(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _pb_key(3, 1) + struct.pack("<d", value)
+    return _pb_bytes(1, str(value).encode("utf-8"))
+
+def encode_mvt_layer(name, features):
+    """Encode one vector tile layer. features: [(id, properties, rings)] where
+    rings are already in tile coordinates with the correct winding."""
+    keys, values = [], []
+    key_index, value_index = {}, {}
+    encoded = []
+    for feature_id, properties, rings in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags += [key_index[key], value_index[value_key]]
+
+        commands = []
+        cx = cy = 0
+        for ring in rings:
+            x, y = ring[0]
+            commands += [(1 & 7) | (1 << 3), _zigzag(x - cx), _zigzag(y - cy)]
+            cx, cy = x, y
+            commands.append((2 & 7) | ((len(ring) - 1) << 3))
+            for x, y in ring[1:]:
+                commands += [_zigzag(x - cx), _zigzag(y - cy)]
+                cx, cy = x, y
+            commands.append((7 & 7) | (1 << 3))
+
+        encoded.append(
+            _pb_uint(1, feature_id) + _pb_packed(2, tags) + _pb_uint(3, 3) + _pb_packed(4, commands)
+        )
+
+    layer = _pb_uint(15, 2) + _pb_bytes(1, name.encode("utf-8"))
+    layer += b"".join(_pb_bytes(2, feature) for feature in encoded)
+    layer += b"".join(_pb_bytes(3, key.encode("utf-8")) for key in keys)
+    layer += b"".join(_pb_bytes(4, _mvt_value(value)) for value in values)
+    layer += _pb_uint(5, TILE_EXTENT)
+    return _pb_bytes(3, layer)
+
+def build_country_tiles(source=COUNTRIES_GEOJSON, target=COUNTRY_TILES, max_zoom=COUNTRY_TILES_MAX_ZOOM):
+    """Cut the countries layer into gzipped vector tiles in an MBTiles file.
+    Returns the number of tiles written."""
+    countries = []
+    for properties, polygons in load_country_features(source):
+        kept = {key: properties[key] for key in COUNTRY_TILE_PROPERTIES if properties.get(key) is not None}
+        countries.append((kept, [[ring_importance(ring) for ring in polygon] for polygon in polygons]))
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = target + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    out = sqlite3.connect(tmp_path)
+    out.executescript("""
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+        CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+    """)
+
+    written = 0
+    for zoom in range(max_zoom + 1):
+        scale = TILE_EXTENT * 2 ** zoom
+        min_importance = (TILE_TOLERANCE / scale) ** 2
+        tiles = {}
+
+        for feature_id, (properties, polygons) in enumerate(countries, start=1):
+            for polygon in polygons:
+                # Simplify for this zoom and move to world tile units
+                rings = []
+                for ring in polygon:
+                    points = [(p[0] * scale, p[1] * scale) for p in ring if p[2] > min_importance]
+                    if len(points) >= 4 and abs(ring_area(points)) >= 1:
+                        rings.append(points)
+                if not rings:
+                    continue
+
+                xs = [p[0] for p in rings[0]]
+                ys = [p[1] for p in rings[0]]
+                for tx in range(max(0, int((min(xs) - TILE_BUFFER) // TILE_EXTENT)),
+                                min(2 ** zoom - 1, int((max(xs) + TILE_BUFFER) // TILE_EXTENT)) + 1):
+                    for ty in range(max(0, int((min(ys) - TILE_BUFFER) // TILE_EXTENT)),
+                                    min(2 ** zoom - 1, int((max(ys) + TILE_BUFFER) // TILE_EXTENT)) + 1):
+                        ox, oy = tx * TILE_EXTENT, ty * TILE_EXTENT
+                        tile_rings = []
+                        for i, ring in enumerate(rings):
+                            clipped = clip_ring(
+                                [(x - ox, y - oy) for x, y in ring],
+                                -TILE_BUFFER, -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+                            )
+                            local = []
+                            for x, y in clipped:
+                                point = (round(x), round(y))
+                                if not local or local[-1] != point:
+                                    local.append(point)
+                            if len(local) > 1 and local[0] == local[-1]:
+                                local.pop()
+                            area = ring_area(local) if len(local) >= 3 else 0
+                            if not area:
+                                if i == 0:
+                                    break  # exterior vanished; holes are meaningless
+                                continue
+                            # Exterior rings need positive area in tile coordinates, holes negative
+                            if (i == 0) != (area > 0):
+                                local.reverse()
+                            tile_rings.append(local)
+                        if tile_rings:
+                            parts = tiles.setdefault((tx, ty), {})
+                            parts.setdefault(feature_id, (properties, []))[1].extend(tile_rings)
+
+        for (tx, ty), parts in tiles.items():
+            data = encode_mvt_layer(
+                "countries", [(fid, props, rings) for fid, (props, rings) in parts.items()]
+            )
+            out.execute(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                (zoom, tx, 2 ** zoom - 1 - ty, gzip.compress(data))
+            )
+            written += 1
+
+    vector_layers = {"vector_layers": [{"id": "countries", "fields": {key: "String" for key in COUNTRY_TILE_PROPERTIES}}]}
+    out.executemany("INSERT INTO metadata VALUES (?, ?)", [
+        ("name", "countries"), ("format", "pbf"), ("minzoom", "0"), ("maxzoom", str(max_zoom)),
+        ("json", json.dumps(vector_layers)),
+    ])
+    out.commit()
+    out.close()
+    os.replace(tmp_path, target)
+    return written
+
+@app.cli.command("build-country-tiles")
+@click.option("--max-zoom", default=COUNTRY_TILES_MAX_ZOOM, show_default=True)
+def build_country_tiles_command(max_zoom):
+    """Pre-render the countries layer into vector tiles."""
+    if not os.path.exists(COUNTRIES_GEOJSON):
+        raise click.ClickException(f"{COUNTRIES_GEOJSON} not found")
+    start = time.perf_counter()
+    count = build_country_tiles(max_zoom=max_zoom)
+    click.echo(f"Wrote {count} tiles to {COUNTRY_TILES} in {time.perf_counter() - start:.1f}s")
+
+# -------------------------
+# Full-Text Search
+# -------------------------
+# Each searchable table gets an FTS5 index (search_index) in its own database,
+# using the table as external content so the text is not stored twice.
+# Triggers keep the index in step with every write path.
+SEARCH_SOURCES = {
+    "blog": {"db": BLOG_DB, "table": "posts", "columns": ("title", "description", "location"),
+             "endpoint": "blog", "anchor": "post-{}", "date": "date"},
+    "update": {"db": UPDATES_DB, "table": "posts", "columns": ("title", "description", "location"),
+               "endpoint": "site_updates", "anchor": "update-{}", "date": "date"},
+    "picture": {"db": DB_NAME, "table": "pictures", "columns": ("title", "description", "album"),
+                "endpoint": "pictures", "anchor": "picture-{}", "date": "date_taken"},
+    "food": {"db": FOOD_DB, "table": "food_locations", "columns": ("name", "cuisine", "desc"),
+             "endpoint": "food_map", "anchor": None, "date": None},
+}
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 50
+SEARCH_MAX_TERMS = 8
+# Control characters mark matches so the text can be escaped before adding <mark>
+MARK_START, MARK_END = "\x02", "\x03"
+
+def init_search_index():
+    """Create the FTS5 index and its triggers for each searchable table."""
+    for kind, source in SEARCH_SOURCES.items():
+        conn = get_connection(source["db"])
+        try:
+            tables = [row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            if source["table"] not in tables:
+                continue
+            table = source["table"]
+            cols = ", ".join(f'"{col}"' for col in source["columns"])
+            new_cols = ", ".join(f'new."{col}"' for col in source["columns"])
+            old_cols = ", ".join(f'old."{col}"' for col in source["columns"])
+            conn.executescript(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                    {cols}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS search_index_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO search_index (rowid, {cols}) VALUES (new.id, {new_cols});
+                END;
+                CREATE TRIGGER IF NOT EXISTS search_index_delete AFTER DELETE ON {table} BEGIN
+                    INSERT INTO search_index (search_index, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                END;
+                CREATE TRIGGER IF NOT EXISTS search_index_update AFTER UPDATE OF {cols} ON {table} BEGIN
+                    INSERT INTO search_index (search_index, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    INSERT INTO search_index (rowid, {cols}) VALUES (new.id, {new_cols});
+                END;
+            """)
+            if "search_index" not in tables:
+                conn.execute("INSERT INTO search_index (search_index) VALUES ('rebuild')")
+                conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Warning: search index unavailable for {kind}: {e}")
+        finally:
+            conn.close()
+
+init_search_index()
+
+def fts_query(text):
+    """Turn free text into an FTS5 query where every word must match as a prefix."""
+    words = re.findall(r"\w+", text)[:SEARCH_MAX_TERMS]
+    return " ".join(f'"{word}"*' for word in words)
+
+def marked_html(text):
+    """Escape indexed text and turn the match markers into <mark> tags."""
+    return html.escape(text or "").replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+@app.route("/api/search")
+def search():
+    """Ranked full-text search over blog posts, site updates, pictures and food.
+    ?q=text, optional ?type=blog,update,picture,food, ?page= and ?per_page="""
+    text = request.args.get("q", "").strip()
+    kinds = [kind for kind in request.args.get("type", "").split(",") if kind] or list(SEARCH_SOURCES)
+    if any(kind not in SEARCH_SOURCES for kind in kinds):
+        return jsonify({"error": f"type must be one of {', '.join(SEARCH_SOURCES)}"}), 400
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+        per_page = min(SEARCH_MAX_PER_PAGE, max(1, int(request.args.get("per_page", SEARCH_PER_PAGE))))
+    except ValueError:
+        return jsonify({"error": "page and per_page must be integers"}), 400
+
+    query = fts_query(text)
+    results, total = [], 0
+    if query:
+        for kind in kinds:
+            source = SEARCH_SOURCES[kind]
+            conn = get_connection(source["db"])
+            try:
+                total += conn.execute(
+                    "SELECT count(*) FROM search_index WHERE search_index MATCH ?", (query,)
+                ).fetchone()[0]
+                # Each source only needs enough rows to fill the requested page after merging
+                date_col = f't."{source["date"]}"' if source["date"] else "NULL"
+                rows = conn.execute(
+                    f"""
+                    SELECT search_index.rowid AS id, {date_col} AS date,
+                           bm25(search_index, 10.0{', 1.0' * (len(source["columns"]) - 1)}) AS score,
+                           highlight(search_index, 0, ?, ?) AS title,
+                           snippet(search_index, -1, ?, ?, '…', 16) AS snippet
+                    FROM search_index
+                    JOIN {source["table"]} t ON t.id = search_index.rowid
+                    WHERE search_index MATCH ?
+                    ORDER BY score
+                    LIMIT ?
+                    """,
+                    (MARK_START, MARK_END, MARK_START, MARK_END, query, page * per_page)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                rows = []  # index not built (table missing or no FTS5)
+            conn.close()
+
+            for row in rows:
+                if source["anchor"]:
+                    # Link to the page of the listing that starts at this row
+                    url = url_for(
+                        source["endpoint"],
+                        cursor=start_cursor(row["date"], row["id"]),
+                        _anchor=source["anchor"].format(row["id"])
+                    )
+                else:
+                    url = url_for(source["endpoint"])
+                results.append({
+                    "type": kind,
+                    "id": row["id"],
+                    "title": marked_html(row["title"]),
+                    "snippet": marked_html(row["snippet"]),
+                    "url": url,
+                    "score": round(-row["score"], 4),
+                })
+
+    # bm25 scores are negative (lower is better); they are flipped above
+    results.sort(key=lambda result: result["score"], reverse=True)
+    return jsonify({
+        "query": text,
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "pages": math.ceil(total / per_page),
+        "results": results[(page - 1) * per_page:page * per_page],
+    })
+
+# -------------------------
+# Geocoding
+# -------------------------
+# /api/geocode answers place searches from a local gazetteer built from a
+# GeoNames dump (flask --app app build-gazetteer cities15000.txt). Names are
+# indexed by normalized prefix, with an FTS5 trigram index for substrings.
+# Queries the gazetteer can't answer (street addresses, say) go to Nominatim
+# once and are kept in a SQLite cache until they expire. Only the admin pages
+# (/admin/api/geocode) fall back to Nominatim, unless GEOCODE_PUBLIC_UPSTREAM=on;
+# the one request per second limit is kept in the cache database so every
+# worker shares it, and a lookup over the limit gets a 429 instead of waiting.
+# Set GEOCODE_UPSTREAM=off to stay fully offline.
+GEOCODE_FOLDER = os.path.join(PERSISTENT_DIR, "geocode")
+GAZETTEER_DB = os.path.join(GEOCODE_FOLDER, "gazetteer.db")
+GEOCODE_CACHE_DB = os.path.join(GEOCODE_FOLDER, "cache.db")
+GEOCODE_UPSTREAM = os.getenv("GEOCODE_UPSTREAM", "https://nominatim.openstreetmap.org/search")
+GEOCODE_USER_AGENT = "asheppard-geojourney geocoder"
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60
+GEOCODE_EMPTY_TTL = 24 * 60 * 60    # "not found" answers are retried sooner
+GEOCODE_UPSTREAM_INTERVAL = 1.0     # Nominatim allows one request per second
+GEOCODE_PUBLIC_UPSTREAM = os.getenv("GEOCODE_PUBLIC_UPSTREAM", "off").lower() == "on"
+GEOCODE_MAX_LIMIT = 20
+GAZETTEER_MAX_ALTERNATES = 50
+os.makedirs(GEOCODE_FOLDER, exist_ok=True)
+
+def normalize_place_name(text):
+    """Lowercase, strip accents and collapse punctuation: "São Paulo" -> "sao paulo"."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def read_tsv(path):
+    """Yield the tab-separated fields of a GeoNames file, skipping comments."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            yield line.rstrip("\n").split("\t")
+
+def build_gazetteer(source, target=GAZETTEER_DB, countries=None, admin1=None, min_population=0):
+    """Build the gazetteer from a GeoNames dump (cities15000.txt, allCountries.txt, ...).
+    countryInfo.txt and admin1CodesASCII.txt, when given, make display names readable.
+    Returns the number of places written."""
+    country_names = {row[0]: row[4] for row in read_tsv(countries)} if countries else {}
+    admin1_names = {row[0]: row[1] for row in read_tsv(admin1)} if admin1 else {}
+
+    tmp_path = target + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    out = sqlite3.connect(tmp_path)
+    out.executescript("""
+        CREATE TABLE places (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            country TEXT,
+            feature_class TEXT,
+            feature_code TEXT,
+            population INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE place_names (key TEXT NOT NULL, place_id INTEGER NOT NULL, population INTEGER NOT NULL);
+        CREATE VIRTUAL TABLE place_trigrams USING fts5(key, place_id UNINDEXED, tokenize='trigram');
+    """)
+
+    count = 0
+    for row in read_tsv(source):
+        if len(row) < 15:
+            continue
+        population = int(row[14] or 0)
+        if population < min_population:
+            continue
+        place_id, name, ascii_name, alternates = int(row[0]), row[1], row[2], row[3]
+        country, admin1_code = row[8], row[10]
+        parts = [name]
+        admin1_name = admin1_names.get(f"{country}.{admin1_code}")
+        if admin1_name and admin1_name != name:
+            parts.append(admin1_name)
+        parts.append(country_names.get(country, country))
+
+        out.execute(
+            "INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (place_id, name, ", ".join(p for p in parts if p), float(row[4]), float(row[5]),
+             country, row[6], row[7], population)
+        )
+        keys = {normalize_place_name(name), normalize_place_name(ascii_name)}
+        keys.update(normalize_place_name(alt) for alt in alternates.split(",")[:GAZETTEER_MAX_ALTERNATES])
+        keys.discard("")
+        out.executemany("INSERT INTO place_names VALUES (?, ?, ?)", [(key, place_id, population) for key in keys])
+        out.executemany("INSERT INTO place_trigrams VALUES (?, ?)", [(key, place_id) for key in keys])
+        count += 1
+
+    out.executescript("""
+        CREATE INDEX idx_place_names_key ON place_names (key, population);
+        INSERT INTO place_trigrams (place_trigrams) VALUES ('optimize');
+    """)
+    out.commit()
+    out.close()
+    os.replace(tmp_path, target)
+    return count
+
+@app.cli.command("build-gazetteer")
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.option("--countries", type=click.Path(exists=True, dir_okay=False), help="GeoNames countryInfo.txt")
+@click.option("--admin1", type=click.Path(exists=True, dir_okay=False), help="GeoNames admin1CodesASCII.txt")
+@click.option("--min-population", default=0, show_default=True)
+def build_gazetteer_command(source, countries, admin1, min_population):
+    """Build the local geocoding gazetteer from a GeoNames dump."""
+    start = time.perf_counter()
+    count = build_gazetteer(source, countries=countries, admin1=admin1, min_population=min_population)
+    click.echo(f"Indexed {count} places into {GAZETTEER_DB} in {time.perf_counter() - start:.1f}s")
+
+def place_result(row):
+    """A gazetteer row in the shape Nominatim returns."""
+    return {
+        "place_id": row["id"],
+        "lat": str(row["lat"]),
+        "lon": str(row["lon"]),
+        "display_name": row["display_name"],
+        "name": row["name"],
+        "type": row["feature_code"],
+        "importance": row["population"],
+        "source": "local",
+    }
+
+def gazetteer_search(text, limit):
+    """Look a query up in the local gazetteer: exact and prefix matches first,
+    then substring matches, most populous first. "Paris, France" matches places
+    named Paris whose display name also mentions France."""
+    if not os.path.exists(GAZETTEER_DB):
+        return []
+    name, *qualifiers = text.split(",")
+    key = normalize_place_name(name)
+    qualifiers = [normalize_place_name(q) for q in qualifiers if normalize_place_name(q)]
+    if not key:
+        return []
+
+    def keep(row):
+        display = normalize_place_name(row["display_name"])
+        return all(q in display for q in qualifiers)
+
+    conn = get_connection(GAZETTEER_DB, read_only=True)
+    # Qualifiers are checked in Python, so fetch extra candidates when there are any
+    fetch = limit * 10 if qualifiers else limit
+    rows = conn.execute(
+        """
+        SELECT p.*, MIN(n.key != ?) AS inexact FROM place_names n
+        JOIN places p ON p.id = n.place_id
+        WHERE n.key >= ? AND n.key < ?
+        GROUP BY p.id
+        ORDER BY inexact, p.population DESC
+        LIMIT ?
+        """,
+        (key, key, key + "\uffff", fetch)
+    ).fetchall()
+    results = [row for row in rows if keep(row)][:limit]
+
+    if len(results) < limit and len(key) >= 3:
+        seen = {row["id"] for row in results}
+        try:
+            rows = conn.execute(
+                """
+                SELECT DISTINCT p.* FROM place_trigrams t
+                JOIN places p ON p.id = t.place_id
+                WHERE place_trigrams MATCH ?
+                ORDER BY p.population DESC
+                LIMIT ?
+                """,
+                (f'"{key}"', fetch)
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []  # SQLite built without the trigram tokenizer
+        results += [row for row in rows if row["id"] not in seen and keep(row)][:limit - len(results)]
+    conn.close()
+    return [place_result(row) for row in results]
+
+def init_geocode_cache():
+    conn = get_connection(GEOCODE_CACHE_DB)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT PRIMARY KEY,
+            results TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_geocode_cache_expires ON geocode_cache (expires_at);
+        CREATE TABLE IF NOT EXISTS upstream_throttle (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_request REAL NOT NULL
+        );
+        INSERT OR IGNORE INTO upstream_throttle VALUES (1, 0);
+    """)
+    conn.close()
+
+def claim_upstream_slot():
+    """Take the upstream request slot if the last request, from any worker, was
+    at least GEOCODE_UPSTREAM_INTERVAL ago. Returns False otherwise."""
+    now = time.time()
+    conn = get_connection(GEOCODE_CACHE_DB)
+    claimed = conn.execute(
+        "UPDATE upstream_throttle SET last_request = ? WHERE id = 1 AND last_request <= ?",
+        (now, now - GEOCODE_UPSTREAM_INTERVAL)
+    ).rowcount == 1
+    conn.commit()
+    conn.close()
+    return claimed
+
+init_geocode_cache()
+
+def upstream_geocode(text, limit):
+    """Ask the upstream geocoder, going through the cache. Returns a result list,
+    or None if the upstream rate limit leaves no slot right now."""
+    cache_key = f"{normalize_place_name(text)}|{limit}"
+    conn = get_connection(GEOCODE_CACHE_DB)
+    row = conn.execute(
+        "SELECT results FROM geocode_cache WHERE query = ? AND expires_at > ?", (cache_key, time.time())
+    ).fetchone()
+    conn.close()
+    if row:
+        return json.loads(row["results"])
+
+    if not claim_upstream_slot():
+        return None
+    try:
+        response = requests.get(
+            GEOCODE_UPSTREAM,
+            params={"q": text, "format": "json", "limit": limit},
+            headers={"User-Agent": GEOCODE_USER_AGENT},
+            timeout=5
+        )
+        response.raise_for_status()
+        results = [
+            {key: place.get(key) for key in ("place_id", "lat", "lon", "display_name", "name", "type", "importance")}
+            for place in response.json()
+        ]
+    except (requests.RequestException, ValueError) as e:
+        print(f"Geocoding upstream failed for {text!r}: {e}")
+        return []  # not cached, so the next lookup tries again
+
+    for place in results:
+        place["source"] = "upstream"
+    now = time.time()
+    conn = get_connection(GEOCODE_CACHE_DB)
+    conn.execute("DELETE FROM geocode_cache WHERE expires_at <= ?", (now,))
+    conn.execute(
+        "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?)",
+        (cache_key, json.dumps(results), now + (GEOCODE_CACHE_TTL if results else GEOCODE_EMPTY_TTL))
+    )
+    conn.commit()
+    conn.close()
+    return results
+
+@app.route("/api/geocode")
+def geocode():
+    """Nominatim-compatible place search: ?q=text, optional ?limit= and
+    ?autocomplete=1 (local gazetteer only, for suggestions while typing)."""
+    return geocode_response(GEOCODE_PUBLIC_UPSTREAM)
+
+def geocode_response(allow_upstream):
+    """Answer a geocode request from the gazetteer, falling back to the
+    upstream geocoder when allowed."""
+    text = request.args.get("q", "").strip()
+    try:
+        limit = min(GEOCODE_MAX_LIMIT, max(1, int(request.args.get("limit", 5))))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not text:
+        return jsonify([])
+
+    results = gazetteer_search(text, limit)
+    if results or request.args.get("autocomplete") or not allow_upstream or GEOCODE_UPSTREAM.lower() in ("", "off"):
+        return jsonify(results)
+    results = upstream_geocode(text, limit)
+    if results is None:
+        return jsonify({"error": "geocoder busy, try again shortly"}), 429, {"Retry-After": str(math.ceil(GEOCODE_UPSTREAM_INTERVAL))}
+    return jsonify(results)
+
+# -------------------------
+# Response Cache
+# -------------------------
+# Public pages and /api/food are cached whole, keyed by endpoint, query string
+# and the change counters of the data they show. Triggers bump a counter in
+# data_versions on every insert, update and delete of the tables behind it,
+# so any write (admin route, CLI command, background job, another worker)
+# moves the key and a cached response is never served stale. Entries live in
+# an in-process LRU; setting RESPONSE_CACHE_DIR adds an on-disk layer that
+# gunicorn workers share.
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_ENTRIES = 2000
+
+# cache source -> (database, data_versions name)
+DATA_SOURCES = {
+    "pictures": (DB_NAME, "pictures"),
+    "blog": (BLOG_DB, "posts"),
+    "updates": (UPDATES_DB, "posts"),
+    "food": (FOOD_DB, "food_locations"),
+}
+# Tables whose writes bump each source (food_locations has its own triggers in init_food_db)
+VERSIONED_TABLES = {
+    "pictures": ("pictures", "image_files", "image_optimizations"),
+    "blog": ("posts",),
+    "updates": ("posts",),
+}
+
+_response_cache = OrderedDict()  # key -> (status, content type, headers, body)
+# Response headers kept with a cached body
+CACHED_HEADERS = ("Content-Encoding", "Vary")
+_response_cache_bytes = 0
+_response_cache_lock = threading.Lock()
+_disk_cache_writes = 0
+
+def init_source_versions():
+    """Create the data_versions counters and the triggers that bump them."""
+    for source, tables in VERSIONED_TABLES.items():
+        path, name = DATA_SOURCES[source]
+        conn = get_connection(path)
+        existing = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        conn.execute("CREATE TABLE IF NOT EXISTS data_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO data_versions VALUES (?, 0)", (name,))
+        for table in tables:
+            if table not in existing:
+                continue  # created later, or not at all on a fresh install
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                        UPDATE data_versions SET version = version + 1 WHERE name = '{name}';
+                    END
+                """)
+        conn.commit()
+        conn.close()
+
+def source_version(source):
+    """Return a source's change counter, or None if it has none yet."""
+    path, name = DATA_SOURCES[source]
+    conn = get_connection(path)
+    try:
+        row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return row["version"] if row else None
+
+def bump_source_version(source):
+    """Invalidate a source's cached pages after a change its tables do not see
+    (e.g. derivatives rebuilt in the background)."""
+    path, name = DATA_SOURCES[source]
+    conn = get_connection(path)
+    conn.execute("UPDATE data_versions SET version = version + 1 WHERE name = ?", (name,))
+    conn.commit()
+    conn.close()
+
+def reset_source_versions():
+    """Move every counter past any value seen before, e.g. after a restore
+    brought back an older counter. Counters restart from the current time in ms."""
+    for path, name in DATA_SOURCES.values():
+        conn = get_connection(path)
+        try:
+            # Time computed here: unixepoch('subsec') needs SQLite 3.42
+            conn.execute(
+                "UPDATE data_versions SET version = MAX(version + 1, ?) WHERE name = ?",
+                (int(time.time() * 1000), name)
+            )
+            conn.commit()
+        except sqlite3.DatabaseError as e:
+            # No counters in this database yet, or a damaged restore; never abort the caller
+            conn.rollback()
+            if not isinstance(e, sqlite3.OperationalError):
+                print(f"Could not reset data version {name} in {path}: {e}")
+        conn.close()
+    clear_response_cache()
+
+def clear_response_cache():
+    global _response_cache_bytes
+    with _response_cache_lock:
+        _response_cache.clear()
+        _response_cache_bytes = 0
+
+def _disk_cache_path(key):
+    return os.path.join(RESPONSE_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest())
+
+def cache_lookup(key):
+    """Return a cached (status, content type, body), trying memory then disk."""
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is not None:
+            _response_cache.move_to_end(key)
+            return entry
+    if not RESPONSE_CACHE_DIR:
+        return None
+    try:
+        with open(_disk_cache_path(key), "rb") as f:
+            header, body = f.read().split(b"\n", 1)
+    except (OSError, ValueError):
+        return None
+    status, content_type, headers = json.loads(header)
+    entry = (status, content_type, headers, body)
+    _remember_response(key, entry)
+    return entry
+
+def _remember_response(key, entry):
+    """Add an entry to the in-process LRU, evicting the least recently used."""
+    global _response_cache_bytes
+    size = len(entry[-1])
+    if size > RESPONSE_CACHE_MAX_BYTES // 4:
+        return  # one huge response should not flush everything else
+    with _response_cache_lock:
+        old = _response_cache.pop(key, None)
+        if old is not None:
+            _response_cache_bytes -= len(old[-1])
+        _response_cache[key] = entry
+        _response_cache_bytes += size
+        while len(_response_cache) > RESPONSE_CACHE_ENTRIES or _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+            _, evicted = _response_cache.popitem(last=False)
+            _response_cache_bytes -= len(evicted[-1])
+
+def cache_store(key, entry):
+    """Cache a response in memory and, when configured, on disk."""
+    global _disk_cache_writes
+    _remember_response(key, entry)
+    if not RESPONSE_CACHE_DIR:
+        return
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=RESPONSE_CACHE_DIR, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(list(entry[:3])).encode() + b"\n" + entry[3])
+        os.replace(tmp_path, _disk_cache_path(key))
+
+        # Entries for old versions are never read again; trim the oldest now and then
+        _disk_cache_writes += 1
+        if _disk_cache_writes % 100 == 0:
+            files = [f for f in os.scandir(RESPONSE_CACHE_DIR) if not f.name.startswith(".")]
+            if len(files) > RESPONSE_CACHE_DISK_ENTRIES:
+                files.sort(key=lambda f: f.stat().st_mtime)
+                for old in files[:len(files) - RESPONSE_CACHE_DISK_ENTRIES]:
+                    os.remove(old.path)
+    except OSError as e:
+        print(f"Could not write response cache: {e}")
+
+def cached_response(*sources):
+    """Serve a GET route from the response cache. sources name the data the
+    response shows (keys of DATA_SOURCES). JSON is cached gzipped for clients
+    that accept it, so hits are not compressed again, and map data per layout."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = [source_version(source) for source in sources]
+            if None in versions:
+                return view(*args, **kwargs)
+
+            accepts_gzip = request.accept_encodings.quality("gzip") > 0
+            key = f"{request.endpoint}|{request.query_string.decode('latin-1')}|{versions}|{accepts_gzip}|{wants_columnar()}"
+            entry = cache_lookup(key)
+            state = "HIT"
+            if entry is None:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                gzip_response(response)
+                headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+                entry = (response.status_code, response.content_type, headers, response.get_data())
+                cache_store(key, entry)
+                state = "MISS"
+
+            status, content_type, headers, body = entry
+            response = Response(body, status=status, content_type=content_type, headers=headers)
+            response.headers["X-Cache"] = state
+            return response
+        return wrapper
+    return decorator
+
 # -------------------------
 # Public Routes
 # -------------------------
@@ -147,74 +2515,150 @@ def home():
 @app.route("/map")
 def map_view():
     """Map page showing visited places."""
-    return render_template("map_view.html")
+    return render_template(
+        "map_view.html",
+        country_tiles=os.path.exists(COUNTRY_TILES),
+        country_tiles_max_zoom=COUNTRY_TILES_MAX_ZOOM
+    )
 
-@app.route("/pictures")
-def pictures():
-    """Public pictures page with optional sorting by date."""
+@app.route("/tiles/countries/<int:z>/<int:x>/<int:y>.pbf")
+def country_tile(z, x, y):
+    """Serve a pre-built country boundaries vector tile."""
+    if not os.path.exists(COUNTRY_TILES):
+        abort(404)
+    conn = get_connection(COUNTRY_TILES, read_only=True)
+    row = conn.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+        (z, x, 2 ** z - 1 - y)
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return "", 204  # open ocean or outside the built zoom range
+
+    data = row["tile_data"]
+    headers = {"Content-Type": "application/x-protobuf", "Cache-Control": "public, max-age=86400", "Vary": "Accept-Encoding"}
+    if request.accept_encodings.quality("gzip") > 0:
+        headers["Content-Encoding"] = "gzip"
+    else:
+        data = gzip.decompress(data)
+    return Response(data, headers=headers)
+
+def pictures_order():
     order = request.args.get("order", "desc").lower()
-    if order not in ("asc", "desc"):
-        order = "desc"
+    return order if order in ("asc", "desc") else "desc"
 
+def load_pictures_page(cursor, order):
     conn = get_db_connection()
-    pics = conn.execute(f"SELECT * FROM pictures ORDER BY date_taken {order}").fetchall()
+    pics, next_cursor = keyset_page(conn, "pictures", "date_taken", cursor, PICTURES_PAGE_SIZE, order)
     conn.close()
+    return pics, next_cursor
 
-    # Format date for display
-    formatted_pics = []
-    for pic in pics:
-        date_str = pic["date_taken"]
-        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%B %d, %Y") if date_str else ""
-        pic = dict(pic)
-        pic["formatted_date"] = formatted_date
-        formatted_pics.append(pic)
+@app.route("/pictures")
+@cached_response("pictures")
+def pictures():
+    """Public pictures page with optional sorting by date."""
+    order = pictures_order()
+    pics, next_cursor = load_pictures_page(page_cursor(), order)
 
     toggle_order = "asc" if order == "desc" else "desc"
     return render_template(
         "pictures.html",
-        pictures=formatted_pics,
+        pictures=pics,
         toggle_order=toggle_order,
-        current_order=order
+        current_order=order,
+        next_cursor=next_cursor
     )
 
+@app.route("/api/pictures")
+@cached_response("pictures")
+def pictures_page():
+    """Next page of the gallery as an HTML fragment, for infinite scroll."""
+    order = pictures_order()
+    try:
+        cursor = decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    pics, next_cursor = load_pictures_page(cursor, order)
+    return jsonify({
+        "html": render_template("_picture_items.html", pictures=pics),
+        "next_cursor": next_cursor,
+        "next_url": url_for("pictures", order=order, cursor=next_cursor) if next_cursor else None,
+        "next_page_url": url_for("pictures_page", order=order, cursor=next_cursor) if next_cursor else None,
+    })
+
+def load_blog_page(cursor):
+    conn = get_blog_connection()
+    posts, next_cursor = keyset_page(conn, "posts", "date", cursor, POSTS_PAGE_SIZE)
+    conn.close()
+    return posts, next_cursor
+
 @app.route("/blog")
+@cached_response("blog")
 def blog():
     """Public blog page."""
-    conn = get_blog_connection()
-    
-    posts = conn.execute("SELECT * FROM posts ORDER BY date DESC").fetchall()
-    conn.close()
-    return render_template("blog.html", posts=posts)
+    posts, next_cursor = load_blog_page(page_cursor())
+    return render_template("blog.html", posts=posts, next_cursor=next_cursor)
 
-@app.route("/site_updates")
-def site_updates():
-    """Public site updates page."""
+@app.route("/api/blog")
+@cached_response("blog")
+def blog_page():
+    """Next page of blog posts as an HTML fragment, for infinite scroll."""
+    try:
+        cursor = decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    posts, next_cursor = load_blog_page(cursor)
+    return jsonify({
+        "html": render_template("_blog_items.html", posts=posts),
+        "next_cursor": next_cursor,
+        "next_url": url_for("blog", cursor=next_cursor) if next_cursor else None,
+        "next_page_url": url_for("blog_page", cursor=next_cursor) if next_cursor else None,
+    })
+
+def load_updates_page(cursor):
+    """One page of site updates with their HTML (raises OperationalError if the table is missing)."""
     conn = get_updates_connection()
-
-    # Check what tables exist
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = [t[0] for t in cur.fetchall()]
-    print("Tables in site_updates DB:", tables)  # this will show up in your console/logs
-
-    if "posts" not in tables:
+    try:
+        posts, next_cursor = keyset_page(conn, "posts", "date", cursor, POSTS_PAGE_SIZE)
+    finally:
         conn.close()
-        return "Table 'posts' does not exist in the database.", 500
 
-    # Fetch posts only if the table exists
-    posts = conn.execute("SELECT * FROM posts ORDER BY date DESC").fetchall()
-    conn.close()
-
-    # Convert Markdown description to HTML
+    # Use the stored HTML; only render rows saved before it existed
     posts_html = []
     for post in posts:
         post = dict(post)
-        post["description"] = markdown.markdown(
-            post["description"], extensions=["fenced_code", "codehilite"]
-        )
+        html = post.get("description_html")
+        post["description"] = html if html is not None else render_markdown(post["description"])
         posts_html.append(post)
+    return posts_html, next_cursor
 
-    return render_template("site_updates.html", posts=posts_html)
+@app.route("/site_updates")
+@cached_response("updates")
+def site_updates():
+    """Public site updates page."""
+    try:
+        posts, next_cursor = load_updates_page(page_cursor())
+    except sqlite3.OperationalError:
+        return "Table 'posts' does not exist in the database.", 500
+    return render_template("site_updates.html", posts=posts, next_cursor=next_cursor)
+
+@app.route("/api/site_updates")
+@cached_response("updates")
+def site_updates_page():
+    """Next page of site updates as an HTML fragment, for infinite scroll."""
+    try:
+        cursor = decode_cursor(request.args.get("cursor"))
+        posts, next_cursor = load_updates_page(cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.OperationalError:
+        return jsonify({"error": "Table 'posts' does not exist in the database."}), 500
+    return jsonify({
+        "html": render_template("_update_items.html", posts=posts),
+        "next_cursor": next_cursor,
+        "next_url": url_for("site_updates", cursor=next_cursor) if next_cursor else None,
+        "next_page_url": url_for("site_updates_page", cursor=next_cursor) if next_cursor else None,
+    })
 
 # @app.route("/debug_site_updates")
 # def debug_site_updates():
@@ -264,27 +2708,153 @@ def food_map():
     return render_template("food_map.html")
 
 @app.route("/api/food")
+@cached_response("food")
 def get_food():
-    """Return all food locations as JSON"""
+    """Return food locations as JSON, optionally limited to ?bbox=west,south,east,north
+    (?format=columnar for the columnar layout). At a ?zoom=... up to
+    CLUSTER_MAX_ZOOM the answer is the clustered FeatureCollection instead."""
+    try:
+        boxes = parse_bbox(request.args.get("bbox"))
+        zoom = request.args.get("zoom")
+        zoom = None if zoom is None else float(zoom)
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north and zoom a number"}), 400
+    if zoom is not None and zoom <= CLUSTER_MAX_ZOOM:
+        features = query_clusters(get_cluster_levels("food"), boxes, int(max(0.0, zoom)))
+        return jsonify({"type": "FeatureCollection", "features": features})
+    rows = query_food(boxes)
+    if wants_columnar():
+        response = food_columnar(rows)
+    else:
+        response = jsonify([food_row_dict(row) for row in rows])
+    response.vary.add("Accept")
+    return response
+
+@app.route("/api/food/cuisines")
+def get_food_cuisines():
+    """Return the distinct cuisines, for the food map filter."""
     conn = get_FOOD_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM food_locations")
-    rows = cur.fetchall()
+    rows = conn.execute("SELECT DISTINCT cuisine FROM food_locations ORDER BY cuisine").fetchall()
     conn.close()
+    return jsonify([row["cuisine"] for row in rows])
 
-    food_list = [
-        {
-            "id": row["id"],
-            "name": row["name"],
-            "cuisine": row["cuisine"],
-            "rating": row["rating"],
-            "coords": [row["lon"], row["lat"]],
-            "desc": row["desc"],
-            "link": row["link"]
-        }
-        for row in rows
-    ]
-    return jsonify(food_list)
+@app.route("/api/clusters/<layer>")
+def get_clusters(layer):
+    """Return clustered points for food, cities or mountains at ?zoom=..., optionally within ?bbox=..."""
+    if layer != "food" and layer not in FEATURE_LAYERS:
+        abort(404)
+    try:
+        boxes = parse_bbox(request.args.get("bbox"))
+        # Clamp before int() so ?zoom=inf lands on the most detailed level
+        zoom = int(max(0.0, min(float(request.args.get("zoom", 0)), CLUSTER_MAX_ZOOM + 1)))
+    except (ValueError, OverflowError):
+        return jsonify({"error": "bbox must be west,south,east,north and zoom a number"}), 400
+
+    features = query_clusters(get_cluster_levels(layer), boxes, zoom)
+    return jsonify({"type": "FeatureCollection", "features": features})
+
+@app.route("/api/features/<layer>")
+def get_features(layer):
+    """Return a GeoJSON layer (cities or mountains), optionally limited to ?bbox=...
+    (?format=columnar for the columnar layout)"""
+    if layer not in FEATURE_LAYERS:
+        abort(404)
+    try:
+        boxes = parse_bbox(request.args.get("bbox"))
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north"}), 400
+    rows = query_feature_rows(layer, boxes)
+    if wants_columnar():
+        response = features_columnar(rows)
+    else:
+        response = jsonify({"type": "FeatureCollection", "features": [feature_row_dict(row) for row in rows]})
+    response.vary.add("Accept")
+    return response
+
+@app.route("/api/photos")
+@cached_response("pictures")
+def get_photos():
+    """Return geotagged pictures as GeoJSON, optionally limited to ?bbox=west,south,east,north"""
+    try:
+        boxes = parse_bbox(request.args.get("bbox"))
+        limit = min(int(request.args.get("limit", PHOTOS_API_LIMIT)), PHOTOS_API_LIMIT)
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north and limit a number"}), 400
+    features = [photo_row_dict(row) for row in query_photos(boxes, max(limit, 1))]
+    return jsonify({"type": "FeatureCollection", "features": features})
+
+@app.route("/photos/thumbnail/<path:filename>")
+def photo_thumbnail(filename):
+    """A picture's smallest derivative, or the original until it has one. The
+    ?v= from /api/photos makes the derivative cacheable for good."""
+    path = safe_join(DERIVATIVE_FOLDER, derivative_name(filename, DERIVATIVE_WIDTHS[0], "jpg"))
+    if path is None or not os.path.isfile(path):
+        return send_precompressed(IMAGE_FOLDER, filename)
+
+    conn = get_db_connection()
+    row = conn.execute("SELECT size, mtime FROM image_files WHERE filename = ?", (filename,)).fetchone()
+    conn.close()
+    fingerprinted = row is not None and request.args.get("v") == ledger_version(row["size"], row["mtime"])
+    response = send_precompressed(
+        DERIVATIVE_FOLDER, os.path.basename(path),
+        max_age=FINGERPRINT_MAX_AGE if fingerprinted else None
+    )
+    if fingerprinted:
+        response.cache_control.immutable = True
+    return response
+
+@app.route("/api/countries/visited")
+def countries_visited():
+    """Per-country counts of cities, mountains and food spots, with the first and
+    last dated visit, for every country that has at least one."""
+    if get_country_index() is None:
+        return jsonify({
+            "error": "Country boundaries are not installed (static/layers/countries.json)",
+            "boundaries_available": False,
+        }), 503
+    stats = {}
+
+    def entry(name):
+        return stats.setdefault(name, {
+            "country": name, "cities": 0, "mountains": 0, "food": 0, "first_visit": None, "last_visit": None
+        })
+
+    conn = get_features_connection()
+    rows = conn.execute(
+        """
+        SELECT country, layer, COUNT(*) AS count,
+               MIN(NULLIF(json_extract(properties, '$.date'), '')) AS first_visit,
+               MAX(NULLIF(json_extract(properties, '$.date'), '')) AS last_visit
+        FROM features
+        WHERE country != ''
+        GROUP BY country, layer
+        """
+    ).fetchall()
+    untagged = conn.execute("SELECT COUNT(*) FROM features WHERE country IS NULL").fetchone()[0]
+    conn.close()
+    for row in rows:
+        country = entry(row["country"])
+        country[row["layer"]] = row["count"]
+        for key, pick in (("first_visit", min), ("last_visit", max)):
+            dates = [d for d in (country[key], row[key]) if d]
+            country[key] = pick(dates) if dates else None
+
+    conn = get_FOOD_connection()
+    try:
+        rows = conn.execute(
+            "SELECT country, COUNT(*) AS count FROM food_locations WHERE country != '' GROUP BY country"
+        ).fetchall()
+        untagged += conn.execute("SELECT COUNT(*) FROM food_locations WHERE country IS NULL").fetchone()[0]
+    except sqlite3.OperationalError:
+        rows = []  # food table not created yet
+    conn.close()
+    for row in rows:
+        entry(row["country"])["food"] = row["count"]
+
+    countries = sorted(stats.values(), key=lambda country: country["country"])
+    return jsonify({
+        "visited": len(countries), "untagged": untagged, "boundaries_available": True, "countries": countries
+    })
 
 # -------------------------
 # Admin Login
@@ -391,10 +2961,11 @@ def admin_updates():
     # Add new post
     if request.method == "POST" and "new_title" in request.form:
         conn.execute(
-            "INSERT INTO posts (title, description, location, date, images) VALUES (?, ?, ?, ?, ?)",
+            "INSERT INTO posts (title, description, description_html, location, date, images) VALUES (?, ?, ?, ?, ?, ?)",
             (
                 request.form["new_title"],
                 request.form["new_description"],
+                render_markdown(request.form["new_description"]),
                 request.form.get("new_location"),
                 request.form["new_date"],
                 request.form.get("new_images", "[]")  # optional JSON array
@@ -408,10 +2979,11 @@ def admin_updates():
     # Edit existing post
     if request.method == "POST" and "edit_id" in request.form:
         conn.execute(
-            "UPDATE posts SET title=?, description=?, location=?, date=?, images=? WHERE id=?",
+            "UPDATE posts SET title=?, description=?, description_html=?, location=?, date=?, images=? WHERE id=?",
             (
                 request.form["edit_title"],
                 request.form["edit_description"],
+                render_markdown(request.form["edit_description"]),
                 request.form.get("edit_location"),
                 request.form["edit_date"],
                 request.form.get("edit_images", "[]"),
@@ -449,27 +3021,36 @@ def admin_pictures():
     conn = get_db_connection()
 
     if request.method == "POST":
-        # Upload new picture
-        if "file" in request.files:
-            file = request.files["file"]
-            if file.filename == "":
-                flash("No selected file")
-                return redirect(request.url)
-
-            title = request.form.get("title") or os.path.splitext(file.filename)[0]
+        # Upload new pictures (one or many)
+        files = [file for file in request.files.getlist("file") if file.filename]
+        if "file" in request.files and not files:
+            flash("No selected file")
+            return redirect(request.url)
+
+        if files:
             description = request.form.get("description") or ""
             date_taken = request.form.get("date_taken") or None
             album = request.form.get("album") or ""
-            filename = file.filename
-            filepath = os.path.join(IMAGE_FOLDER, filename)
-            file.save(filepath)
-
-            conn.execute(
-                "INSERT INTO pictures (title, description, filename, date_taken, album) VALUES (?, ?, ?, ?, ?)",
-                (title, description, filename, date_taken, album)
-            )
-            conn.commit()
-            flash(f"Uploaded {filename} successfully!")
+            counts = {"added": 0, "shared": 0, "duplicate": 0}
+            for file in files:
+                if os.path.splitext(file.filename)[1].lower() not in UPLOAD_EXTENSIONS:
+                    flash(f"Skipped {file.filename}: not a supported image type")
+                    continue
+                # A title typed for a batch would repeat on every picture; use file names instead
+                title = (request.form.get("title") if len(files) == 1 else None) or os.path.splitext(file.filename)[0]
+                status, filename = store_picture(conn, file, title, description, date_taken, album)
+                counts[status] += 1
+                if status == "added":
+                    queue_upload_processing(filename)
+                elif status == "duplicate":
+                    flash(f"Skipped {file.filename}: already in this album")
+
+            stored = counts["added"] + counts["shared"]
+            if stored:
+                message = f"Uploaded {stored} picture{'s' if stored != 1 else ''}"
+                if counts["shared"]:
+                    message += f" ({counts['shared']} reusing an already stored file)"
+                flash(message + ". Thumbnails are being generated in the background.")
 
         # Edit existing picture
         if "edit_id" in request.form:
@@ -494,16 +3075,20 @@ def admin_pictures():
     return render_template("admin_pictures.html", pictures=pics)
 
 @app.route("/admin/pictures/delete/<int:pic_id>", methods=["POST"])
+@requires_auth
 def delete_picture(pic_id):
-    """Delete a picture and its file from disk."""
+    """Delete a picture; its file is removed once no other picture uses it."""
     conn = get_db_connection()
+    conn.execute("BEGIN IMMEDIATE")
     pic = conn.execute("SELECT filename FROM pictures WHERE id = ?", (pic_id,)).fetchone()
+    unused = False
     if pic:
-        image_path = os.path.join(IMAGE_FOLDER, pic["filename"])
-        if os.path.exists(image_path):
-            os.remove(image_path)
         conn.execute("DELETE FROM pictures WHERE id = ?", (pic_id,))
-        conn.commit()
+        unused = remove_picture_file(conn, pic["filename"])
+    conn.commit()
+    # Only touch the disk once the row is gone for good
+    if unused:
+        delete_picture_file(conn, pic["filename"])
     conn.close()
     flash("Picture deleted successfully!")
     return redirect(url_for("admin_pictures"))
@@ -511,37 +3096,195 @@ def delete_picture(pic_id):
 # -------------------------
 # Admin Routes: Rotate Pictures
 # -------------------------
-@app.route("/admin/pictures/rotate/<int:pic_id>/<int:degrees>", methods=["POST"])
+# Quarter turns of a JPEG only rewrite its EXIF orientation tag: the
+# compressed image data is left untouched, so rotating is lossless and does
+# not decode the photo. Browsers and the derivative generator both honour the
+# tag. Other formats are re-encoded (losslessly for PNG).
+EXIF_HEADER = b"Exif\x00\x00"
+JPEG_SOI, JPEG_APP0, JPEG_APP1, JPEG_SOS = 0xD8, 0xE0, 0xE1, 0xDA
+
+# Orientation after one more quarter turn clockwise; mirrored values cycle separately
+ORIENTATION_CLOCKWISE = {1: 6, 6: 3, 3: 8, 8: 1, 2: 7, 7: 4, 4: 5, 5: 2}
+
+def rotated_orientation(orientation, degrees):
+    """Return the EXIF orientation that shows the image turned a further
+    degrees clockwise (a multiple of 90)."""
+    orientation = orientation if orientation in ORIENTATION_CLOCKWISE else 1
+    for _ in range((degrees // 90) % 4):
+        orientation = ORIENTATION_CLOCKWISE[orientation]
+    return orientation
+
+def jpeg_segments(data):
+    """Yield (marker, start, end) for the header segments of a JPEG, stopping at the scan data."""
+    if data[:2] != bytes((0xFF, JPEG_SOI)):
+        raise ValueError("not a JPEG file")
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("corrupt JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # fill byte
+            continue
+        end = pos + 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        yield marker, pos, end
+        if marker == JPEG_SOS:
+            return
+        pos = end
+
+def exif_orientation_offset(tiff):
+    """Return (offset, byte order) of the orientation value in an EXIF TIFF block, or None."""
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None or len(tiff) < 8:
+        return None
+    ifd = struct.unpack(order + "I", tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return None
+    count = struct.unpack(order + "H", tiff[ifd:ifd + 2])[0]
+    for i in range(count):
+        entry = ifd + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        tag, kind = struct.unpack(order + "HH", tiff[entry:entry + 4])
+        if tag == EXIF_ORIENTATION and kind == 3:  # SHORT, stored in the value field
+            return entry + 8, order
+    return None
+
+def rotate_jpeg_lossless(path, degrees):
+    """Turn a JPEG clockwise by rewriting its EXIF orientation. The two bytes
+    of an existing tag are patched in place; otherwise a new Exif segment is
+    spliced into the header. Returns the new orientation."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    segments = list(jpeg_segments(data))
+    exif_segment = next(
+        ((start, end) for marker, start, end in segments
+         if marker == JPEG_APP1 and data[start + 4:start + 10] == EXIF_HEADER),
+        None
+    )
+
+    if exif_segment:
+        tiff_start = exif_segment[0] + 4 + len(EXIF_HEADER)
+        found = exif_orientation_offset(data[tiff_start:exif_segment[1]])
+        if found:
+            offset, order = found
+            current = struct.unpack(order + "H", data[tiff_start + offset:tiff_start + offset + 2])[0]
+            orientation = rotated_orientation(current, degrees)
+            with open(path, "r+b") as f:
+                f.seek(tiff_start + offset)
+                f.write(struct.pack(order + "H", orientation))
+            return orientation
+
+    # No tag to patch: serialize the EXIF with one added and splice it in
+    with Image.open(path) as img:
+        exif = img.getexif()
+    orientation = rotated_orientation(exif.get(EXIF_ORIENTATION, 1), degrees)
+    exif[EXIF_ORIENTATION] = orientation
+    payload = exif.tobytes()
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError("EXIF block too large to rewrite")
+    segment = bytes((0xFF, JPEG_APP1)) + struct.pack(">H", len(payload) + 2) + payload
+
+    if exif_segment:
+        start, end = exif_segment
+    else:
+        # JFIF wants its APP0 first, so insert after it
+        start = end = segments[0][2] if segments and segments[0][0] == JPEG_APP0 else 2
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".rotate-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data[:start] + segment + data[end:])
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return orientation
+
+def rotate_image_reencode(path, degrees):
+    """Rotate the pixels of a non-JPEG image and save it in its own format."""
+    with Image.open(path) as img:
+        image_format = img.format
+        img = ImageOps.exif_transpose(img)
+        # PIL rotates counter-clockwise, so we invert
+        img = img.rotate(-degrees, expand=True)
+        if image_format == "PNG":
+            img.save(path, format="PNG", optimize=True)
+        elif img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img.save(path, format=image_format, optimize=True)
+        else:
+            img = img.convert("RGB")
+            img.save(path, format=image_format or "JPEG", quality=85, optimize=True)
+
+@app.route("/admin/pictures/rotate/<int:pic_id>/<int(signed=True):degrees>", methods=["POST"])
 @requires_auth
 def rotate_picture(pic_id, degrees):
-    """Rotate a picture by a given number of degrees."""
+    """Rotate a picture clockwise by a multiple of 90 degrees."""
+    if degrees % 90:
+        flash("Pictures can only be rotated in quarter turns.")
+        return redirect(url_for("admin_pictures"))
+
     conn = get_db_connection()
     pic = conn.execute("SELECT filename FROM pictures WHERE id = ?", (pic_id,)).fetchone()
-    conn.close()
 
     if not pic:
+        conn.close()
         flash("Picture not found!")
         return redirect(url_for("admin_pictures"))
 
-    file_path = os.path.join(IMAGE_FOLDER, pic["filename"])
+    filename = pic["filename"]
+    file_path = os.path.join(IMAGE_FOLDER, filename)
     if not os.path.exists(file_path):
+        conn.close()
         flash("File not found on disk!")
         return redirect(url_for("admin_pictures"))
 
+    # Copy-on-write: the file may be shared with other rows, so the rotated
+    # copy is stored under its own hash and only this row is repointed
+    ext = os.path.splitext(filename)[1].lower()
+    fd, tmp_path = tempfile.mkstemp(dir=IMAGE_FOLDER, prefix=".rotate-", suffix=".tmp")
+    os.close(fd)
     try:
-        with Image.open(file_path) as img:
-            # Apply rotation (degrees clockwise)
-            img = img.rotate(-degrees, expand=True)  # PIL rotates counter-clockwise, so we invert
-            # Preserve format
-            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-                img.save(file_path, optimize=True)
-            else:
-                img = img.convert("RGB")
-                img.save(file_path, format="JPEG", quality=85, optimize=True)
-        flash(f"Rotated picture by {degrees}° successfully!")
+        shutil.copyfile(file_path, tmp_path)
+        with Image.open(tmp_path) as img:
+            is_jpeg = img.format == "JPEG"
+        if is_jpeg:
+            rotate_jpeg_lossless(tmp_path, degrees)
+        else:
+            rotate_image_reencode(tmp_path, degrees)
+        content_hash = file_sha256(tmp_path)
+        new_filename = content_hash[:16] + ext
+
+        # Place the file under the write lock, as store_picture does
+        conn.execute("BEGIN IMMEDIATE")
+        new_path = os.path.join(IMAGE_FOLDER, new_filename)
+        if not os.path.exists(new_path):
+            os.replace(tmp_path, new_path)
+        swap = "width = height, height = width, " if degrees % 180 else ""
+        conn.execute(
+            f"UPDATE pictures SET {swap}filename = ?, content_hash = ? WHERE id = ?",
+            (new_filename, content_hash, pic_id)
+        )
+        record_image_file(conn, new_filename)
+        unused = new_filename != filename and remove_picture_file(conn, filename)
+        conn.commit()
     except Exception as e:
+        conn.rollback()
+        conn.close()
         flash(f"Failed to rotate picture: {e}")
-
+        return redirect(url_for("admin_pictures"))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # The old file and its derivatives go once no other row uses them;
+    # pages fall back to the new original until its derivatives are built
+    if unused:
+        delete_picture_file(conn, filename)
+    conn.close()
+    future = get_process_pool().submit(generate_derivatives, new_filename)
+    future.add_done_callback(lambda f: queue_db_write(bump_source_version, "pictures"))
+    flash(f"Rotated picture by {degrees}° successfully!")
     return redirect(url_for("admin_pictures"))
 
 # -------------------------
@@ -551,52 +3294,41 @@ def rotate_picture(pic_id, degrees):
 @requires_auth
 def admin_geojson():
     """
-    Admin page for managing the cities.geojson file.
+    Admin page for managing the cities layer (snapshotted to cities.geojson).
     Supports:
       - Editing existing features (city name, date, coordinates)
       - Deleting features
       - Adding new features with coordinates
     """
-    geojson_path = CITIES_GEOJSON  # <-- use persistent file
-
-    # -------------------
-    # Load existing GeoJSON
-    # -------------------
-    if os.path.exists(geojson_path):
-        with open(geojson_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {"type": "FeatureCollection", "features": []}
+    layer = "cities"
 
     if request.method == "POST":
-        updated_features = []
+        conn = get_features_connection()
+        conn.execute("BEGIN IMMEDIATE")
 
         # -------------------
-        # Update existing features
+        # Update existing features (only rows that changed are written)
         # -------------------
-        for i, feature in enumerate(data.get("features", [])):
-            if request.form.get(f"delete_{i}") == "on":
-                continue  # skip deleted features
+        for feature in query_features_locked(conn, layer):
+            fid = feature["id"]
+            if request.form.get(f"delete_{fid}") == "on":
+                delete_feature(conn, layer, fid)
+                continue
 
-            # Update properties
-            feature["properties"]["city"] = request.form.get(
-                f"title_{i}", feature["properties"].get("city", "")
-            )
-            feature["properties"]["date"] = request.form.get(
-                f"date_{i}", feature["properties"].get("date", "")
-            )
+            props = dict(feature["properties"])
+            props["city"] = request.form.get(f"title_{fid}", props.get("city", ""))
+            props["date"] = request.form.get(f"date_{fid}", props.get("date", ""))
 
             # Update coordinates if provided
+            lng, lat = feature["geometry"]["coordinates"]
             try:
-                lat = float(request.form.get(f"lat_{i}", feature["geometry"]["coordinates"][1]))
-                lng = float(request.form.get(f"lng_{i}", feature["geometry"]["coordinates"][0]))
-                feature["geometry"]["coordinates"] = [lng, lat]
+                lat = float(request.form.get(f"lat_{fid}", lat))
+                lng = float(request.form.get(f"lng_{fid}", lng))
             except (TypeError, ValueError):
                 pass  # keep original if invalid
 
-            updated_features.append(feature)
-
-        data["features"] = updated_features
+            if props != feature["properties"] or [lng, lat] != feature["geometry"]["coordinates"]:
+                save_feature(conn, layer, lng, lat, props, fid)
 
         # -------------------
         # Add new feature if provided
@@ -608,30 +3340,25 @@ def admin_geojson():
 
         if new_city and new_lat and new_lng:
             try:
-                lat = float(new_lat)
-                lng = float(new_lng)
-                new_feature = {
-                    "type": "Feature",
-                    "geometry": {"type": "Point", "coordinates": [lng, lat]},
-                    "properties": {"city": new_city, "date": new_date or ""}
-                }
-                data["features"].append(new_feature)
+                save_feature(conn, layer, float(new_lng), float(new_lat), {"city": new_city, "date": new_date or ""})
             except ValueError:
                 pass  # ignore if coordinates are invalid
 
+        tag_countries(conn, "features")
+        conn.commit()
+        conn.close()
+
         # -------------------
-        # Save updated GeoJSON back to file
+        # Write the cities.geojson snapshot
         # -------------------
-        os.makedirs(os.path.dirname(geojson_path), exist_ok=True)
-        with open(geojson_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        export_layer(layer)
 
         return redirect(url_for("admin_geojson"))
 
     # -------------------
     # GET request → render admin page
     # -------------------
-    return render_template("admin_geojson.html", features=data.get("features", []))
+    return render_template("admin_geojson.html", features=query_features(layer, None))
 
 # -------------------------
 # Admin Routes: Terrain (Cesium)
@@ -640,46 +3367,40 @@ def admin_geojson():
 @requires_auth
 def admin_terrain():
     """
-    Admin page for managing the mountains.geojson file.
+    Admin page for managing the mountains layer (snapshotted to mountains.geojson).
     Allows add/edit/delete of mountain summit features.
     """
-    geojson_path = MOUNTAINS_GEOJSON
-
-    # Load
-    if os.path.exists(geojson_path):
-        with open(geojson_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {"type": "FeatureCollection", "features": []}
+    layer = "mountains"
 
     if request.method == "POST":
-        updated_features = []
+        conn = get_features_connection()
+        conn.execute("BEGIN IMMEDIATE")
 
-        # Update existing
-        for i, feature in enumerate(data.get("features", [])):
-            if request.form.get(f"delete_{i}") == "on":
+        # Update existing (only rows that changed are written)
+        for feature in query_features_locked(conn, layer):
+            fid = feature["id"]
+            if request.form.get(f"delete_{fid}") == "on":
+                delete_feature(conn, layer, fid)
                 continue
 
-            props = feature.get("properties", {})
-            props["name"] = request.form.get(f"name_{i}", props.get("name", ""))
-            props["crowds"] = request.form.get(f"crowds_{i}", props.get("crowds", ""))
-            props["date"] = request.form.get(f"date_{i}", props.get("date", ""))
-            props["rating"] = int(request.form.get(f"rating_{i}", props.get("rating", 0)))
-            props["difficulty"] = int(request.form.get(f"difficulty_{i}", props.get("difficulty", 0)))
-            props["distance (mi)"] = float(request.form.get(f"distance_{i}", props.get("distance (mi)", 0)))
-            props["elevation (m)"] = float(request.form.get(f"elevation_{i}", props.get("elevation (m)", 0)))
+            props = dict(feature["properties"])
+            props["name"] = request.form.get(f"name_{fid}", props.get("name", ""))
+            props["crowds"] = request.form.get(f"crowds_{fid}", props.get("crowds", ""))
+            props["date"] = request.form.get(f"date_{fid}", props.get("date", ""))
+            props["rating"] = int(request.form.get(f"rating_{fid}", props.get("rating", 0)))
+            props["difficulty"] = int(request.form.get(f"difficulty_{fid}", props.get("difficulty", 0)))
+            props["distance (mi)"] = float(request.form.get(f"distance_{fid}", props.get("distance (mi)", 0)))
+            props["elevation (m)"] = float(request.form.get(f"elevation_{fid}", props.get("elevation (m)", 0)))
 
+            lng, lat = feature["geometry"]["coordinates"]
             try:
-                lat = float(request.form.get(f"lat_{i}", feature["geometry"]["coordinates"][1]))
-                lng = float(request.form.get(f"lng_{i}", feature["geometry"]["coordinates"][0]))
-                feature["geometry"]["coordinates"] = [lng, lat]
+                lat = float(request.form.get(f"lat_{fid}", lat))
+                lng = float(request.form.get(f"lng_{fid}", lng))
             except (TypeError, ValueError):
                 pass
 
-            feature["properties"] = props
-            updated_features.append(feature)
-
-        data["features"] = updated_features
+            if props != feature["properties"] or [lng, lat] != feature["geometry"]["coordinates"]:
+                save_feature(conn, layer, lng, lat, props, fid)
 
         # Add new
         new_name = request.form.get("new_name")
@@ -692,28 +3413,26 @@ def admin_terrain():
                 lat = float(new_lat)
                 lng = float(new_lng)
                 elev = float(new_elev) if new_elev else 0
-                new_feature = {
-                    "type": "Feature",
-                    "geometry": {"type": "Point", "coordinates": [lng, lat]},
-                    "properties": {
-                        "name": new_name,
-                        "elevation (m)": elev,
-                        "date": request.form.get("new_date", ""),
-                        "rating": int(request.form.get("new_rating", 0)),
-                        "difficulty": int(request.form.get("new_difficulty", 0)),
-                        "distance (mi)": float(request.form.get("new_distance", 0)),
-                        "crowds": request.form.get("new_crowds", "")
-                    }
-                }
-                data["features"].append(new_feature)
+                save_feature(conn, layer, lng, lat, {
+                    "name": new_name,
+                    "elevation (m)": elev,
+                    "date": request.form.get("new_date", ""),
+                    "rating": int(request.form.get("new_rating", 0)),
+                    "difficulty": int(request.form.get("new_difficulty", 0)),
+                    "distance (mi)": float(request.form.get("new_distance", 0)),
+                    "crowds": request.form.get("new_crowds", "")
+                })
             except ValueError:
                 pass
 
-        # Save back to file
-        with open(geojson_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        tag_countries(conn, "features")
+        conn.commit()
+        conn.close()
+
+        # Write the mountains.geojson snapshot
+        export_layer(layer)
 
-    return render_template("admin_terrain.html", features=data.get("features", []))
+    return render_template("admin_terrain.html", features=query_features(layer, None))
 
 # -------------------------
 # Admin Routes: Food Map
@@ -735,31 +3454,25 @@ def admin_food_map():
     # Handle POST updates
     # -------------------
     if request.method == "POST":
-        # Get all IDs
-        cur.execute("SELECT id FROM food_locations")
-        all_ids = [row["id"] for row in cur.fetchall()]
-
-        for fid in all_ids:
+        # Without JavaScript the whole form is posted; only rows that differ are written
+        cur.execute("SELECT * FROM food_locations")
+        for row in cur.fetchall():
+            fid = row["id"]
             if request.form.get(f"delete_{fid}") == "on":
                 cur.execute("DELETE FROM food_locations WHERE id=?", (fid,))
                 continue
 
+            values = [request.form.get(f"{col}_{fid}") for col in FOOD_FIELDS]
+            if all(value is None or value == str(row[col]) for col, value in zip(FOOD_FIELDS, values)):
+                continue
+
             cur.execute(
                 """
                 UPDATE food_locations
                 SET name=?, cuisine=?, rating=?, lat=?, lon=?, desc=?, link=?
                 WHERE id=?
                 """,
-                (
-                    request.form.get(f"name_{fid}"),
-                    request.form.get(f"cuisine_{fid}"),
-                    request.form.get(f"rating_{fid}"),
-                    request.form.get(f"lat_{fid}"),
-                    request.form.get(f"lon_{fid}"),
-                    request.form.get(f"desc_{fid}"),
-                    request.form.get(f"link_{fid}"),
-                    fid
-                )
+                (*values, fid)
             )
 
         # Add new entry
@@ -781,6 +3494,7 @@ def admin_food_map():
                 (new_name, new_cuisine, new_rating, new_lat, new_lon, new_desc, new_link)
             )
 
+        tag_countries(conn, "food_locations")
         conn.commit()
         conn.close()
         return redirect(url_for("admin_food_map"))
@@ -808,38 +3522,484 @@ def admin_food_map():
     conn.close()
     return render_template("admin_food_map.html", locations=locations)
 
+# -------------------------
+# Admin API: delta edits
+# -------------------------
+# The admin pages send only what was edited, as
+#   {"upsert": [{...}, ...], "delete": [id, ...]}
+# Entries with an id update just the fields they carry; entries without one
+# are inserted. Each request is applied in a single transaction.
+FOOD_FIELDS = {"name": str, "cuisine": str, "rating": float, "lat": float, "lon": float, "desc": str, "link": str}
+FOOD_REQUIRED = ("name", "cuisine", "lat", "lon")
+FOOD_RANGES = {"lat": (-90, 90), "lon": (-180, 180)}
+
+def parse_patch(body):
+    """Return (upserts, deletes) from a PATCH body, raising ValueError if malformed."""
+    if not isinstance(body, dict):
+        raise ValueError("body must be a JSON object")
+    upserts = body.get("upsert", [])
+    deletes = body.get("delete", [])
+    if not isinstance(upserts, list) or not all(isinstance(item, dict) for item in upserts):
+        raise ValueError("upsert must be a list of objects")
+    if not all(type(item.get("id")) in (int, type(None)) for item in upserts):
+        raise ValueError("upsert ids must be integers")
+    if not isinstance(deletes, list) or not all(type(fid) is int for fid in deletes):
+        raise ValueError("delete must be a list of ids")
+    return upserts, deletes
+
+def food_values(item):
+    """Pick and convert the food_locations columns present in an upsert entry."""
+    values = {}
+    for col, cast in FOOD_FIELDS.items():
+        if col not in item:
+            continue
+        value = item[col]
+        if cast is float:
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError(f"{col} must be a finite number")
+            low, high = FOOD_RANGES.get(col, (-math.inf, math.inf))
+            if not low <= value <= high:
+                raise ValueError(f"{col} out of range")
+        elif value is not None:
+            value = str(value)
+        values[col] = value
+    return values
+
+@app.route("/admin/api/geocode")
+@requires_auth
+def admin_geocode():
+    """/api/geocode for the admin pages, with the upstream fallback for addresses."""
+    return geocode_response(True)
+
+@app.route("/admin/api/food", methods=["PATCH"])
+@requires_auth
+def patch_food():
+    """Apply a delta of food location edits."""
+    try:
+        upserts, deletes = parse_patch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    result = {"inserted": [], "updated": 0, "deleted": 0}
+    conn = get_FOOD_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for item in upserts:
+            values = food_values(item)
+            columns = [f'"{col}"' for col in values]
+            if item.get("id") is None:
+                missing = [col for col in FOOD_REQUIRED if values.get(col) in (None, "")]
+                if missing:
+                    raise ValueError(f"new locations need {', '.join(missing)}")
+                if "rating" not in values:
+                    values["rating"] = 0.0
+                    columns.append('"rating"')
+                cur = conn.execute(
+                    f"INSERT INTO food_locations ({', '.join(columns)}) VALUES ({', '.join('?' * len(values))})",
+                    list(values.values())
+                )
+                result["inserted"].append(cur.lastrowid)
+            else:
+                if not conn.execute("SELECT 1 FROM food_locations WHERE id = ?", (item["id"],)).fetchone():
+                    raise ValueError(f"no food location with id {item['id']}")
+                if values:
+                    conn.execute(
+                        f"UPDATE food_locations SET {', '.join(f'{col} = ?' for col in columns)} WHERE id = ?",
+                        [*values.values(), item["id"]]
+                    )
+                result["updated"] += 1
+
+        for fid in deletes:
+            result["deleted"] += conn.execute("DELETE FROM food_locations WHERE id = ?", (fid,)).rowcount
+    except (ValueError, TypeError, sqlite3.IntegrityError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": str(e)}), 400
+
+    tag_countries(conn, "food_locations")
+    conn.commit()
+    conn.close()
+    return jsonify(result)
+
+def parse_coordinates(value):
+    """Return (lon, lat) from a [lon, lat] pair, raising ValueError if invalid."""
+    if not isinstance(value, list) or len(value) != 2:
+        raise ValueError("coordinates must be [lon, lat]")
+    lon, lat = float(value[0]), float(value[1])
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError("coordinates out of range")
+    return lon, lat
+
+@app.route("/admin/api/features/<layer>", methods=["PATCH"])
+@requires_auth
+def patch_features(layer):
+    """Apply a delta of edits to the cities or mountains layer.
+    Upsert entries look like {"id", "coordinates": [lon, lat], "properties": {...}};
+    given properties are merged into the feature's, and a null value removes one."""
+    if layer not in FEATURE_LAYERS:
+        abort(404)
+    try:
+        upserts, deletes = parse_patch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    result = {"inserted": [], "updated": 0, "deleted": 0}
+    conn = get_features_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for item in upserts:
+            properties = item.get("properties", {})
+            if not isinstance(properties, dict):
+                raise ValueError("properties must be an object")
+
+            if item.get("id") is None:
+                if "coordinates" not in item:
+                    raise ValueError("new features need coordinates")
+                lon, lat = parse_coordinates(item["coordinates"])
+                props = {key: value for key, value in properties.items() if value is not None}
+                result["inserted"].append(save_feature(conn, layer, lon, lat, props))
+                continue
+
+            row = conn.execute(
+                "SELECT * FROM features WHERE id = ? AND layer = ?", (item["id"], layer)
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"no {layer} feature with id {item['id']}")
+            lon, lat = parse_coordinates(item["coordinates"]) if "coordinates" in item else (row["lon"], row["lat"])
+            props = json.loads(row["properties"])
+            for key, value in properties.items():
+                if value is None:
+                    props.pop(key, None)
+                else:
+                    props[key] = value
+            save_feature(conn, layer, lon, lat, props, row["id"])
+            result["updated"] += 1
+
+        for fid in deletes:
+            result["deleted"] += conn.execute(
+                "DELETE FROM features WHERE id = ? AND layer = ?", (fid, layer)
+            ).rowcount
+    except (ValueError, TypeError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": str(e)}), 400
+
+    tag_countries(conn, "features")
+    conn.commit()
+    conn.close()
+    export_layer(layer)
+    return jsonify(result)
+
+# -------------------------
+# Streaming ZIP export
+# -------------------------
+# Files that are already compressed are stored as-is instead of deflated again
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".zip", ".gz", ".br"}
+SQLITE_EXTENSIONS = {".db"}
+# Regenerable caches are left out of backups
+BACKUP_EXCLUDE_DIRS = {"derivatives", "tiles", "geocode", "profiles"}
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+class ZipStreamBuffer:
+    """Write-only file object that hands out whatever zipfile has written so far.
+    It has no tell()/seek(), so zipfile writes entries with data descriptors."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def sqlite_snapshot(path):
+    """Copy a live SQLite database to a temp file using the backup API.
+    Returns the temp path; the caller removes it."""
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    src = sqlite3.connect(path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return tmp_path
+
+def backup_entries(root=PERSISTENT_DIR):
+    """Yield (arcname, path) for every file under root that belongs in a backup."""
+    for dirpath, dirs, files in os.walk(root):
+        if dirpath == root:
+            dirs[:] = [d for d in dirs if d not in BACKUP_EXCLUDE_DIRS]
+        # Hidden folders hold restore staging areas
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            # SQLite sidecars are folded into the snapshot; temp files are half-written
+            if name.endswith(("-wal", "-shm", "-journal", ".tmp")):
+                continue
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, start=root).replace(os.sep, "/"), path
+
+def iter_zip(entries, extra=None):
+    """Yield a ZIP archive of (arcname, path) entries chunk by chunk,
+    without ever holding more than one chunk of file data in memory.
+    extra maps arcnames to small in-memory bytes appended at the end."""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for arcname, path in entries:
+            ext = os.path.splitext(path)[1].lower()
+            snapshot = sqlite_snapshot(path) if ext in SQLITE_EXTENSIONS else None
+            try:
+                source = snapshot or path
+                info = zipfile.ZipInfo.from_file(source, arcname)
+                info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                with open(source, "rb") as src, zip_file.open(info, "w") as dest:
+                    for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                        dest.write(chunk)
+                        data = buffer.drain()
+                        if data:
+                            yield data
+            finally:
+                if snapshot:
+                    os.remove(snapshot)
+            data = buffer.drain()
+            if data:
+                yield data
+        for arcname, content in (extra or {}).items():
+            zip_file.writestr(arcname, content, compress_type=zipfile.ZIP_DEFLATED)
+    yield buffer.drain()
+
 # -------------------------
 # Downloading the databases
 # -------------------------
 @app.route("/download")
 @requires_auth
 def download_all():
-    # Create an in-memory bytes buffer
-    zip_buffer = io.BytesIO()
-
-    # Create a zip archive in the buffer
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        
-        # Add the entire data folder
-        for root, dirs, files in os.walk(PERSISTENT_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Preserve folder structure inside the zip
-                arcname = os.path.relpath(file_path, start=PERSISTENT_DIR)
-                zip_file.write(file_path, arcname=arcname)
-
-    # Make sure the buffer’s pointer is at the start
-    zip_buffer.seek(0)
-
+    """Stream a ZIP of the persistent data folder, snapshotting SQLite databases."""
     # Create a filename with the current date
     date_str = datetime.now().strftime("%Y-%m-%d")
     zip_filename = f"databases_{date_str}.zip"
 
-    return send_file(
-        zip_buffer,
-        as_attachment=True,
-        download_name=zip_filename,
-        mimetype="application/zip"
+    return Response(
+        iter_zip(backup_entries()),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
+    )
+
+# -------------------------
+# Incremental backup and restore
+# -------------------------
+# A client keeps a manifest of the files it already has (path -> sha256, size,
+# mtime). It asks for only the files that differ, and restores apply only the
+# entries whose content actually changed.
+SYNC_MANIFEST_NAME = "_sync_manifest.json"
+
+_hash_cache = {}
+
+def cached_sha256(path):
+    """Return a file's SHA-256, reusing the last result while size and mtime are unchanged."""
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _hash_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = file_sha256(path)
+    _hash_cache[path] = (key, digest)
+    return digest
+
+def build_manifest(root=PERSISTENT_DIR):
+    """Return {arcname: {"sha256", "size", "mtime"}} for every backed-up file."""
+    manifest = {}
+    for arcname, path in backup_entries(root):
+        stat = os.stat(path)
+        manifest[arcname] = {
+            "sha256": cached_sha256(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+    return manifest
+
+def file_changed(server_entry, client_entry):
+    """Decide whether the client's copy of a file differs from ours."""
+    if not client_entry:
+        return True
+    if client_entry.get("sha256"):
+        return client_entry["sha256"] != server_entry["sha256"]
+    # Without a hash, fall back to an exact size + mtime comparison
+    return (client_entry.get("size"), client_entry.get("mtime")) != (server_entry["size"], server_entry["mtime"])
+
+def safe_arcname(name):
+    """Return a normalized relative path for a ZIP entry, or None if it escapes the data folder."""
+    normalized = os.path.normpath(name.replace("\\", "/"))
+    if os.path.isabs(normalized) or normalized.split(os.sep)[0] == ".." or normalized in (".", ""):
+        return None
+    return normalized
+
+def parse_sync_manifest(data):
+    """Return the "deleted" list of a ZIP's _sync_manifest.json.
+    Raises ValueError when it is not the object sync_export() writes."""
+    manifest = json.loads(data)
+    if not isinstance(manifest, dict):
+        raise ValueError(f"{SYNC_MANIFEST_NAME} must be a JSON object")
+    deleted = manifest.get("deleted", [])
+    if not isinstance(deleted, list) or not all(isinstance(name, str) for name in deleted):
+        raise ValueError(f"{SYNC_MANIFEST_NAME}: deleted must be a list of paths")
+    return deleted
+
+def restore_sqlite(source_path, target_path):
+    """Copy a database over a live one with the backup API.
+    Renaming over a WAL-mode database would pair the new file with the old
+    -wal file, so the pages are copied into it transactionally instead."""
+    src = sqlite3.connect(source_path)
+    dst = sqlite3.connect(target_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def resync_feature_store(restored):
+    """Keep the feature store and its .geojson snapshots agreeing after a restore.
+    A restored features.db wins (its layers are re-exported); a backup that only
+    carries the .geojson files is imported into the store instead."""
+    conn = get_features_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    if os.path.basename(FEATURES_DB) in restored:
+        conn.execute("UPDATE layer_versions SET version = version + 1")
+    else:
+        for layer, path in FEATURE_LAYERS.items():
+            if os.path.basename(path) in restored:
+                import_layer(conn, layer, path)
+                conn.execute("UPDATE layer_versions SET exported_version = version WHERE layer = ?", (layer,))
+    conn.commit()
+    conn.close()
+    for layer in FEATURE_LAYERS:
+        export_layer(layer)
+
+def apply_restore(zip_path):
+    """Restore a full or incremental backup ZIP into PERSISTENT_DIR.
+    Changed entries are extracted into a staging folder first and only swapped
+    in (with atomic renames) once the whole archive has been read. Only files
+    already in this server's backup set can be deleted. Returns a summary dict;
+    raises ValueError for a malformed sync manifest."""
+    summary = {"restored": [], "unchanged": 0, "deleted": [], "rejected": []}
+    backed_up = {arcname for arcname, _ in backup_entries()}
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=PERSISTENT_DIR)
+    try:
+        staged = []
+        deleted = []
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                if info.filename == SYNC_MANIFEST_NAME:
+                    deleted = parse_sync_manifest(zip_ref.read(info))
+                    continue
+                relpath = safe_arcname(info.filename)
+                if relpath is None:
+                    summary["rejected"].append(info.filename)
+                    continue
+
+                staged_path = os.path.join(staging_dir, relpath)
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                digest = hashlib.sha256()
+                with zip_ref.open(info) as src, open(staged_path, "wb") as dest:
+                    for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        dest.write(chunk)
+
+                target = os.path.join(PERSISTENT_DIR, relpath)
+                if os.path.isfile(target) and cached_sha256(target) == digest.hexdigest():
+                    os.remove(staged_path)
+                    summary["unchanged"] += 1
+                    continue
+                staged.append((relpath, staged_path))
+
+        # Everything is staged; swap the changed files in
+        for relpath, staged_path in staged:
+            target = os.path.join(PERSISTENT_DIR, relpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.splitext(relpath)[1].lower() in SQLITE_EXTENSIONS and os.path.exists(target):
+                restore_sqlite(staged_path, target)
+            else:
+                os.replace(staged_path, target)
+            if relpath.startswith("images/"):
+                invalidate_derivatives(os.path.basename(relpath))
+            summary["restored"].append(relpath)
+
+        # Bring restored databases up to the current schema and indexes
+        if any(os.path.splitext(relpath)[1].lower() in SQLITE_EXTENSIONS for relpath in summary["restored"]):
+            init_updates_db()
+            init_food_db()
+            init_search_index()
+            init_page_indexes()
+            init_picture_uploads()
+            init_photo_metadata()
+            init_storage_ledger()
+            init_optimize_tables()
+            init_source_versions()
+            reset_source_versions()
+        resync_feature_store(summary["restored"])
+
+        for name in deleted:
+            relpath = safe_arcname(name)
+            if relpath not in backed_up:
+                summary["rejected"].append(name)
+                continue
+            target = os.path.join(PERSISTENT_DIR, relpath)
+            if os.path.isfile(target):
+                os.remove(target)
+                if relpath.startswith("images/"):
+                    invalidate_derivatives(os.path.basename(relpath))
+                summary["deleted"].append(relpath)
+
+        # Restored or deleted originals change what the storage ledger should say
+        if any(relpath.startswith("images/") or relpath == os.path.basename(DB_NAME)
+               for relpath in summary["restored"] + summary["deleted"]):
+            reconcile_storage()
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return summary
+
+@app.route("/admin/sync/manifest")
+@requires_auth
+def sync_manifest():
+    """Return the server's manifest of backed-up files as JSON."""
+    return jsonify({"files": build_manifest()})
+
+@app.route("/admin/sync/export", methods=["POST"])
+@requires_auth
+def sync_export():
+    """Stream a ZIP containing only the files that differ from the client's manifest.
+    Body: {"files": {arcname: {"sha256": ..., "size": ..., "mtime": ...}}}.
+    The ZIP also carries _sync_manifest.json listing the full server manifest
+    and the client files that no longer exist on the server."""
+    body = request.get_json(silent=True) or {}
+    client_files = body.get("files", {}) if isinstance(body, dict) else None
+    if not isinstance(client_files, dict) or not all(isinstance(entry, dict) for entry in client_files.values()):
+        return jsonify({"error": "files must map paths to {sha256, size, mtime} objects"}), 400
+    manifest = build_manifest()
+
+    changed = [name for name, entry in manifest.items() if file_changed(entry, client_files.get(name))]
+    deleted = sorted(set(client_files) - set(manifest))
+    sync_info = json.dumps({"files": manifest, "changed": changed, "deleted": deleted}, indent=2)
+
+    date_str = datetime.now().strftime("%Y-%m-%d")
+    return Response(
+        iter_zip(
+            ((name, os.path.join(PERSISTENT_DIR, name)) for name in changed),
+            extra={SYNC_MANIFEST_NAME: sync_info}
+        ),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=incremental_{date_str}.zip"}
     )
 
 # -------------------------
@@ -849,20 +4009,28 @@ def download_all():
 @app.route("/admin/upload_data", methods=["GET", "POST"])
 @requires_auth
 def upload_data():
-    import zipfile
-
+    """Restore a full or incremental backup ZIP, applying only changed files."""
     if request.method == "POST" and "file" in request.files:
         file = request.files["file"]
         if file.filename.endswith(".zip"):
             # Save to a temporary location
-            temp_path = os.path.join("/tmp", file.filename)
-            file.save(temp_path)
-
-            # Unzip into PERSISTENT_DIR
-            with zipfile.ZipFile(temp_path, "r") as zip_ref:
-                zip_ref.extractall(PERSISTENT_DIR)
-
-            return "Data uploaded and extracted successfully!"
+            fd, temp_path = tempfile.mkstemp(suffix=".zip")
+            os.close(fd)
+            try:
+                file.save(temp_path)
+                summary = apply_restore(temp_path)
+            except ValueError as e:
+                return f"Invalid backup: {html.escape(str(e))}", 400
+            finally:
+                os.remove(temp_path)
+
+            return f"""
+            Data restored successfully!<br>
+            Files restored: {len(summary["restored"])}<br>
+            Files unchanged: {summary["unchanged"]}<br>
+            Files deleted: {len(summary["deleted"])}<br>
+            Entries rejected: {len(summary["rejected"])}
+            """
 
     return '''
     <form method="POST" enctype="multipart/form-data">
@@ -879,97 +4047,965 @@ def upload_data():
 def debug_persistent_dir():
     return f"PERSISTENT_DIR = {PERSISTENT_DIR}"
 
+@app.route("/admin/metrics")
+@requires_auth
+def admin_metrics():
+    """Request, template and SQLite metrics for this worker process, in Prometheus text format."""
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug/db_stats")
+@requires_auth
+def debug_db_stats():
+    """Connection-hold and query timings per database for this worker process."""
+    with _db_stats_lock:
+        return jsonify(DB_STATS)
+
+# -------------------------
+# Storage Ledger
+# -------------------------
+# image_files records the size and format of every original in IMAGE_FOLDER.
+# It is updated wherever files are written or removed (upload, delete,
+# rotate, optimize). Triggers keep storage_totals, the running totals
+# overall, per format, per album and per year, in step with image_files and
+# pictures, so storage stats are read without walking the folder. Album and
+# year totals count picture rows, so a file shared by two albums counts in
+# both; the overall and per-format totals count each file once. The
+# reconcile job re-syncs the ledger with the disk and rebuilds the totals.
+STORAGE_PICTURE_KEYS = {
+    "album": "COALESCE({row}.album, '')",
+    "year": "substr(COALESCE({row}.date_taken, ''), 1, 4)",
+}
+
+def _storage_upsert(dimension, key, count, size, source="WHERE true"):
+    """SQL adding count and size to one storage_totals entry. source selects
+    the rows to add for (the WHERE keeps the upsert unambiguous to parse)."""
+    return f"""
+        INSERT INTO storage_totals (dimension, key, count, bytes)
+        SELECT '{dimension}', {key}, {count}, {size} {source}
+        ON CONFLICT (dimension, key) DO UPDATE
+        SET count = count + excluded.count, bytes = bytes + excluded.bytes;"""
+
+def _picture_storage_sql(row, sign):
+    """Trigger statements adding (sign 1) or removing (sign -1) one pictures row."""
+    size = f"COALESCE((SELECT size FROM image_files WHERE filename = {row}.filename), 0)"
+    return "".join(
+        _storage_upsert(dimension, key.format(row=row), sign, f"{sign} * {size}")
+        for dimension, key in STORAGE_PICTURE_KEYS.items()
+    )
+
+def _file_storage_sql(row, sign):
+    """Trigger statements adding or removing one image_files row: its format and
+    the overall total, plus its size for every picture row that uses it."""
+    statements = _storage_upsert("all", "''", sign, f"{sign} * {row}.size")
+    statements += _storage_upsert("format", f"{row}.format", sign, f"{sign} * {row}.size")
+    for dimension, key in STORAGE_PICTURE_KEYS.items():
+        statements += _storage_upsert(
+            dimension, key.format(row="p"), 0, f"{sign} * {row}.size",
+            f"FROM pictures p WHERE p.filename = {row}.filename"
+        )
+    return statements
+
+def init_storage_ledger():
+    """Create the ledger, its totals and triggers; fill them on first run."""
+    conn = get_db_connection()
+    if not conn.execute("PRAGMA table_info(pictures)").fetchall():
+        conn.close()
+        return  # table not created yet
+    new_ledger = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_files'"
+    ).fetchone()
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS image_files (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            mtime REAL
+        );
+        CREATE TABLE IF NOT EXISTS storage_totals (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        );
+
+        CREATE TRIGGER IF NOT EXISTS image_files_storage_insert AFTER INSERT ON image_files BEGIN
+            {_file_storage_sql("new", 1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS image_files_storage_update AFTER UPDATE OF size, format ON image_files BEGIN
+            {_file_storage_sql("old", -1)}
+            {_file_storage_sql("new", 1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS image_files_storage_delete AFTER DELETE ON image_files BEGIN
+            {_file_storage_sql("old", -1)}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS pictures_storage_insert AFTER INSERT ON pictures BEGIN
+            {_picture_storage_sql("new", 1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS pictures_storage_update AFTER UPDATE OF album, date_taken, filename ON pictures BEGIN
+            {_picture_storage_sql("old", -1)}
+            {_picture_storage_sql("new", 1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS pictures_storage_delete AFTER DELETE ON pictures BEGIN
+            {_picture_storage_sql("old", -1)}
+        END;
+    """)
+    conn.commit()
+    conn.close()
+    if new_ledger:
+        reconcile_storage()
+
+def image_format(filename):
+    """Ledger format key of a file: its lower-case extension, with jpeg folded into jpg."""
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    return "jpg" if ext == "jpeg" else ext or "other"
+
+def record_image_file(conn, filename):
+    """Bring a file's ledger entry in line with the disk. Runs inside the caller's transaction."""
+    path = os.path.join(IMAGE_FOLDER, filename)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        conn.execute("DELETE FROM image_files WHERE filename = ?", (filename,))
+        return
+    conn.execute(
+        """
+        INSERT INTO image_files (filename, size, format, mtime) VALUES (?, ?, ?, ?)
+        ON CONFLICT (filename) DO UPDATE SET size = excluded.size, format = excluded.format, mtime = excluded.mtime
+        """,
+        (filename, stat.st_size, image_format(filename), stat.st_mtime)
+    )
+
+def rebuild_storage_totals(conn):
+    """Recompute storage_totals from image_files and pictures."""
+    conn.execute("DELETE FROM storage_totals")
+    conn.execute(
+        "INSERT INTO storage_totals SELECT 'all', '', COUNT(*), COALESCE(SUM(size), 0) FROM image_files"
+    )
+    conn.execute(
+        "INSERT INTO storage_totals SELECT 'format', format, COUNT(*), SUM(size) FROM image_files GROUP BY format"
+    )
+    for dimension, key in STORAGE_PICTURE_KEYS.items():
+        conn.execute(
+            f"""
+            INSERT INTO storage_totals
+            SELECT '{dimension}', {key.format(row="p")}, COUNT(*), COALESCE(SUM(f.size), 0)
+            FROM pictures p LEFT JOIN image_files f ON f.filename = p.filename
+            GROUP BY 2
+            """
+        )
+
+def reconcile_storage(delete_orphans=False):
+    """Compare IMAGE_FOLDER with the ledger and pictures.db. Ledger entries
+    are corrected and the totals rebuilt. Returns a report listing orphaned
+    files (on disk, used by no picture) and missing files (used by a picture,
+    not on disk); orphans are deleted when asked to."""
+    on_disk = {
+        entry.name: entry.stat()
+        for entry in os.scandir(IMAGE_FOLDER)
+        if entry.is_file() and not entry.name.startswith(".")
+    }
+
+    conn = get_db_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    ledger = {
+        row["filename"]: (row["size"], row["mtime"])
+        for row in conn.execute("SELECT filename, size, mtime FROM image_files")
+    }
+    referenced = {row["filename"] for row in conn.execute("SELECT DISTINCT filename FROM pictures")}
+
+    orphaned = sorted(set(on_disk) - referenced)
+    missing = sorted(referenced - set(on_disk))
+    if delete_orphans:
+        for filename in orphaned:
+            remove_picture_file(conn, filename)
+            on_disk.pop(filename)
+            ledger.pop(filename, None)
+
+    corrected = 0
+    for filename in set(on_disk) | set(ledger):
+        stat = on_disk.get(filename)
+        if ledger.get(filename) != (stat and (stat.st_size, stat.st_mtime)):
+            record_image_file(conn, filename)
+            corrected += 1
+    rebuild_storage_totals(conn)
+    conn.commit()
+    if delete_orphans:
+        for filename in orphaned:
+            delete_picture_file(conn, filename)
+    conn.close()
+
+    return {
+        "files": len(on_disk),
+        "ledger_corrected": corrected,
+        "orphaned": orphaned,
+        "missing": missing,
+        "orphans_deleted": delete_orphans,
+    }
+
+@app.cli.command("reconcile-storage")
+@click.option("--delete-orphans", is_flag=True, help="Delete files that no picture uses.")
+def reconcile_storage_command(delete_orphans):
+    """Re-sync the storage ledger with IMAGE_FOLDER and report orphaned and missing files."""
+    report = reconcile_storage(delete_orphans)
+    click.echo(f"{report['files']} files, {report['ledger_corrected']} ledger entries corrected")
+    for label in ("orphaned", "missing"):
+        click.echo(f"{label.capitalize()} ({len(report[label])}): {', '.join(report[label]) or '-'}")
+
+def storage_metrics():
+    """Storage totals from the ledger plus the real usage of the data volume."""
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT dimension, key, count, bytes FROM storage_totals WHERE count != 0 OR bytes != 0"
+    ).fetchall()
+    conn.close()
+
+    metrics = {"files": 0, "bytes": 0, "by_format": {}, "by_album": {}, "by_year": {}}
+    for row in rows:
+        if row["dimension"] == "all":
+            metrics.update(files=row["count"], bytes=row["bytes"])
+        else:
+            metrics[f"by_{row['dimension']}"][row["key"]] = {"count": row["count"], "bytes": row["bytes"]}
+
+    disk = shutil.disk_usage(PERSISTENT_DIR)
+    metrics["disk"] = {"total": disk.total, "used": disk.used, "free": disk.free}
+    metrics["average_bytes"] = metrics["bytes"] // metrics["files"] if metrics["files"] else 0
+    metrics["estimated_additional_images"] = disk.free // metrics["average_bytes"] if metrics["average_bytes"] else 0
+    return metrics
+
+init_storage_ledger()
+
+@app.route("/admin/storage/metrics")
+@requires_auth
+def storage_metrics_json():
+    """Storage totals and free space as JSON, for monitoring."""
+    return jsonify(storage_metrics())
+
+@app.route("/admin/storage/reconcile", methods=["POST"])
+@requires_auth
+def storage_reconcile():
+    """Run the reconcile job; ?delete_orphans=1 also removes unused files."""
+    return jsonify(reconcile_storage(request.args.get("delete_orphans") == "1"))
+
 # -------------------------
 # Check size of image file
 # -------------------------
 @app.route("/image_space")
 @requires_auth
 def image_space():
-    import os
+    metrics = storage_metrics()
+    mb = 1024 * 1024
+    albums = "".join(
+        f"<li>{html.escape(album or '(no album)')}: {entry['count']} pictures, {entry['bytes'] / mb:.2f} MB</li>"
+        for album, entry in sorted(metrics["by_album"].items())
+    )
 
-    IMAGE_FOLDER = os.path.join(PERSISTENT_DIR, "images")
-    DISK_LIMIT_MB = 1024  # 1 GB
+    return f"""
+    <h2>Image Storage Info</h2>
+    <p>Total images: {metrics['files']}</p>
+    <p>Total size: {metrics['bytes'] / mb:.2f} MB</p>
+    <p>Average image size: {metrics['average_bytes'] / mb:.2f} MB</p>
+    <p>Remaining space: {metrics['disk']['free'] / mb:.2f} MB of {metrics['disk']['total'] / mb:.2f} MB</p>
+    <p>Estimated additional images you can add: {metrics['estimated_additional_images']}</p>
+    <h3>By album</h3>
+    <ul>{albums}</ul>
+    """
 
-    total_size = 0
-    image_count = 0
+# -------------------------
+# Image Optimization Jobs
+# -------------------------
+# Optimization runs in a process pool in the background. Every optimized file is
+# recorded with its content hash and the settings used, so files that have not
+# changed since their last optimization are skipped instead of re-compressed.
+# The pool spawns fresh interpreters rather than forking the threaded web
+# worker, and done-callbacks (which run on the pool's management thread) hand
+# any database writes to a single writer thread.
+OPTIMIZE_SETTINGS = {"max_dim": 1920, "quality": 85}
+OPTIMIZE_WORKERS = int(os.getenv("OPTIMIZE_WORKERS", os.cpu_count() or 1))
+OPTIMIZE_STALE_SECONDS = 600  # a "running" job with no progress for this long is treated as dead
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+_db_writes = queue.Queue()
+_db_writer = None
+
+def get_process_pool():
+    """Return the shared process pool used for Pillow work, creating it on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=OPTIMIZE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+def warm_process_pool():
+    """Start the pool's interpreters now instead of on the first upload or
+    precompress, so no request waits for them (gunicorn.conf.py calls this
+    once per worker)."""
+    pool = get_process_pool()
+    for future in [pool.submit(os.getpid) for _ in range(OPTIMIZE_WORKERS)]:
+        future.result()
+
+def _run_db_writes():
+    """Writer thread: run queued database writes one at a time."""
+    while True:
+        func, args = _db_writes.get()
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Background write {func.__name__} failed: {e}")
+
+def queue_db_write(func, *args):
+    """Run func(*args) on the writer thread, starting it on first use."""
+    global _db_writer
+    with _process_pool_lock:
+        if _db_writer is None:
+            _db_writer = threading.Thread(target=_run_db_writes, name="db-writer", daemon=True)
+            _db_writer.start()
+    _db_writes.put((func, args))
+
+def init_optimize_tables():
+    """Create the optimization manifest and job tables in pictures.db if missing."""
+    conn = sqlite3.connect(DB_NAME)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS image_optimizations (
+            filename TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            settings TEXT NOT NULL,
+            original_size INTEGER,
+            optimized_size INTEGER,
+            optimized_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS optimize_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            optimized INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            bytes_saved INTEGER DEFAULT 0,
+            started_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        );
+    """)
+    conn.close()
 
-    for root, dirs, files in os.walk(IMAGE_FOLDER):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if os.path.isfile(file_path):
-                total_size += os.path.getsize(file_path)
-                image_count += 1
+init_optimize_tables()
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def optimize_image_file(filename, known_hash, settings):
+    """Optimize a single image in IMAGE_FOLDER (runs inside the process pool).
+    The result is written to a temp file and renamed over the original, and
+    is only kept when it is actually smaller. Returns a result dict."""
+    file_path = os.path.join(IMAGE_FOLDER, filename)
+    original_hash = file_sha256(file_path)
+    original_size = os.path.getsize(file_path)
+    result = {"filename": filename, "original_size": original_size, "optimized_size": original_size}
+
+    if original_hash == known_hash:
+        result.update(status="skipped", content_hash=original_hash)
+        return result
+
+    fd, tmp_path = tempfile.mkstemp(dir=IMAGE_FOLDER, prefix=f".{filename}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        with Image.open(file_path) as img:
+            # Apply EXIF orientation to the pixels so the tag can be dropped
+            img = ImageOps.exif_transpose(img)
 
-    total_size_mb = total_size / (1024 * 1024)
-    avg_size_mb = total_size_mb / image_count if image_count else 0
-    remaining_mb = DISK_LIMIT_MB - total_size_mb
-    est_additional_images = int(remaining_mb / avg_size_mb) if avg_size_mb else 0
+            # Resize if larger than max_dim width or height
+            max_dim = settings["max_dim"]
+            if img.width > max_dim or img.height > max_dim:
+                img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+            width, height = img.size
 
-    return f"""
-    <h2>Image Storage Info</h2>
-    <p>Total images: {image_count}</p>
-    <p>Total size: {total_size_mb:.2f} MB</p>
-    <p>Average image size: {avg_size_mb:.2f} MB</p>
-    <p>Remaining space: {remaining_mb:.2f} MB</p>
-    <p>Estimated additional images you can add: {est_additional_images}</p>
-    """
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                # Preserve PNG with transparency
+                ext = os.path.splitext(filename)[1].lower()
+                img.save(tmp_path, format=Image.registered_extensions().get(ext, "PNG"), optimize=True)
+            else:
+                img = img.convert("RGB")  # Ensure JPEG-compatible
+                img.save(tmp_path, format="JPEG", quality=settings["quality"], optimize=True)
+
+        new_size = os.path.getsize(tmp_path)
+        if new_size >= original_size:
+            # Re-encoding would not help; keep the original bytes untouched
+            os.remove(tmp_path)
+            result.update(status="skipped", content_hash=original_hash)
+            return result
+
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    refresh_derivatives(filename)
+    result.update(
+        status="optimized", content_hash=file_sha256(file_path), optimized_size=new_size,
+        width=width, height=height
+    )
+    return result
 
-@app.route("/image_optimize")
-@requires_auth
-def image_optimize():
-    optimized_count = 0
-    optimized_bytes_saved = 0
+def _update_job(conn, job_id, **fields):
+    """Write progress fields for an optimize job and bump its heartbeat."""
+    fields["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    columns = ", ".join(f"{key} = ?" for key in fields)
+    conn.execute(f"UPDATE optimize_jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    conn.commit()
+
+def record_optimization(conn, result, settings_key):
+    """Store an optimize result in the manifest so unchanged files are skipped
+    next time, its new size in the storage ledger and, when the image was
+    re-encoded, its new dimensions and hash on the pictures using it."""
+    record_image_file(conn, result["filename"])
+    if result["status"] == "optimized":
+        conn.execute(
+            "UPDATE pictures SET width = ?, height = ?, content_hash = ? WHERE filename = ?",
+            (result["width"], result["height"], result["content_hash"], result["filename"])
+        )
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO image_optimizations
+        (filename, content_hash, settings, original_size, optimized_size, optimized_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (result["filename"], result["content_hash"], settings_key, result["original_size"],
+         result["optimized_size"], datetime.now().isoformat(timespec="seconds"))
+    )
 
-    for filename in os.listdir(IMAGE_FOLDER):
-        file_path = os.path.join(IMAGE_FOLDER, filename)
+def run_optimize_job(job_id):
+    """Fan the images out to the process pool and record progress as results arrive."""
+    conn = get_db_connection()
+    settings_key = json.dumps(OPTIMIZE_SETTINGS, sort_keys=True)
+    known = {
+        row["filename"]: row["content_hash"]
+        for row in conn.execute("SELECT filename, content_hash FROM image_optimizations WHERE settings = ?", (settings_key,))
+    }
+    # Content-addressed uploads keep their uploaded bytes, so their name stays
+    # their hash; only legacy files are re-encoded in place
+    addressed = {
+        row["filename"]
+        for row in conn.execute("SELECT DISTINCT filename, content_hash FROM pictures WHERE content_hash IS NOT NULL")
+        if is_content_addressed(row["filename"], row["content_hash"])
+    }
+    filenames = [
+        name for name in sorted(os.listdir(IMAGE_FOLDER))
+        if not name.startswith(".") and name not in addressed
+        and os.path.isfile(os.path.join(IMAGE_FOLDER, name))
+    ]
+    _update_job(conn, job_id, total=len(filenames))
+
+    counts = {"processed": 0, "optimized": 0, "skipped": 0, "failed": 0, "bytes_saved": 0}
+    pool = get_process_pool()
+    futures = {
+        pool.submit(optimize_image_file, name, known.get(name), OPTIMIZE_SETTINGS): name
+        for name in filenames
+    }
+    for future in as_completed(futures):
+        counts["processed"] += 1
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Skipping {futures[future]}: {e}")
+            counts["failed"] += 1
+        else:
+            counts[result["status"]] += 1
+            counts["bytes_saved"] += result["original_size"] - result["optimized_size"]
+            record_optimization(conn, result, settings_key)
+        _update_job(conn, job_id, **counts)
+
+    _update_job(conn, job_id, status="finished", finished_at=datetime.now().isoformat(timespec="seconds"))
+    conn.close()
 
-        if not os.path.isfile(file_path):
-            continue
+def _run_optimize_job_safely(job_id):
+    """Thread entry point: mark the job as failed instead of leaving it running."""
+    try:
+        run_optimize_job(job_id)
+    except Exception as e:
+        print(f"Optimize job {job_id} failed: {e}")
+        conn = get_db_connection()
+        _update_job(conn, job_id, status="failed", finished_at=datetime.now().isoformat(timespec="seconds"))
+        conn.close()
+
+def start_optimize_job():
+    """Start a background optimize job unless one is already running. Returns the job id."""
+    conn = get_db_connection()
+    # Check and insert under the write lock so two workers cannot both start a job
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        now = datetime.now().isoformat(timespec="seconds")
+        running = conn.execute(
+            "SELECT id, updated_at FROM optimize_jobs WHERE status = 'running' ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if running:
+            age = datetime.now() - datetime.fromisoformat(running["updated_at"])
+            if age.total_seconds() < OPTIMIZE_STALE_SECONDS:
+                conn.rollback()
+                return running["id"]
+            conn.execute(
+                "UPDATE optimize_jobs SET status = 'failed', updated_at = ? WHERE id = ?", (now, running["id"])
+            )
+
+        cur = conn.execute(
+            "INSERT INTO optimize_jobs (status, started_at, updated_at) VALUES ('running', ?, ?)", (now, now)
+        )
+        conn.commit()
+        job_id = cur.lastrowid
+    finally:
+        conn.close()
+
+    threading.Thread(target=_run_optimize_job_safely, args=(job_id,), daemon=True).start()
+    return job_id
+
+# -------------------------
+# Picture Uploads
+# -------------------------
+# Uploads are content-addressed: the bytes are hashed while they stream to
+# disk and the file is named after the hash, so the same photo uploaded twice
+# is stored once. Several pictures rows may share a file; it is removed with
+# the last row that uses it. The original is never rewritten, so its name and
+# content_hash stay true; oriented, resized copies are built as derivatives
+# in the process pool after the upload request has returned.
+UPLOAD_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def init_picture_uploads():
+    """Add the content_hash column to pictures and hash rows stored before it existed."""
+    conn = get_db_connection()
+    try:
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(pictures)")}
+        if "content_hash" not in columns:
+            conn.execute("ALTER TABLE pictures ADD COLUMN content_hash TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pictures_content_hash ON pictures (content_hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pictures_filename ON pictures (filename)")
+        unhashed = conn.execute(
+            "SELECT DISTINCT filename FROM pictures WHERE content_hash IS NULL"
+        ).fetchall()
+        for row in unhashed:
+            path = os.path.join(IMAGE_FOLDER, row["filename"])
+            if os.path.isfile(path):
+                conn.execute(
+                    "UPDATE pictures SET content_hash = ? WHERE filename = ? AND content_hash IS NULL",
+                    (file_sha256(path), row["filename"])
+                )
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass  # table not created yet
+    conn.close()
+
+init_picture_uploads()
+
+def stream_to_temp(file, folder):
+    """Copy an uploaded file to a temp file in folder, hashing it on the way.
+    Returns (temp path, hex SHA-256)."""
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
+
+def store_picture(conn, file, title, description, date_taken, album):
+    """Store one uploaded picture and insert its row.
+    Returns (status, filename): "added" for new bytes, "shared" when the file
+    was already stored, or "duplicate" when the album already has the photo."""
+    ext = os.path.splitext(file.filename)[1].lower()
+    tmp_path, content_hash = stream_to_temp(file, IMAGE_FOLDER)
+    try:
+        # Read EXIF from the upload itself: derivatives are re-encoded without it
+        metadata = read_photo_metadata(tmp_path, file.filename)
+        if not date_taken and metadata["captured_at"]:
+            date_taken = metadata["captured_at"][:10]
+
+        # Hold the write lock so a concurrent delete cannot remove the file we reuse
+        conn.execute("BEGIN IMMEDIATE")
+        existing = conn.execute(
+            "SELECT id, filename, album FROM pictures WHERE content_hash = ?", (content_hash,)
+        ).fetchall()
+        if any((row["album"] or "") == album for row in existing):
+            conn.rollback()
+            return "duplicate", existing[0]["filename"]
+
+        if existing and os.path.isfile(os.path.join(IMAGE_FOLDER, existing[0]["filename"])):
+            filename, status = existing[0]["filename"], "shared"
+        else:
+            filename, status = content_hash[:16] + ext, "added"
+            os.replace(tmp_path, os.path.join(IMAGE_FOLDER, filename))
+            record_image_file(conn, filename)
+
+        conn.execute(
+            f"""
+            INSERT INTO pictures (title, description, filename, date_taken, album, content_hash,
+                                  {", ".join(PHOTO_METADATA_COLUMNS)}, metadata_at)
+            VALUES (?, ?, ?, ?, ?, ?, {", ".join("?" for _ in PHOTO_METADATA_COLUMNS)}, ?)
+            """,
+            (title, description, filename, date_taken, album, content_hash,
+             *(metadata[column] for column in PHOTO_METADATA_COLUMNS), datetime.now().isoformat(timespec="seconds"))
+        )
+        conn.commit()
+        return status, filename
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def is_content_addressed(filename, content_hash):
+    """True when a stored file is named after its content hash."""
+    return bool(content_hash) and os.path.splitext(filename)[0] == content_hash[:16]
+
+def _record_upload(filename, future):
+    """Done-callback for generate_derivatives: log failures, let pages pick up the new sizes."""
+    try:
+        future.result()
+    except Exception as e:
+        print(f"Could not process upload {filename}: {e}")
+        return
+    queue_db_write(bump_source_version, "pictures")
+
+def queue_upload_processing(filename):
+    """Build the derivatives of a stored upload in the process pool without waiting for it."""
+    future = get_process_pool().submit(generate_derivatives, filename)
+    future.add_done_callback(lambda f: _record_upload(filename, f))
+
+def remove_picture_file(conn, filename):
+    """Drop the manifest and ledger entries of a file no pictures row uses any
+    more. Runs inside the caller's transaction; once it has committed, call
+    delete_picture_file() to remove the file itself. Returns False if a
+    pictures row still uses the file."""
+    if conn.execute("SELECT 1 FROM pictures WHERE filename = ? LIMIT 1", (filename,)).fetchone():
+        return False
+    conn.execute("DELETE FROM image_optimizations WHERE filename = ?", (filename,))
+    conn.execute("DELETE FROM image_files WHERE filename = ?", (filename,))
+    return True
+
+def delete_picture_file(conn, filename):
+    """Delete an original and its derivatives after remove_picture_file() has
+    committed. The write lock keeps an upload of the same bytes from reusing
+    the file between the check and the delete."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM pictures WHERE filename = ? LIMIT 1", (filename,)).fetchone():
+            return False  # uploaded again since the commit
+        image_path = os.path.join(IMAGE_FOLDER, filename)
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        invalidate_derivatives(filename)
+        return True
+    finally:
+        conn.commit()
+
+# -------------------------
+# Photo Metadata
+# -------------------------
+# Capture time, GPS position, camera and dimensions are read from EXIF once
+# (on upload, or by the extract-photo-metadata backfill) and kept in indexed
+# columns with an R-tree over the positions, so the maps can show photos
+# without opening image files. Photos without an EXIF date fall back to a
+# date in the file name, e.g. 20250928_102630.jpg.
+PHOTO_METADATA_COLUMNS = ("captured_at", "lat", "lon", "camera", "width", "height")
+PHOTOS_API_LIMIT = 500
+FILENAME_DATE = re.compile(r"(?<!\d)(\d{8})[_-]?(\d{6})(?!\d)")
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+EXIF_MAKE, EXIF_MODEL, EXIF_ORIENTATION, EXIF_DATETIME = 271, 272, 274, 306
+EXIF_DATETIME_ORIGINAL, EXIF_DATETIME_DIGITIZED = 36867, 36868
+
+def init_photo_metadata():
+    """Add the metadata columns, their indexes and the geotag R-tree to pictures.db."""
+    conn = get_db_connection()
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(pictures)")}
+    if not columns:
+        conn.close()
+        return  # table not created yet
+    for column, kind in (("captured_at", "TEXT"), ("lat", "REAL"), ("lon", "REAL"), ("camera", "TEXT"),
+                         ("width", "INTEGER"), ("height", "INTEGER"), ("metadata_at", "TEXT")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE pictures ADD COLUMN {column} {kind}")
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_pictures_captured_at ON pictures (captured_at);
+        CREATE INDEX IF NOT EXISTS idx_pictures_unread ON pictures (id) WHERE metadata_at IS NULL;
+        CREATE VIRTUAL TABLE IF NOT EXISTS pictures_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+
+        CREATE TRIGGER IF NOT EXISTS pictures_geo_insert AFTER INSERT ON pictures
+        WHEN new.lat IS NOT NULL AND new.lon IS NOT NULL BEGIN
+            INSERT INTO pictures_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+        END;
+        CREATE TRIGGER IF NOT EXISTS pictures_geo_update AFTER UPDATE OF lat, lon ON pictures BEGIN
+            DELETE FROM pictures_rtree WHERE id = old.id;
+            INSERT INTO pictures_rtree
+            SELECT new.id, new.lon, new.lon, new.lat, new.lat WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL;
+        END;
+        CREATE TRIGGER IF NOT EXISTS pictures_geo_delete AFTER DELETE ON pictures BEGIN
+            DELETE FROM pictures_rtree WHERE id = old.id;
+        END;
+    """)
+    conn.commit()
+    conn.close()
+
+init_photo_metadata()
+# Last of the module-level init_* calls: the tables its triggers watch
+# (pictures, image_files, image_optimizations, posts) all exist by now
+init_source_versions()
+# Snapshots are only rewritten by write paths; catch up on anything they
+# missed, such as the first import into the feature store. Pool workers
+# import this module too and leave it to the process that serves requests.
+if multiprocessing.parent_process() is None:
+    for _layer in FEATURE_LAYERS:
+        export_layer(_layer)
+
+def exif_degrees(value, ref):
+    """Convert an EXIF (degrees, minutes, seconds) triple and its N/S/E/W ref to a float."""
+    degrees, minutes, seconds = (float(part) for part in value)
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if str(ref).upper() in ("S", "W") else result
+
+def parse_exif_datetime(value):
+    """EXIF writes "2025:09:28 10:26:30"; return ISO format or None."""
+    try:
+        return datetime.strptime(str(value).strip("\x00 ")[:19], "%Y:%m:%d %H:%M:%S").isoformat()
+    except ValueError:
+        return None
+
+def filename_datetime(*names):
+    """Return the capture time encoded in a file name like 20250928_102630.jpg, or None."""
+    for name in names:
+        match = FILENAME_DATE.search(name or "")
+        if match:
+            try:
+                return datetime.strptime("".join(match.groups()), "%Y%m%d%H%M%S").isoformat()
+            except ValueError:
+                continue
+    return None
 
+def read_photo_metadata(path, *names):
+    """Read capture time, GPS, camera and oriented dimensions from an image.
+    Only the file header is parsed; pixels are not decoded. names are file
+    names to take the date from when EXIF has none."""
+    metadata = dict.fromkeys(PHOTO_METADATA_COLUMNS)
+    try:
+        with Image.open(path) as img:
+            metadata["width"], metadata["height"] = img.size
+            exif = img.getexif()
+    except Exception as e:
+        print(f"Could not read metadata from {path}: {e}")
+        exif = {}
+
+    if exif:
+        if exif.get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            # Rotated a quarter turn: the displayed image is height x width
+            metadata["width"], metadata["height"] = metadata["height"], metadata["width"]
+
+        details = exif.get_ifd(EXIF_IFD)
+        for value in (details.get(EXIF_DATETIME_ORIGINAL), details.get(EXIF_DATETIME_DIGITIZED), exif.get(EXIF_DATETIME)):
+            metadata["captured_at"] = value and parse_exif_datetime(value)
+            if metadata["captured_at"]:
+                break
+
+        make = str(exif.get(EXIF_MAKE) or "").strip("\x00 ")
+        model = str(exif.get(EXIF_MODEL) or "").strip("\x00 ")
+        camera = model if model.lower().startswith(make.lower()) else f"{make} {model}".strip()
+        metadata["camera"] = camera or None
+
+        gps = exif.get_ifd(GPS_IFD)
         try:
-            with Image.open(file_path) as img:
-                original_size = os.path.getsize(file_path)
+            lat = exif_degrees(gps[2], gps.get(1, "N"))
+            lon = exif_degrees(gps[4], gps.get(3, "E"))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            pass
+        else:
+            # Cameras without a fix sometimes write 0,0
+            if -90 <= lat <= 90 and -180 <= lon <= 180 and (lat, lon) != (0.0, 0.0):
+                metadata["lat"], metadata["lon"] = round(lat, 6), round(lon, 6)
+
+    if not metadata["captured_at"]:
+        metadata["captured_at"] = filename_datetime(*names)
+    return metadata
+
+def _read_picture_metadata(filename, title):
+    """Process pool entry point for the backfill."""
+    return filename, read_photo_metadata(os.path.join(IMAGE_FOLDER, filename), filename, title)
+
+@app.cli.command("extract-photo-metadata")
+@click.option("--all", "reread", is_flag=True, help="Re-read pictures that already have metadata.")
+def extract_photo_metadata_command(reread):
+    """Read EXIF metadata for pictures in parallel and fill blank dates.
+    Values the file no longer has (legacy files re-encoded by the optimize job lose EXIF) are kept."""
+    conn = get_db_connection()
+    where = "" if reread else "WHERE metadata_at IS NULL"
+    rows = conn.execute(f"SELECT filename, MIN(title) AS title FROM pictures {where} GROUP BY filename").fetchall()
+    rows = [row for row in rows if os.path.isfile(os.path.join(IMAGE_FOLDER, row["filename"]))]
+
+    start = time.perf_counter()
+    pool = get_process_pool()
+    futures = [pool.submit(_read_picture_metadata, row["filename"], row["title"]) for row in rows]
+    located = 0
+    for future in as_completed(futures):
+        filename, metadata = future.result()
+        located += metadata["lat"] is not None
+        conn.execute(
+            f"""
+            UPDATE pictures SET {", ".join(f"{column} = COALESCE(?, {column})" for column in PHOTO_METADATA_COLUMNS)}, metadata_at = ?,
+                date_taken = COALESCE(NULLIF(date_taken, ''), ?)
+            WHERE filename = ?
+            """,
+            (*(metadata[column] for column in PHOTO_METADATA_COLUMNS), datetime.now().isoformat(timespec="seconds"),
+             metadata["captured_at"] and metadata["captured_at"][:10], filename)
+        )
+    conn.commit()
+    conn.close()
+    click.echo(f"Read {len(rows)} files ({located} geotagged) in {time.perf_counter() - start:.2f}s")
+
+def ledger_version(size, mtime):
+    """Version token for an original from its storage ledger entry. Rotating or
+    re-encoding a file changes its mtime, and its derivatives are rebuilt with it."""
+    if size is None:
+        return None
+    return f"{size:x}-{round((mtime or 0) * 1e6):x}"
+
+def photo_row_dict(row):
+    """Convert a geotagged pictures row into a GeoJSON Feature for the maps.
+    Built from the row alone; no image file is touched."""
+    return {
+        "type": "Feature",
+        "id": row["id"],
+        "geometry": {"type": "Point", "coordinates": [row["lon"], row["lat"]]},
+        "properties": {
+            "title": row["title"],
+            "date": row["date_taken"],
+            "captured_at": row["captured_at"],
+            "camera": row["camera"],
+            "width": row["width"],
+            "height": row["height"],
+            "thumbnail": url_for("photo_thumbnail", filename=row["filename"], v=ledger_version(row["file_size"], row["file_mtime"])),
+            "url": url_for("pictures", cursor=start_cursor(row["date_taken"], row["id"]), _anchor=f"picture-{row['id']}")
+        }
+    }
 
-                # Apply EXIF orientation if present, then remove EXIF orientation tag
-                try:
-                    exif = img.getexif()
-                    orientation = exif.get(274)  # 274 is the EXIF orientation tag
-                    if orientation == 3:
-                        img = img.rotate(180, expand=True)
-                    elif orientation == 6:
-                        img = img.rotate(270, expand=True)
-                    elif orientation == 8:
-                        img = img.rotate(90, expand=True)
-                    # Remove orientation to prevent re-rotation
-                    if exif is not None:
-                        exif[274] = 1
-                except Exception:
-                    pass  # No EXIF or cannot read it
-
-                # Resize if larger than 1920px width or height
-                max_dim = 1920
-                if img.width > max_dim or img.height > max_dim:
-                    img.thumbnail((max_dim, max_dim), Image.LANCZOS)
-
-                # Overwrite with optimized JPEG/PNG
-                if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-                    # Preserve PNG with transparency
-                    img.save(file_path, optimize=True)
-                else:
-                    img = img.convert("RGB")  # Ensure JPEG-compatible
-                    img.save(file_path, format="JPEG", quality=85, optimize=True)
+def query_photos(boxes, limit):
+    """Return geotagged pictures rows, newest first, limited to the boxes when given."""
+    conn = get_db_connection()
+    columns = (
+        "p.id, p.title, p.filename, p.date_taken, p.captured_at, p.camera, p.width, p.height, p.lat, p.lon, "
+        "f.size AS file_size, f.mtime AS file_mtime"
+    )
+    if boxes is None:
+        rows = conn.execute(
+            f"""
+            SELECT {columns} FROM pictures p
+            JOIN pictures_rtree r ON r.id = p.id
+            LEFT JOIN image_files f ON f.filename = p.filename
+            ORDER BY p.captured_at DESC LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+    else:
+        rows = []
+        for west, south, east, north in boxes:
+            rows += conn.execute(
+                f"""
+                SELECT {columns} FROM pictures p
+                JOIN pictures_rtree r ON r.id = p.id
+                LEFT JOIN image_files f ON f.filename = p.filename
+                WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+                ORDER BY p.captured_at DESC LIMIT ?
+                """,
+                (west, east, south, north, limit)
+            ).fetchall()
+        # The R-tree stores 32-bit floats, so trim to the exact box
+        rows = [row for row in rows if point_in_boxes(row["lon"], row["lat"], boxes)]
+        rows.sort(key=lambda row: row["captured_at"] or "", reverse=True)
+    conn.close()
+    return rows[:limit]
+
+@app.route("/image_optimize")
+@requires_auth
+def image_optimize():
+    """Start (or join) a background optimization job and show its progress."""
+    job_id = start_optimize_job()
+    status_url = url_for("image_optimize_status", job_id=job_id)
+    return f"""
+    <h2>Image Optimization Job #{job_id}</h2>
+    <p id="progress">Starting...</p>
+    <script>
+      async function poll() {{
+        const job = await (await fetch("{status_url}")).json();
+        document.getElementById("progress").innerHTML =
+          `Status: ${{job.status}}<br>` +
+          `Processed: ${{job.processed}} / ${{job.total}}<br>` +
+          `Optimized: ${{job.optimized}}, skipped: ${{job.skipped}}, failed: ${{job.failed}}<br>` +
+          `Approximate bytes saved: ${{(job.bytes_saved / 1024).toFixed(2)}} KB`;
+        if (job.status === "running") setTimeout(poll, 1000);
+      }}
+      poll();
+    </script>
+    """
 
-                new_size = os.path.getsize(file_path)
-                optimized_bytes_saved += (original_size - new_size)
-                optimized_count += 1
+@app.route("/image_optimize/status/<int:job_id>")
+@requires_auth
+def image_optimize_status(job_id):
+    """Return the progress of an optimize job as JSON."""
+    conn = get_db_connection()
+    job = conn.execute("SELECT * FROM optimize_jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(dict(job))
 
+@app.route("/admin/pictures/derivatives")
+@requires_auth
+def backfill_derivatives():
+    """Generate any missing gallery derivatives for existing pictures."""
+    conn = get_db_connection()
+    widths = {
+        row["filename"]: row["width"]
+        for row in conn.execute("SELECT filename, MAX(width) AS width FROM pictures GROUP BY filename")
+    }
+
+    generated = 0
+    failed = 0
+    for filename, width in widths.items():
+        path = os.path.join(IMAGE_FOLDER, filename)
+        if not os.path.isfile(path):
+            continue
+        if width is None:
+            # Record the dimensions once so later runs can skip small originals unopened
+            metadata = read_photo_metadata(path)
+            width = metadata["width"]
+            conn.execute(
+                "UPDATE pictures SET width = COALESCE(width, ?), height = COALESCE(height, ?) WHERE filename = ?",
+                (width, metadata["height"], filename)
+            )
+            conn.commit()
+        try:
+            generated += generate_derivatives(filename, source_width=width)
         except Exception as e:
+            failed += 1
             print(f"Skipping {filename}: {e}")
+    conn.close()
+    if generated:
+        bump_source_version("pictures")
 
     return f"""
-    Image Optimization Complete!<br>
-    Total images processed: {optimized_count}<br>
-    Approximate bytes saved: {optimized_bytes_saved / 1024:.2f} KB
+    Derivative Backfill Complete!<br>
+    Pictures checked: {len(widths)}<br>
+    Derivatives generated: {generated}<br>
+    Failures: {failed}
     """
 
 # -------------------------
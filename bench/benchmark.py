@@ -0,0 +1,437 @@
+"""
+Benchmark and load test for the public and admin routes.
+
+Seeds synthetic data at multiples of today's dataset into a temporary
+PERSISTENT_DIR, then times the main routes through the Flask test client
+and through a local gunicorn. Reports p50/p99 latency, throughput and peak
+RSS, and exits non-zero when a result regresses against the stored
+baseline.
+
+    python bench/benchmark.py                      # 1x and 100x, compare to baseline
+    python bench/benchmark.py --scales 1,100,10000 # add the 10,000x dataset (slow)
+    python bench/benchmark.py --update-baseline    # record this machine's numbers
+
+Baselines are only comparable on the machine that recorded them.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+
+# Today's dataset (data/ in the repo); scales multiply these
+BASE_COUNTS = {"pictures": 138, "blog": 23, "updates": 1, "food": 3, "cities": 13, "mountains": 4}
+MAX_IMAGES = 2000  # image files are shared by picture rows above this many
+IMAGE_SIZE = (800, 600)
+
+ADMIN_USERNAME = "bench"
+ADMIN_PASSWORD = "bench"
+
+# name -> (method, path, timed requests through the test client)
+CLIENT_ROUTES = {
+    "GET /pictures": ("GET", "/pictures", 50),
+    "GET /blog": ("GET", "/blog", 50),
+    "GET /site_updates": ("GET", "/site_updates", 50),
+    "GET /api/food": ("GET", "/api/food", 50),
+    "GET /data/cities.geojson": ("GET", "/data/cities.geojson", 50),
+    "POST /admin/geojson": ("POST", "/admin/geojson", 20),
+    "GET /download": ("GET", "/download", 3),
+}
+# Routes the gunicorn load test drives, with total requests and concurrency
+SERVER_ROUTES = ("GET /pictures", "GET /blog", "GET /site_updates", "GET /api/food", "GET /data/cities.geojson")
+SERVER_REQUESTS = 200
+SERVER_CONCURRENCY = 8
+SERVER_WORKERS = 2
+
+# A result regresses when it is worse than the baseline by more than the
+# tolerance; latency differences under LATENCY_FLOOR_MS are ignored as noise
+DEFAULT_TOLERANCE = 0.5
+LATENCY_FLOOR_MS = 2.0
+
+# -------------------------
+# Seeding
+# -------------------------
+SCHEMA = {
+    "pictures.db": """
+        CREATE TABLE pictures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            filename TEXT NOT NULL,
+            date_taken TEXT,
+            album TEXT
+        );
+    """,
+    "blog.db": """
+        CREATE TABLE posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            location TEXT,
+            date TEXT
+        );
+    """,
+    "site_update.db": """
+        CREATE TABLE posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            images TEXT,
+            location TEXT,
+            date TEXT
+        );
+    """,
+    "food_map.db": """
+        CREATE TABLE food_locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            cuisine TEXT NOT NULL,
+            rating REAL NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            desc TEXT,
+            link TEXT
+        );
+    """,
+}
+
+WORDS = ("mountain lake ridge summit valley market noodle temple river trail harbour "
+         "sunrise desert glacier forest village street canyon island bridge").split()
+CUISINES = ("Thai", "Mongolian", "Italian", "Japanese", "Mexican", "Indian", "Georgian", "Peruvian")
+ALBUMS = ("", "Mongolia", "Alps", "Japan", "Patagonia")
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def random_date(rng):
+    return (datetime(2015, 1, 1) + timedelta(seconds=rng.randrange(10 * 365 * 86400)))
+
+def seed(directory, scale, rng):
+    """Fill an empty directory with a synthetic dataset at scale x today's size."""
+    counts = {name: count * scale for name, count in BASE_COUNTS.items()}
+
+    # Images: real JPEGs, named like the camera files in data/images
+    from PIL import Image
+    os.makedirs(os.path.join(directory, "images"))
+    filenames = []
+    for i in range(min(counts["pictures"], MAX_IMAGES)):
+        name = f"{random_date(rng):%Y%m%d_%H%M%S}_{i}.jpg"
+        color = tuple(rng.randrange(256) for _ in range(3))
+        img = Image.new("RGB", IMAGE_SIZE, color)
+        img.paste(Image.effect_noise((IMAGE_SIZE[0] // 4, IMAGE_SIZE[1] // 4), 40).convert("RGB"), (0, 0))
+        img.save(os.path.join(directory, "images", name), "JPEG", quality=85)
+        filenames.append(name)
+
+    for db_name, schema in SCHEMA.items():
+        conn = sqlite3.connect(os.path.join(directory, db_name))
+        conn.executescript(schema)
+        conn.close()
+
+    conn = sqlite3.connect(os.path.join(directory, "pictures.db"))
+    conn.executemany(
+        "INSERT INTO pictures (title, description, filename, date_taken, album) VALUES (?, ?, ?, ?, ?)",
+        (
+            (sentence(rng, 3), sentence(rng, 12), filenames[i % len(filenames)],
+             random_date(rng).strftime("%Y-%m-%d"), rng.choice(ALBUMS))
+            for i in range(counts["pictures"])
+        )
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(os.path.join(directory, "blog.db"))
+    conn.executemany(
+        "INSERT INTO posts (title, description, location, date) VALUES (?, ?, ?, ?)",
+        (
+            (sentence(rng, 5), "\n\n".join(sentence(rng, 40) for _ in range(6)), sentence(rng, 2),
+             random_date(rng).strftime("%Y-%m-%d"))
+            for _ in range(counts["blog"])
+        )
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(os.path.join(directory, "site_update.db"))
+    conn.executemany(
+        "INSERT INTO posts (title, description, images, location, date) VALUES (?, ?, ?, ?, ?)",
+        (
+            (sentence(rng, 4), "## Changes\n\n- " + "\n- ".join(sentence(rng, 8) for _ in range(5)), "[]",
+             sentence(rng, 2), random_date(rng).strftime("%Y-%m-%d"))
+            for _ in range(counts["updates"])
+        )
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(os.path.join(directory, "food_map.db"))
+    conn.executemany(
+        "INSERT INTO food_locations (name, cuisine, rating, lat, lon, desc, link) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            (sentence(rng, 2), rng.choice(CUISINES), rng.randrange(1, 11) / 2,
+             rng.uniform(-60, 70), rng.uniform(-180, 180), sentence(rng, 10), "")
+            for _ in range(counts["food"])
+        )
+    )
+    conn.commit()
+    conn.close()
+
+    for layer, name_key in (("cities", "city"), ("mountains", "name")):
+        features = [
+            {
+                "type": "Feature",
+                "properties": {name_key: sentence(rng, 2), "date": random_date(rng).strftime("%Y-%m-%d")},
+                "geometry": {"type": "Point", "coordinates": [rng.uniform(-180, 180), rng.uniform(-60, 70)]},
+            }
+            for _ in range(counts[layer])
+        ]
+        with open(os.path.join(directory, f"{layer}.geojson"), "w", encoding="utf-8") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+    return counts
+
+# -------------------------
+# Measuring
+# -------------------------
+def summarize(latencies, elapsed):
+    """p50/p99 in milliseconds and requests per second for a list of latencies."""
+    ordered = sorted(latencies)
+    p99_index = min(len(ordered) - 1, max(0, round(0.99 * len(ordered)) - 1))
+    return {
+        "requests": len(ordered),
+        "p50_ms": round(statistics.median(ordered) * 1000, 3),
+        "p99_ms": round(ordered[p99_index] * 1000, 3),
+        "rps": round(len(ordered) / elapsed, 1) if elapsed else None,
+    }
+
+def peak_rss_mb(usage):
+    """ru_maxrss is KiB on Linux and bytes on macOS."""
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(usage.ru_maxrss / divisor, 1)
+
+def run_client(directory):
+    """Time the routes through the Flask test client (runs in a child process
+    whose PERSISTENT_DIR is the seeded directory)."""
+    import base64
+    sys.path.insert(0, REPO_DIR)
+    import app as site
+
+    site.warm_process_pool()  # as gunicorn.conf.py does for each worker
+    client = site.app.test_client()
+    auth = {"Authorization": "Basic " + base64.b64encode(f"{ADMIN_USERNAME}:{ADMIN_PASSWORD}".encode()).decode()}
+    city = site.query_features("cities", None)[0]
+
+    def request(method, path, i):
+        if method == "POST":
+            # Rename one city back and forth, so every POST writes a row
+            data = {f"title_{city['id']}": f"Bench city {i % 2}"}
+            response = client.post(path, data=data, headers=auth)
+        else:
+            response = client.get(path, headers=auth)
+        response.get_data()
+        response.close()
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+
+    results = {}
+    for name, (method, path, count) in CLIENT_ROUTES.items():
+        for i in range(2):  # warm caches and lazy initialization
+            request(method, path, i)
+        latencies = []
+        start = time.perf_counter()
+        for i in range(count):
+            t = time.perf_counter()
+            request(method, path, i)
+            latencies.append(time.perf_counter() - t)
+        results[name] = summarize(latencies, time.perf_counter() - start)
+    results["peak_rss_mb"] = peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def process_peak_rss_mb(pid):
+    """Peak RSS of a process from /proc (Linux only), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def run_server(directory, env):
+    """Load-test the public routes through a local gunicorn."""
+    import requests
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+         "--workers", str(SERVER_WORKERS), "--threads", "4", "--log-level", "warning"],
+        cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 120
+        while True:
+            try:
+                requests.get(base + "/api/food", timeout=5)
+                break
+            except requests.ConnectionError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("gunicorn did not start: " + server.stderr.read().decode()[-2000:])
+                time.sleep(0.2)
+
+        results = {}
+        with requests.Session() as session, ThreadPoolExecutor(SERVER_CONCURRENCY) as pool:
+            def timed_get(path):
+                t = time.perf_counter()
+                response = session.get(base + path, timeout=60)
+                response.raise_for_status()
+                return time.perf_counter() - t
+
+            for name in SERVER_ROUTES:
+                path = CLIENT_ROUTES[name][1]
+                list(pool.map(timed_get, [path] * SERVER_CONCURRENCY))  # warm every worker
+                start = time.perf_counter()
+                latencies = list(pool.map(timed_get, [path] * SERVER_REQUESTS))
+                results[name] = summarize(latencies, time.perf_counter() - start)
+
+        children = []
+        try:
+            with open(f"/proc/{server.pid}/task/{server.pid}/children") as f:
+                children = [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        peaks = [rss for rss in map(process_peak_rss_mb, [server.pid, *children]) if rss is not None]
+        results["peak_rss_mb"] = max(peaks) if peaks else None
+        return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+# -------------------------
+# Baseline comparison
+# -------------------------
+def compare(results, baseline, tolerance):
+    """Return a list of regression messages for results against the baseline."""
+    regressions = []
+    for run, routes in results.items():
+        for name, current in routes.items():
+            previous = baseline.get(run, {}).get(name)
+            if previous is None:
+                continue
+            label = f"{run} {name}"
+            if name == "peak_rss_mb":
+                if current and previous and current > previous * (1 + tolerance):
+                    regressions.append(f"{label}: {current} MB vs baseline {previous} MB")
+                continue
+            for key in ("p50_ms", "p99_ms"):
+                limit = max(previous[key] * (1 + tolerance), previous[key] + LATENCY_FLOOR_MS)
+                if current[key] > limit:
+                    regressions.append(f"{label} {key}: {current[key]} vs baseline {previous[key]}")
+            if current["rps"] and previous["rps"] and current["rps"] < previous["rps"] / (1 + tolerance):
+                if current["p50_ms"] > previous["p50_ms"] + LATENCY_FLOOR_MS:
+                    regressions.append(f"{label} rps: {current['rps']} vs baseline {previous['rps']}")
+    return regressions
+
+def print_table(run, routes):
+    print(f"\n{run}")
+    print(f"  {'route':<28}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for name, result in routes.items():
+        if name != "peak_rss_mb":
+            print(f"  {name:<28}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['rps'] or 0:>10.1f}")
+    print(f"  peak RSS: {routes.get('peak_rss_mb')} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1,100", help="comma-separated dataset multipliers (default 1,100)")
+    parser.add_argument("--no-server", action="store_true", help="skip the gunicorn load test")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown before failing, as a fraction (default 0.5)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded directories")
+    parser.add_argument("--client-worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client_worker:
+        # Child process: PERSISTENT_DIR is already set in the environment
+        print(json.dumps(run_client(args.client_worker)))
+        return 0
+
+    results = {}
+    for scale in (int(value) for value in args.scales.split(",")):
+        directory = tempfile.mkdtemp(prefix=f"bench-{scale}x-")
+        try:
+            start = time.perf_counter()
+            counts = seed(directory, scale, random.Random(args.seed))
+            print(f"Seeded {scale}x in {time.perf_counter() - start:.1f}s: {counts}")
+
+            env = dict(os.environ, PERSISTENT_DIR=directory,
+                       ADMIN_USERNAME=ADMIN_USERNAME, ADMIN_PASSWORD=ADMIN_PASSWORD, GEOCODE_UPSTREAM="off")
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--client-worker", directory],
+                env=env, capture_output=True, text=True
+            )
+            if child.returncode:
+                print(child.stdout + child.stderr, file=sys.stderr)
+                return child.returncode
+            results[f"{scale}x client"] = json.loads(child.stdout.strip().splitlines()[-1])
+            print_table(f"{scale}x client", results[f"{scale}x client"])
+
+            if not args.no_server:
+                results[f"{scale}x gunicorn"] = run_server(directory, env)
+                print_table(f"{scale}x gunicorn", results[f"{scale}x gunicorn"])
+        finally:
+            if args.keep:
+                print(f"Kept {directory}")
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("\nNo baseline to compare against; run with --update-baseline first.")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for message in regressions:
+            print(f"  {message}")
+        return 1
+    print("\nNo regressions against the baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+# Picked up by gunicorn when it is started from the repo root (see Procfile).
+
+def post_worker_init(worker):
+    """Start the image process pool before the worker takes requests."""
+    from app import warm_process_pool
+    warm_process_pool()
@@ -57,7 +57,21 @@ document.addEventListener("DOMContentLoaded", () => {
     });
 
     // ---------------------------
-    // Simple Nominatim Geocoding
+    // Save only the edited locations
+    // ---------------------------
+    const foodForm = document.getElementById("food-form");
+    if (foodForm) {
+        setupPatchForm(foodForm, "/admin/api/food", ({ changed, deleted, added }) => {
+            const upsert = Object.entries(changed).map(([id, fields]) => ({ id: Number(id), ...fields }));
+            if (added.name && added.cuisine && added.lat && added.lon) {
+                upsert.push(added);
+            }
+            return { upsert, delete: deleted };
+        });
+    }
+
+    // ---------------------------
+    // Geocoding
     // ---------------------------
     const geocodeBtn = document.getElementById("geocode-btn");
     const addressInput = document.getElementById("address-input");
@@ -67,10 +81,13 @@ document.addEventListener("DOMContentLoaded", () => {
             const query = addressInput.value.trim();
             if (!query) return;
 
-            const url = `https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}`;
+            const url = `/admin/api/geocode?q=${encodeURIComponent(query)}`;
 
             fetch(url)
-                .then(res => res.json())
+                .then(res => {
+                    if (!res.ok) throw new Error(res.status === 429 ? "Geocoder busy, try again in a second" : res.statusText);
+                    return res.json();
+                })
                 .then(results => {
                     if (results.length === 0) {
                         alert("Location not found.");
@@ -21,7 +21,7 @@ L.tileLayer('https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png', {
 // Load existing features from Flask
 // ---------------------------
 if (window.geojsonFeatures && Array.isArray(window.geojsonFeatures)) {
-    window.geojsonFeatures.forEach((feature, idx) => {
+    window.geojsonFeatures.forEach((feature) => {
         const coords = feature.geometry.coordinates;
         const marker = L.marker([coords[1], coords[0]], { draggable: true })
             .addTo(map)
@@ -29,8 +29,8 @@ if (window.geojsonFeatures && Array.isArray(window.geojsonFeatures)) {
 
         // Update hidden form inputs when marker is dragged
         marker.on('dragend', (e) => {
-            document.querySelector(`input[name="lat_${idx}"]`).value = e.target.getLatLng().lat;
-            document.querySelector(`input[name="lng_${idx}"]`).value = e.target.getLatLng().lng;
+            document.querySelector(`input[name="lat_${feature.id}"]`).value = e.target.getLatLng().lat;
+            document.querySelector(`input[name="lng_${feature.id}"]`).value = e.target.getLatLng().lng;
         });
 
         markers.push({ feature, marker });
@@ -53,7 +53,7 @@ map.on('click', function (e) {
 });
 
 // ---------------------------
-// Simple Nominatim Geocoding
+// Geocoding
 // ---------------------------
 const geocodeBtn = document.getElementById("geocode-btn");
 const addressInput = document.getElementById("address-input");
@@ -63,10 +63,13 @@ if (geocodeBtn && addressInput) {
         const query = addressInput.value.trim();
         if (!query) return;
 
-        const url = `https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}`;
+        const url = `/admin/api/geocode?q=${encodeURIComponent(query)}`;
 
         fetch(url)
-            .then(res => res.json())
+            .then(res => {
+                if (!res.ok) throw new Error(res.status === 429 ? "Geocoder busy, try again in a second" : res.statusText);
+                return res.json();
+            })
             .then(results => {
                 if (results.length === 0) {
                     alert("Location not found.");
@@ -95,4 +98,22 @@ if (geocodeBtn && addressInput) {
             })
             .catch(err => console.error("Geocoding error:", err));
     });
-}
\ No newline at end of file
+}
+// ---------------------------
+// Save only the edited cities
+// ---------------------------
+const cityForm = document.getElementById("geojson-form");
+if (cityForm) {
+    const cityFields = { title: ["city"], date: ["date"] };
+
+    setupPatchForm(cityForm, "/admin/api/features/cities", ({ changed, deleted, added }) => {
+        const upsert = Object.entries(changed).map(([id, fields]) => featureChange(cityForm, id, fields, cityFields));
+        if (added.city && added.lat && added.lng) {
+            upsert.push({
+                coordinates: [Number(added.lng), Number(added.lat)],
+                properties: { city: added.city, date: added.date || "" }
+            });
+        }
+        return { upsert, delete: deleted };
+    });
+}
@@ -0,0 +1,91 @@
+// ---------------------------
+// admin_patch.js
+// ---------------------------
+// Turns an admin form into a delta editor: on submit only the inputs that
+// changed since the page loaded are sent, as a JSON PATCH of
+// {"upsert": [...], "delete": [...]}. Existing rows use inputs named
+// "<field>_<id>", the add-new section uses "new_<field>".
+
+function trackFormChanges(form) {
+    const initial = new Map();
+    form.querySelectorAll("input, textarea, select").forEach(input => {
+        if (input.name) initial.set(input.name, input.type === "checkbox" ? input.checked : input.value);
+    });
+
+    return function collectChanges() {
+        const changed = {};  // id -> {field: value}
+        const deleted = [];
+        const added = {};    // field -> value
+
+        form.querySelectorAll("input, textarea, select").forEach(input => {
+            if (!input.name) return;
+
+            if (input.name.startsWith("new_")) {
+                if (input.value !== "") added[input.name.slice(4)] = input.value;
+                return;
+            }
+
+            const match = input.name.match(/^(.+)_(\d+)$/);
+            if (!match) return;
+            const [, field, id] = match;
+
+            if (input.type === "checkbox") {
+                if (field === "delete" && input.checked) deleted.push(Number(id));
+            } else if (input.value !== initial.get(input.name)) {
+                (changed[id] = changed[id] || {})[field] = input.value;
+            }
+        });
+
+        // Rows being deleted don't need their edits sent
+        deleted.forEach(id => delete changed[id]);
+        return { changed, deleted, added };
+    };
+}
+
+// Build a feature upsert from the changed fields of one row.
+// propertyMap maps form fields to [property name, optional converter].
+function featureChange(form, id, fields, propertyMap) {
+    const change = { id: Number(id) };
+    const properties = {};
+
+    Object.entries(fields).forEach(([field, value]) => {
+        if (!(field in propertyMap)) return;
+        const [key, convert] = propertyMap[field];
+        properties[key] = convert ? convert(value) : value;
+    });
+    if (Object.keys(properties).length) change.properties = properties;
+
+    // A dragged marker changes both hidden inputs; send the pair together
+    if ("lat" in fields || "lng" in fields) {
+        change.coordinates = [
+            Number(form.elements[`lng_${id}`].value),
+            Number(form.elements[`lat_${id}`].value)
+        ];
+    }
+    return change;
+}
+
+function setupPatchForm(form, url, buildBody) {
+    const collectChanges = trackFormChanges(form);
+
+    form.addEventListener("submit", (e) => {
+        e.preventDefault();
+        const body = buildBody(collectChanges());
+        if (!body.upsert.length && !body.delete.length) {
+            alert("No changes to save.");
+            return;
+        }
+
+        fetch(url, {
+            method: "PATCH",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(body)
+        })
+            .then(res => res.json().then(data => {
+                if (!res.ok) throw new Error(data.error || res.statusText);
+                return data;
+            }))
+            .then(() => window.location.reload())
+            .catch(err => alert(`Save failed: ${err.message}`));
+    });
+}
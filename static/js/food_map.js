@@ -72,38 +72,114 @@ function updateFilters() {
     addMarkers(cuisineFilter.value, parseFloat(ratingFilter.value));
 }
 
-// Rating slider display
+// Rating slider display; switching filters on/off changes between clusters and points
 ratingFilter.addEventListener('input', () => {
     ratingValue.textContent = ratingFilter.value;
-    updateFilters();
+    loadVisibleFood();
 });
-cuisineFilter.addEventListener('change', updateFilters);
+cuisineFilter.addEventListener('change', loadVisibleFood);
 
 // ---------------------------
 // Load data from Flask API
 // ---------------------------
-map.on('load', () => {
-    fetch("/api/food")
+// Only the locations inside the current view are requested; the list is
+// refreshed whenever the map stops moving. While zoomed out (and no filter is
+// active) the server returns precomputed clusters instead of every point.
+const CLUSTER_MAX_ZOOM = 14;
+let clusterMarkers = [];
+let latestRequest = 0;
+
+function filtersActive() {
+    return cuisineFilter.value !== "All" || parseFloat(ratingFilter.value) > 0;
+}
+
+function clearClusterMarkers() {
+    clusterMarkers.forEach(m => m.remove());
+    clusterMarkers = [];
+}
+
+function addClusterMarkers(clusters) {
+    clearClusterMarkers();
+    clusters.forEach(c => {
+        const el = document.createElement('div');
+        el.className = 'food-cluster';
+        el.textContent = c.properties.point_count;
+        el.addEventListener('click', () => {
+            map.easeTo({ center: c.geometry.coordinates, zoom: c.properties.expansion_zoom });
+        });
+
+        const marker = new maplibregl.Marker({ element: el })
+            .setLngLat(c.geometry.coordinates)
+            .addTo(map);
+        clusterMarkers.push(marker);
+    });
+}
+
+// /api/food?format=columnar sends one array per property (cuisine as
+// distinct values + codes); rebuild the row objects the filters expect
+function decodeColumnar(data) {
+    const columns = Object.entries(data.properties).map(([name, column]) =>
+        [name, column.codes ? column.codes.map(code => column.values[code]) : column]);
+    const rows = new Array(data.count);
+    for (let i = 0; i < data.count; i++) {
+        const row = { id: data.id[i], coords: [data.lon[i], data.lat[i]] };
+        columns.forEach(([name, values]) => { row[name] = values[i]; });
+        rows[i] = row;
+    }
+    return rows;
+}
+
+function loadVisibleFood() {
+    const b = map.getBounds();
+    const bbox = [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()]
+        .map(v => v.toFixed(5))
+        .join(",");
+    const zoom = Math.floor(map.getZoom());
+    const useClusters = zoom <= CLUSTER_MAX_ZOOM && !filtersActive();
+    const url = useClusters ? `/api/food?bbox=${bbox}&zoom=${zoom}` : `/api/food?bbox=${bbox}&format=columnar`;
+    const requestId = ++latestRequest;
+
+    fetch(url)
         .then(res => res.json())
         .then(data => {
-            foodLocations = data;
+            // Ignore responses that arrive after a newer request was sent
+            if (requestId !== latestRequest) return;
+
+            if (useClusters) {
+                const features = data.features;
+                addClusterMarkers(features.filter(f => f.properties.cluster));
+                foodLocations = features
+                    .filter(f => !f.properties.cluster)
+                    .map(f => ({ ...f.properties, coords: f.geometry.coordinates }));
+            } else {
+                clearClusterMarkers();
+                foodLocations = decodeColumnar(data);
+            }
+            updateFilters();
+        })
+        .catch(err => console.error("Error fetching food locations:", err));
+}
 
-            // Populate cuisine filter
-            const cuisineSet = new Set(foodLocations.map(f => f.cuisine));
-            cuisineSet.forEach(c => {
+map.on('load', () => {
+    // Populate cuisine filter
+    fetch("/api/food/cuisines")
+        .then(res => res.json())
+        .then(cuisines => {
+            cuisines.forEach(c => {
                 const opt = document.createElement('option');
                 opt.value = c;
                 opt.textContent = c;
                 cuisineFilter.appendChild(opt);
             });
-
-            addMarkers();
         })
-        .catch(err => console.error("Error fetching food locations:", err));
+        .catch(err => console.error("Error fetching cuisines:", err));
+
+    loadVisibleFood();
 });
+map.on('moveend', loadVisibleFood);
 
 // ---------------------------
-// Geocode search (Nominatim)
+// Geocode search (/api/geocode)
 // ---------------------------
 const geocodeBtn = document.getElementById("geocode-btn");
 const addressInput = document.getElementById("address-input");
@@ -113,7 +189,7 @@ if (geocodeBtn && addressInput) {
         const query = addressInput.value.trim();
         if (!query) return;
 
-        const url = `https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}`;
+        const url = `/api/geocode?q=${encodeURIComponent(query)}`;
         fetch(url)
             .then(res => res.json())
             .then(results => {
@@ -189,6 +265,19 @@ function addLegend() {
             color: #1E88E5 !important;
             text-decoration: underline;
         }
+        .food-cluster {
+            width: 34px;
+            height: 34px;
+            line-height: 34px;
+            border-radius: 50%;
+            background: rgba(30, 136, 229, 0.85);
+            border: 2px solid white;
+            color: white;
+            font: bold 13px sans-serif;
+            text-align: center;
+            cursor: pointer;
+            box-shadow: 0 0 5px rgba(0,0,0,0.3);
+        }
     `;
     document.head.appendChild(style);
 }
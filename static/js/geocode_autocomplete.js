@@ -0,0 +1,40 @@
+// ---------------------------
+// geocode_autocomplete.js
+// ---------------------------
+// Suggests place names under the #address-input search box while typing,
+// from the site's local gazetteer (/api/geocode?autocomplete=1).
+
+(function () {
+    const input = document.getElementById("address-input");
+    if (!input) return;
+
+    const list = document.createElement("datalist");
+    list.id = "address-suggestions";
+    input.setAttribute("list", list.id);
+    input.setAttribute("autocomplete", "off");
+    input.after(list);
+
+    let timer = null;
+    let latestQuery = "";
+
+    input.addEventListener("input", () => {
+        clearTimeout(timer);
+        const query = input.value.trim();
+        if (query.length < 2) return;
+
+        timer = setTimeout(() => {
+            latestQuery = query;
+            fetch(`/api/geocode?autocomplete=1&limit=8&q=${encodeURIComponent(query)}`)
+                .then(res => res.json())
+                .then(results => {
+                    if (query !== latestQuery) return;  // a newer request is on its way
+                    list.replaceChildren(...results.map(place => {
+                        const option = document.createElement("option");
+                        option.value = place.display_name;
+                        return option;
+                    }));
+                })
+                .catch(err => console.error("Autocomplete error:", err));
+        }, 150);
+    });
+})();
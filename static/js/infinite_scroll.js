@@ -0,0 +1,54 @@
+// ---------------------------
+// infinite_scroll.js
+// ---------------------------
+// Turns a "Load more" link into infinite scroll. When the link comes close to
+// the viewport the next page is fetched as JSON and its HTML is appended to
+// the list. Without JavaScript the link still opens the next page.
+
+document.querySelectorAll("a.load-more[data-page-url]").forEach(link => {
+    const list = document.querySelector(link.dataset.target);
+    if (!list) return;
+
+    let loading = false;
+    let observer = null;
+
+    const loadNext = () => {
+        if (loading) return;
+        loading = true;
+
+        fetch(link.dataset.pageUrl)
+            .then(res => {
+                if (!res.ok) throw new Error(res.statusText);
+                return res.json();
+            })
+            .then(page => {
+                list.insertAdjacentHTML("beforeend", page.html);
+                if (page.next_page_url) {
+                    link.dataset.pageUrl = page.next_page_url;
+                    link.href = page.next_url;
+                    // Re-observe so a short page that leaves the link in view loads again
+                    if (observer) {
+                        observer.unobserve(link);
+                        observer.observe(link);
+                    }
+                } else {
+                    if (observer) observer.disconnect();
+                    link.remove();
+                }
+            })
+            .catch(err => console.error("Error loading more:", err))
+            .finally(() => { loading = false; });
+    };
+
+    link.addEventListener("click", (e) => {
+        e.preventDefault();
+        loadNext();
+    });
+
+    if ("IntersectionObserver" in window) {
+        observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadNext();
+        }, { rootMargin: "600px" });
+        observer.observe(link);
+    }
+});
@@ -237,25 +237,51 @@ const expandableLayerControl = L.Control.extend({
         countryLabel.style.fontSize = "0.85rem";
         countryLabel.style.color = "#000";
 
-        // Load GeoJSON
-        fetch("/static/layers/countries.json")
-            .then(res => res.json())
-            .then(data => {
-                countryLayer = L.geoJSON(data, {
-                    style: {
+        if (window.countryTiles && L.vectorGrid) {
+            // Pre-built vector tiles: only the visible boundaries, simplified per zoom
+            countryLayer = L.vectorGrid.protobuf("/tiles/countries/{z}/{x}/{y}.pbf", {
+                maxNativeZoom: window.countryTilesMaxZoom,
+                interactive: true,
+                vectorTileLayerStyles: {
+                    countries: {
                         weight: 1,
+                        color: "#3388ff",
                         fill: true,
-                        fillColor: "rgba(200,200,200,0.2)"
-                    },
-                    onEachFeature: (feature, layer) => {
-                        layer.bindPopup(feature.properties.ADMIN || "Country");
+                        fillColor: "rgb(200,200,200)",
+                        fillOpacity: 0.2
                     }
-                });
+                }
+            });
+            countryLayer.on("click", e => {
+                L.popup()
+                    .setLatLng(e.latlng)
+                    .setContent(e.layer.properties.ADMIN || "Country")
+                    .openOn(map);
+            });
 
-                // Add by default
-                countryLayer.addTo(map);
-            })
-            .catch(err => console.error("Error loading country boundaries:", err));
+            // Add by default
+            countryLayer.addTo(map);
+        } else {
+            // Fall back to the full GeoJSON
+            fetch("/static/layers/countries.json")
+                .then(res => res.json())
+                .then(data => {
+                    countryLayer = L.geoJSON(data, {
+                        style: {
+                            weight: 1,
+                            fill: true,
+                            fillColor: "rgba(200,200,200,0.2)"
+                        },
+                        onEachFeature: (feature, layer) => {
+                            layer.bindPopup(feature.properties.ADMIN || "Country");
+                        }
+                    });
+
+                    // Add by default
+                    countryLayer.addTo(map);
+                })
+                .catch(err => console.error("Error loading country boundaries:", err));
+        }
 
         // Toggle layer when clicking the row
         countryRow.addEventListener("click", (e) => {
@@ -272,6 +298,75 @@ const expandableLayerControl = L.Control.extend({
             countryVisible = !countryVisible;
         });
 
+        // ---------------------------
+        // PHOTO LAYER TOGGLE
+        // ---------------------------
+        // Geotagged photos come from /api/photos, fetched for the visible area
+        const photoLayer = L.layerGroup();
+        let photoVisible = false; // default OFF
+
+        const photoRow = L.DomUtil.create("div", "", content);
+        photoRow.style.display = "flex";
+        photoRow.style.alignItems = "center";
+        photoRow.style.marginBottom = "4px";
+        photoRow.style.cursor = "pointer";
+
+        const photoCheck = L.DomUtil.create("span", "", photoRow);
+        photoCheck.style.display = "inline-block";
+        photoCheck.style.width = "16px";
+        photoCheck.style.marginRight = "6px";
+        photoCheck.style.color = "#000";
+        photoCheck.style.fontWeight = "bold";
+
+        const photoLabel = L.DomUtil.create("span", "", photoRow);
+        photoLabel.textContent = "Photos";
+        photoLabel.style.fontSize = "0.85rem";
+        photoLabel.style.color = "#000";
+
+        const loadPhotos = () => {
+            if (!photoVisible) return;
+            const b = map.getBounds();
+            const bbox = [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()]
+                .map(v => v.toFixed(4)).join(",");
+            fetch(`/api/photos?bbox=${bbox}`)
+                .then(res => res.json())
+                .then(data => {
+                    photoLayer.clearLayers();
+                    data.features.forEach(feature => {
+                        const [lon, lat] = feature.geometry.coordinates;
+                        const props = feature.properties;
+                        const popup = document.createElement("a");
+                        popup.href = props.url;
+                        const img = document.createElement("img");
+                        img.src = props.thumbnail;
+                        img.alt = props.title || "";
+                        img.loading = "lazy";
+                        img.style.width = "160px";
+                        const caption = document.createElement("div");
+                        caption.textContent = [props.title, props.date].filter(Boolean).join(" · ");
+                        popup.append(img, caption);
+                        L.circleMarker([lat, lon], { radius: 5, color: "#e8590c", weight: 1, fillOpacity: 0.8 })
+                            .bindPopup(popup)
+                            .addTo(photoLayer);
+                    });
+                })
+                .catch(err => console.error("Error loading photos:", err));
+        };
+        map.on("moveend", loadPhotos);
+
+        photoRow.addEventListener("click", (e) => {
+            e.stopPropagation();
+            photoVisible = !photoVisible;
+            if (photoVisible) {
+                photoLayer.addTo(map);
+                photoCheck.textContent = "✔";
+                loadPhotos();
+            } else {
+                map.removeLayer(photoLayer);
+                photoCheck.textContent = "";
+            }
+        });
+
         // ---------------------------
         // Expand/collapse logic
         // ---------------------------
@@ -328,7 +423,8 @@ const timeline = document.getElementById("location-list");
 // ---------------------------
 // Load GeoJSON
 // ---------------------------
-fetch("/data/cities.geojson")
+// map_view.html passes a fingerprinted URL so the browser can cache it
+fetch(window.citiesUrl || "/data/cities.geojson")
     .then(res => res.json())
     .then(data => {
         geojsonData = data;
@@ -444,14 +540,14 @@ fetch("/data/cities.geojson")
     .catch(err => console.error("Error loading GeoJSON:", err));
 
 // ---------------------------
-// Simple Nominatim Geocoding
+// Geocoding
 // ---------------------------
 document.getElementById("geocode-btn").addEventListener("click", () => {
     const query = document.getElementById("address-input").value.trim();
     if (!query) return;
 
-    // Use Nominatim API
-    const url = `https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}`;
+    // Site geocoder (local gazetteer, cached Nominatim fallback)
+    const url = `/api/geocode?q=${encodeURIComponent(query)}`;
 
     fetch(url)
         .then(res => res.json())
@@ -19,7 +19,7 @@ L.tileLayer('https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png', {
 // Load existing features from Flask
 // ---------------------------
 if (window.geojsonFeatures && Array.isArray(window.geojsonFeatures)) {
-    window.geojsonFeatures.forEach((feature, idx) => {
+    window.geojsonFeatures.forEach((feature) => {
         const coords = feature.geometry.coordinates;
         const marker = L.marker([coords[1], coords[0]], { draggable: true })
             .addTo(map)
@@ -27,8 +27,8 @@ if (window.geojsonFeatures && Array.isArray(window.geojsonFeatures)) {
 
         // Update hidden form inputs when marker is dragged
         marker.on('dragend', (e) => {
-            document.querySelector(`input[name="lat_${idx}"]`).value = e.target.getLatLng().lat;
-            document.querySelector(`input[name="lng_${idx}"]`).value = e.target.getLatLng().lng;
+            document.querySelector(`input[name="lat_${feature.id}"]`).value = e.target.getLatLng().lat;
+            document.querySelector(`input[name="lng_${feature.id}"]`).value = e.target.getLatLng().lng;
         });
 
         markers.push({ feature, marker });
@@ -51,7 +51,7 @@ map.on('click', function (e) {
 });
 
 // ---------------------------
-// Simple Nominatim Geocoding
+// Geocoding
 // ---------------------------
 const geocodeBtn = document.getElementById("geocode-btn");
 const addressInput = document.getElementById("address-input");
@@ -61,10 +61,13 @@ if (geocodeBtn && addressInput) {
         const query = addressInput.value.trim();
         if (!query) return;
 
-        const url = `https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}`;
+        const url = `/admin/api/geocode?q=${encodeURIComponent(query)}`;
 
         fetch(url)
-            .then(res => res.json())
+            .then(res => {
+                if (!res.ok) throw new Error(res.status === 429 ? "Geocoder busy, try again in a second" : res.statusText);
+                return res.json();
+            })
             .then(results => {
                 if (results.length === 0) {
                     alert("Location not found.");
@@ -93,4 +96,40 @@ if (geocodeBtn && addressInput) {
             })
             .catch(err => console.error("Geocoding error:", err));
     });
-}
\ No newline at end of file
+}
+// ---------------------------
+// Save only the edited summits
+// ---------------------------
+const summitForm = document.getElementById("geojson-form");
+if (summitForm) {
+    const toInt = value => parseInt(value, 10) || 0;
+    const toNumber = value => Number(value) || 0;
+    const summitFields = {
+        name: ["name"],
+        date: ["date"],
+        crowds: ["crowds"],
+        rating: ["rating", toInt],
+        difficulty: ["difficulty", toInt],
+        distance: ["distance (mi)", toNumber],
+        elevation: ["elevation (m)", toNumber]
+    };
+
+    setupPatchForm(summitForm, "/admin/api/features/mountains", ({ changed, deleted, added }) => {
+        const upsert = Object.entries(changed).map(([id, fields]) => featureChange(summitForm, id, fields, summitFields));
+        if (added.name && added.lat && added.lng) {
+            upsert.push({
+                coordinates: [Number(added.lng), Number(added.lat)],
+                properties: {
+                    name: added.name,
+                    "elevation (m)": toNumber(added.elevation),
+                    date: added.date || "",
+                    rating: toInt(added.rating),
+                    difficulty: toInt(added.difficulty),
+                    "distance (mi)": toNumber(added.distance),
+                    crowds: added.crowds || ""
+                }
+            });
+        }
+        return { upsert, delete: deleted };
+    });
+}
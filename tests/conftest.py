@@ -0,0 +1,53 @@
+"""
+Shared fixtures. The app reads PERSISTENT_DIR and the admin credentials when
+it is imported, so both are set here, before any test imports it: the
+databases and layers from data/ are copied into a temp folder (the images
+are left out, the tests bring their own).
+"""
+import base64
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_USERNAME = "test"
+ADMIN_PASSWORD = "test"
+
+DATA_DIR = tempfile.mkdtemp(prefix="geojourney-tests-")
+for name in os.listdir(os.path.join(REPO_DIR, "data")):
+    source = os.path.join(REPO_DIR, "data", name)
+    if name == "images":
+        os.makedirs(os.path.join(DATA_DIR, name))
+    elif os.path.isdir(source):
+        shutil.copytree(source, os.path.join(DATA_DIR, name))
+    else:
+        shutil.copy2(source, DATA_DIR)
+
+os.environ["PERSISTENT_DIR"] = DATA_DIR
+os.environ["ADMIN_USERNAME"] = ADMIN_USERNAME
+os.environ["ADMIN_PASSWORD"] = ADMIN_PASSWORD
+sys.path.insert(0, REPO_DIR)
+
+def pytest_sessionfinish(session, exitstatus):
+    # Pool workers import the app too; let them finish before removing their data
+    site = sys.modules.get("app")
+    if site and site._process_pool:
+        site._process_pool.shutdown(wait=True)
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def site():
+    import app as site
+    return site
+
+@pytest.fixture
+def client(site):
+    return site.app.test_client()
+
+@pytest.fixture
+def auth():
+    token = base64.b64encode(f"{ADMIN_USERNAME}:{ADMIN_PASSWORD}".encode()).decode()
+    return {"Authorization": "Basic " + token}
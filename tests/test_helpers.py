@@ -0,0 +1,151 @@
+"""Pure helpers: cursors, PATCH parsing, manifest diffing and EXIF orientation."""
+import base64
+import io
+import struct
+
+import pytest
+from PIL import Image
+
+
+# -------------------------
+# Keyset cursors
+# -------------------------
+def test_cursor_round_trip(site):
+    cursor = site.encode_cursor("2025-09-28", 42)
+    assert "=" not in cursor
+    assert site.decode_cursor(cursor) == ("2025-09-28", 42)
+
+def test_cursor_without_date(site):
+    assert site.decode_cursor(site.encode_cursor(None, 7)) == ("", 7)
+
+def test_no_cursor(site):
+    assert site.decode_cursor(None) is None
+    assert site.decode_cursor("") is None
+
+@pytest.mark.parametrize("payload", [b"not json", b'["a", "b"]', b"[1, 2]", b'["a", true]', b'["a", 1, 2]'])
+def test_malformed_cursor(site, payload):
+    with pytest.raises(ValueError):
+        site.decode_cursor(base64.urlsafe_b64encode(payload).decode().rstrip("="))
+
+def test_cursor_that_is_not_base64(site):
+    with pytest.raises(ValueError):
+        site.decode_cursor("not base64!")
+
+# -------------------------
+# PATCH bodies
+# -------------------------
+def test_parse_patch(site):
+    body = {"upsert": [{"id": 3, "name": "x"}, {"name": "y"}, {"id": None}], "delete": [4, 5]}
+    assert site.parse_patch(body) == (body["upsert"], [4, 5])
+    assert site.parse_patch({}) == ([], [])
+
+@pytest.mark.parametrize("body", [
+    [],
+    {"upsert": {"id": 1}},
+    {"upsert": [1]},
+    {"upsert": [{"id": "3"}]},
+    {"upsert": [{"id": True}]},
+    {"upsert": [{"id": 1.5}]},
+    {"delete": ["4"]},
+    {"delete": [True]},
+])
+def test_parse_patch_rejects(site, body):
+    with pytest.raises(ValueError):
+        site.parse_patch(body)
+
+def test_food_values(site):
+    values = site.food_values({"id": 1, "name": "Ramen", "lat": "35.5", "lon": -139, "desc": None, "other": 1})
+    assert values == {"name": "Ramen", "lat": 35.5, "lon": -139.0, "desc": None}
+
+@pytest.mark.parametrize("item", [
+    {"lat": 90.5},
+    {"lat": -91},
+    {"lon": 180.01},
+    {"lon": "nan"},
+    {"rating": float("inf")},
+    {"rating": "good"},
+])
+def test_food_values_rejects(site, item):
+    with pytest.raises(ValueError):
+        site.food_values(item)
+
+# -------------------------
+# Sync manifests
+# -------------------------
+SERVER_ENTRY = {"sha256": "abc", "size": 10, "mtime": 1700000000.5}
+
+@pytest.mark.parametrize("client_entry, changed", [
+    (None, True),
+    ({}, True),
+    ({"sha256": "abc", "size": 99}, False),  # the hash wins over size and mtime
+    ({"sha256": "def"}, True),
+    ({"size": 10, "mtime": 1700000000.5}, False),
+    ({"size": 10, "mtime": 1700000001}, True),
+    ({"size": 11, "mtime": 1700000000.5}, True),
+])
+def test_file_changed(site, client_entry, changed):
+    assert site.file_changed(SERVER_ENTRY, client_entry) is changed
+
+# -------------------------
+# EXIF orientation
+# -------------------------
+@pytest.mark.parametrize("orientation, degrees, expected", [
+    (1, 90, 6),
+    (1, 180, 3),
+    (1, 270, 8),
+    (1, -90, 8),
+    (6, 90, 3),
+    (8, 90, 1),
+    (1, 360, 1),
+    (2, 90, 7),   # mirrored orientations cycle among themselves
+    (None, 90, 6),
+    (9, 90, 6),
+])
+def test_rotated_orientation(site, orientation, degrees, expected):
+    assert site.rotated_orientation(orientation, degrees) == expected
+
+def jpeg_bytes(orientation=None):
+    buffer = io.BytesIO()
+    image = Image.new("RGB", (64, 32), "red")
+    if orientation is None:
+        image.save(buffer, "JPEG")
+    else:
+        exif = image.getexif()
+        exif[0x0112] = orientation
+        image.save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+def scan_data(data):
+    """The compressed image data after the SOS marker."""
+    return data[data.index(b"\xff\xda"):]
+
+def test_rotate_jpeg_patches_existing_tag(site, tmp_path):
+    path = tmp_path / "photo.jpg"
+    original = jpeg_bytes(orientation=1)
+    path.write_bytes(original)
+
+    assert site.rotate_jpeg_lossless(str(path), 90) == 6
+    rotated = path.read_bytes()
+    assert len(rotated) == len(original)
+    assert scan_data(rotated) == scan_data(original)
+    with Image.open(path) as img:
+        assert img.getexif()[site.EXIF_ORIENTATION] == 6
+
+def test_rotate_jpeg_adds_missing_tag(site, tmp_path):
+    path = tmp_path / "photo.jpg"
+    original = jpeg_bytes()
+    path.write_bytes(original)
+
+    assert site.rotate_jpeg_lossless(str(path), 270) == 8
+    rotated = path.read_bytes()
+    assert scan_data(rotated) == scan_data(original)
+    with Image.open(path) as img:
+        assert img.getexif()[site.EXIF_ORIENTATION] == 8
+    # JFIF keeps its APP0 segment first
+    assert struct.unpack(">H", rotated[2:4])[0] == 0xFFE0
+
+def test_rotate_jpeg_rejects_other_formats(site, tmp_path):
+    path = tmp_path / "photo.png"
+    Image.new("RGB", (8, 8)).save(path, "PNG")
+    with pytest.raises(ValueError):
+        site.rotate_jpeg_lossless(str(path), 90)
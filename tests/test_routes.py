@@ -0,0 +1,129 @@
+"""Routes through the test client: the response cache, source versions and restores."""
+import io
+import json
+import os
+import time
+import zipfile
+
+import pytest
+
+
+# -------------------------
+# Response cache keys
+# -------------------------
+def test_repeated_request_hits_cache(client):
+    assert client.get("/api/food?bbox=-180,-90,180,90").headers["X-Cache"] == "MISS"
+    assert client.get("/api/food?bbox=-180,-90,180,90").headers["X-Cache"] == "HIT"
+
+def test_query_string_is_part_of_key(client):
+    client.get("/api/food?bbox=-10,-10,10,10")
+    assert client.get("/api/food?bbox=-11,-10,10,10").headers["X-Cache"] == "MISS"
+
+def test_encoding_is_part_of_key(client):
+    plain = client.get("/api/food?bbox=-20,-20,20,20")
+    gzipped = client.get("/api/food?bbox=-20,-20,20,20", headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["X-Cache"] == "MISS"
+    assert "Content-Encoding" not in plain.headers
+    assert client.get("/api/food?bbox=-20,-20,20,20").headers["X-Cache"] == "HIT"
+
+def test_layout_is_part_of_key(client, site):
+    client.get("/api/food?bbox=-30,-30,30,30")
+    columnar = client.get("/api/food?bbox=-30,-30,30,30", headers={"Accept": site.COLUMNAR_MIMETYPE})
+    assert columnar.headers["X-Cache"] == "MISS"
+    assert "id" in columnar.get_json()
+
+def test_write_changes_key(client, auth):
+    client.get("/api/food")
+    response = client.patch("/admin/api/food", headers=auth, json={
+        "upsert": [{"name": "Test noodles", "cuisine": "Thai", "lat": 18.79, "lon": 98.98}]
+    })
+    assert response.status_code == 200
+    new_id = response.get_json()["inserted"][0]
+
+    fresh = client.get("/api/food")
+    assert fresh.headers["X-Cache"] == "MISS"
+    assert new_id in [row["id"] for row in fresh.get_json()]
+
+# -------------------------
+# Source versions
+# -------------------------
+def test_reset_source_versions_moves_every_counter_forward(site):
+    before = {source: site.source_version(source) for source in site.DATA_SOURCES}
+    started_ms = int(time.time() * 1000)
+    site.reset_source_versions()
+    for source, version in before.items():
+        after = site.source_version(source)
+        assert after > version
+        assert after >= started_ms
+
+def test_reset_source_versions_after_counter_from_future(site):
+    path, name = site.DATA_SOURCES["food"]
+    conn = site.get_connection(path)
+    future = int(time.time() * 1000) * 10
+    conn.execute("UPDATE data_versions SET version = ? WHERE name = ?", (future, name))
+    conn.commit()
+    conn.close()
+
+    site.reset_source_versions()
+    assert site.source_version("food") == future + 1
+
+# -------------------------
+# Restore (/admin/upload_data)
+# -------------------------
+def backup_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+def upload(client, auth, files, filename="backup.zip"):
+    return client.post(
+        "/admin/upload_data", headers=auth, content_type="multipart/form-data",
+        data={"file": (backup_zip(files), filename)}
+    )
+
+def test_restore_needs_auth(client):
+    assert client.get("/admin/upload_data").status_code == 401
+
+def test_restore_form(client, auth):
+    assert b'type="file"' in client.get("/admin/upload_data", headers=auth).data
+
+def test_restore_layer_updates_feature_store(client, auth, site):
+    layer = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [106.9, 47.9]},
+         "properties": {"city": "Ulaanbaatar", "date": "2024-07-05"}},
+    ]}
+    response = upload(client, auth, {"cities.geojson": json.dumps(layer)})
+    assert response.status_code == 200
+    assert b"Files restored: 1" in response.data
+    assert [f["properties"]["city"] for f in site.query_features("cities", None)] == ["Ulaanbaatar"]
+
+    # The same archive again changes nothing
+    assert b"Files unchanged: 1" in upload(client, auth, {"cities.geojson": json.dumps(layer)}).data
+
+def test_restore_rejects_escaping_paths(client, auth, site):
+    response = upload(client, auth, {"../outside.txt": "x", "/abs.txt": "x"})
+    assert b"Entries rejected: 2" in response.data
+    assert not os.path.exists(os.path.join(os.path.dirname(site.PERSISTENT_DIR), "outside.txt"))
+
+def test_restore_deletes_only_backed_up_files(client, auth, site):
+    kept = os.path.join(site.PERSISTENT_DIR, ".hidden", "kept.txt")
+    os.makedirs(os.path.dirname(kept), exist_ok=True)
+    for path in (kept, os.path.join(site.IMAGE_FOLDER, "old.jpg")):
+        with open(path, "w") as f:
+            f.write("x")
+
+    manifest = {"deleted": ["images/old.jpg", ".hidden/kept.txt", "../etc/passwd", "missing.txt"]}
+    response = upload(client, auth, {site.SYNC_MANIFEST_NAME: json.dumps(manifest)})
+    assert b"Files deleted: 1" in response.data
+    assert b"Entries rejected: 3" in response.data
+    assert not os.path.exists(os.path.join(site.IMAGE_FOLDER, "old.jpg"))
+    assert os.path.exists(kept)
+
+@pytest.mark.parametrize("manifest", ["{not json", "[1]", '{"deleted": "images/a.jpg"}', '{"deleted": [1]}'])
+def test_restore_rejects_malformed_manifest(client, auth, site, manifest):
+    response = upload(client, auth, {site.SYNC_MANIFEST_NAME: manifest})
+    assert response.status_code == 400
+    assert b"Invalid backup" in response.data